@@ -0,0 +1,324 @@
+"""
+bench_path.py - Rough benchmarks for path.py.
+
+Run directly::
+
+    python bench_path.py
+
+Each benchmark builds its fixtures in a temporary directory, reports the
+best wall-clock time over a few runs and, where relevant, how many
+``stat()`` calls were issued.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import timeit
+
+from path import Path, tempdir
+
+
+class StatCounter(object):
+    """
+    Context manager that counts calls to :func:`os.stat` and
+    :func:`os.lstat` made from Python code.
+    """
+    def __enter__(self):
+        self.count = 0
+        self._saved = os.stat, os.lstat
+
+        def wrap(func):
+            def counted(*args, **kwargs):
+                self.count += 1
+                return func(*args, **kwargs)
+            return counted
+        os.stat, os.lstat = map(wrap, self._saved)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.stat, os.lstat = self._saved
+
+
+def build_tree(root, width=10, depth=3, files=20):
+    """
+    Populate `root` with `width` subdirectories per level, `depth` levels
+    deep, each holding `files` empty files.
+    """
+    dirs = [root]
+    for level in range(depth):
+        next_dirs = []
+        for d in dirs:
+            for i in range(files):
+                (d / ('file%d.txt' % i)).touch()
+            for i in range(width):
+                next_dirs.append((d / ('dir%d' % i)).mkdir())
+        dirs = next_dirs
+    return root
+
+
+def legacy_walkfiles(d):
+    """ The listdir()-then-isfile()/isdir() walk used before 6.3. """
+    for child in d.listdir():
+        if child.isfile():
+            yield child
+        elif child.isdir():
+            for f in legacy_walkfiles(child):
+                yield f
+
+
+def report(name, func, repeat=3):
+    with StatCounter() as counter:
+        func()
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print('%-48s %8.3fs %10d stat calls' % (name, best, counter.count))
+
+
+def bench_walk():
+    with tempdir() as d:
+        build_tree(d, width=8, depth=3)
+        report('walkfiles (listdir + stat)',
+               lambda: list(legacy_walkfiles(d)))
+        report('walkfiles', lambda: list(d.walkfiles()))
+        report('walkfiles, 8 workers', lambda: list(d.walkfiles(workers=8)))
+        report('walkfiles, 8 workers, ordered',
+               lambda: list(d.walkfiles(workers=8, ordered=True)))
+        report('walkdirs', lambda: list(d.walkdirs()))
+        report('walk', lambda: list(d.walk()))
+
+
+def bench_deep_walk(depth=40, files=200):
+    with tempdir() as d:
+        leaf = d
+        for i in range(depth):
+            leaf = (leaf / 'd').mkdir()
+            for j in range(files // depth):
+                (leaf / ('file%d.txt' % j)).touch()
+        report('walkfiles, %d levels deep' % depth,
+               lambda: list(d.walkfiles()))
+
+
+def bench_matching(names=20000, patterns=30):
+    from path import Matcher
+    globs = ['*.ext%d' % i for i in range(patterns)]
+    candidates = [Path('file%d.ext%d' % (i, i % (2 * patterns)))
+                  for i in range(names)]
+    matcher = Matcher(globs)
+
+    def one_by_one():
+        return [c for c in candidates if any(c.fnmatch(g) for g in globs)]
+
+    def compiled():
+        return [c for c in candidates if c.fnmatch(matcher)]
+    assert one_by_one() == compiled()
+    report('fnmatch, %d patterns one by one' % patterns, one_by_one)
+    report('fnmatch, %d patterns as a Matcher' % patterns, compiled)
+
+
+def bench_hashing(count=64, size=2 ** 20):
+    with tempdir() as d:
+        files = [(d / ('%d.bin' % i)) for i in range(count)]
+        for f in files:
+            f.write_bytes(os.urandom(size))
+        report('read_hash, %d x %d KiB' % (count, size // 1024),
+               lambda: [f.read_hash('sha256') for f in files])
+        for workers in (2, 8):
+            report('hash_many, %d workers' % workers,
+                   lambda: list(Path.hash_many(files, 'sha256', workers)))
+
+
+def bench_copy(size=2 ** 28):
+    import shutil
+    from path import COPY_STRATEGIES
+    with tempdir() as d:
+        src = d / 'src.bin'
+        with src.open('wb') as f:
+            for i in range(size // 2 ** 20):
+                f.write(os.urandom(2 ** 20))
+        dst = d / 'dst.bin'
+        report('shutil.copyfile, %d MiB' % (size // 2 ** 20),
+               lambda: shutil.copyfile(src, dst))
+        for strategy in COPY_STRATEGIES:
+            try:
+                src.copy_data(dst, [strategy])
+            except ValueError:
+                print('%-48s unavailable' % strategy)
+                continue
+            report('copy_data, %s' % strategy,
+                   lambda: src.copy_data(dst, [strategy]))
+        print('copy_data picks %r' % src.copy_data(dst))
+
+
+def bench_copytree():
+    import shutil
+    with tempdir() as d:
+        src = (d / 'src').mkdir()
+        build_tree(src, width=6, depth=3, files=10)
+        for f in src.walkfiles():
+            f.write_bytes(b'x' * 65536)
+
+        def run(func):
+            def copy():
+                if (d / 'dst').exists():
+                    (d / 'dst').rmtree()
+                func(d / 'dst')
+            return copy
+        report('shutil.copytree', run(lambda dst: shutil.copytree(src, dst)))
+        for workers in (1, 4, 16):
+            report('copytree, %d workers' % workers,
+                   run(lambda dst: src.copytree(dst, workers=workers)))
+
+
+def bench_rmtree():
+    import shutil
+    with tempdir() as d:
+        def run(func):
+            def setup_and_remove():
+                build_tree((d / 'tree').mkdir(), width=6, depth=4, files=10)
+                start = timeit.default_timer()
+                func(d / 'tree')
+                return timeit.default_timer() - start
+            return setup_and_remove
+        for name, func in [
+            ('shutil.rmtree', shutil.rmtree),
+            ('rmtree', Path.rmtree),
+            ('rmtree, 4 workers', lambda p: p.rmtree(workers=4)),
+        ]:
+            print('%-48s %8.3fs' % (name, min(run(func)() for i in range(3))))
+
+
+def legacy_text(p, encoding):
+    """ Path.text() with an encoding, as of path.py 6.2. """
+    import codecs
+    with codecs.open(p, 'r', encoding) as f:
+        t = f.read()
+    return (t.replace(u'\r\n', u'\n')
+             .replace(u'\r\x85', u'\n')
+             .replace(u'\r', u'\n')
+             .replace(u'\x85', u'\n')
+             .replace(u'\u2028', u'\n'))
+
+
+def legacy_write_text(p, text, encoding, linesep=os.linesep):
+    """ Path.write_text() with Unicode text, as of path.py 6.2. """
+    text = (text.replace(u'\r\n', u'\n')
+                .replace(u'\r\x85', u'\n')
+                .replace(u'\r', u'\n')
+                .replace(u'\x85', u'\n')
+                .replace(u'\u2028', u'\n'))
+    p.write_bytes(text.replace(u'\n', linesep).encode(encoding))
+
+
+def bench_text(lines=500000):
+    line = u'The quick brown fox jumps over the lazy dog %d'
+    inputs = [
+        ('ASCII', u'\n'.join(line % i for i in range(lines))),
+        ('UTF-8', u'\n'.join(line % i + u' \u00e9\u4e2d'
+                              for i in range(lines))),
+        ('mixed newlines', u''.join(
+            line % i + (u'\r\n', u'\r', u'\x85', u'\u2028')[i % 4]
+            for i in range(lines))),
+    ]
+    with tempdir() as d:
+        f = d / 'text.txt'
+        for name, text in inputs:
+            f.write_bytes(text.encode('utf-8'))
+            size = '%s, %d MiB' % (name, f.size // 2 ** 20)
+            report('text (codecs, 5 replaces), %s' % size,
+                   lambda: legacy_text(f, 'utf-8'))
+            report('text, %s' % size, lambda: f.text('utf-8'))
+            report('write_text (5 replaces), %s' % size,
+                   lambda: legacy_write_text(f, text, 'utf-8'))
+            report('write_text, %s' % size,
+                   lambda: f.write_text(text, 'utf-8'))
+
+
+def legacy_write_lines(p, lines, encoding, linesep=os.linesep):
+    """ Path.write_lines() with Unicode lines, as of path.py 6.2. """
+    with p.open('wb') as f:
+        for line in lines:
+            if line[-2:] in (u'\r\n', u'\x0d\x85'):
+                line = line[:-2]
+            elif line[-1:] in (u'\r', u'\n', u'\x85', u'\u2028'):
+                line = line[:-1]
+            line += linesep
+            f.write(line.encode(encoding))
+
+
+def bench_write_lines(count=1000000):
+    lines = [u'line %d\n' % i for i in range(count)]
+    with tempdir() as d:
+        f = d / 'lines.txt'
+        for encoding in ('utf-8', 'utf-16'):
+            name = '%d lines, %s' % (count, encoding)
+            report('write_lines (per line), %s' % name,
+                   lambda: legacy_write_lines(f, lines, encoding))
+            report('write_lines, %s' % name,
+                   lambda: f.write_lines(lines, encoding))
+            report('write_lines from a generator, %s' % name,
+                   lambda: f.write_lines(iter(lines), encoding))
+
+
+def bench_stat_many():
+    with tempdir() as d:
+        build_tree(d, width=10, depth=2, files=1000)
+        files = list(d.walkfiles())
+        # a manifest with a missing entry for every file present
+        paths = files + [f + '.missing' for f in files]
+        report('exists() x %d' % len(paths),
+               lambda: [p.exists() for p in paths])
+        report('exists_many', lambda: Path.exists_many(paths))
+        report('stat() x %d' % len(files),
+               lambda: [(p.size, p.mtime) for p in files])
+        report('stat_many', lambda: Path.stat_many(files))
+
+
+def bench_du():
+    with tempdir() as d:
+        build_tree(d, width=10, depth=3, files=20)
+        report('sum(f.size for f in walkfiles())',
+               lambda: sum(f.size for f in d.walkfiles()))
+        report('du', lambda: d.du())
+        report('du(workers=8)', lambda: d.du(workers=8))
+        report('du(depth=1)', lambda: d.du(depth=1))
+
+
+def bench_index():
+    with tempdir() as d:
+        tree = build_tree((d / 'tree').mkdir(), width=10, depth=3, files=20)
+        old = time.time() - 60
+        for p in [tree] + list(tree.walkdirs()):
+            os.utime(p, (old, old))
+        index = tree.index(d / 'index.db')
+        report("walkfiles('*.txt')", lambda: list(tree.walkfiles('*.txt')))
+        report('index.refresh() (unchanged)', index.refresh)
+        report("index.files('*.txt')", lambda: index.files('*.txt'))
+        index.close()
+
+
+def bench_watch():
+    with tempdir() as d:
+        build_tree(d, width=10, depth=3, files=20)
+        report('mtime over walkfiles()',
+               lambda: [f.mtime for f in d.walkfiles()])
+        with d.watch(poll=True, interval=0) as watcher:
+            report('watch(poll=True).read(0), unchanged',
+                   lambda: watcher.read(0))
+        with d.watch() as watcher:
+            report('watch().read(0), unchanged', lambda: watcher.read(0))
+
+
+if __name__ == '__main__':
+    bench_walk()
+    bench_deep_walk()
+    bench_matching()
+    bench_hashing()
+    bench_copy()
+    bench_copytree()
+    bench_rmtree()
+    bench_text()
+    bench_write_lines()
+    bench_stat_many()
+    bench_du()
+    bench_index()
+    bench_watch()
@@ -36,17 +36,35 @@ Example::
 import sys
 import warnings
 import os
+import stat as stat_module
+import mmap as mmap_module
 import fnmatch
 import glob
 import shutil
 import codecs
 import hashlib
+import binascii
+import array
 import errno
 import tempfile
+import time
 import functools
+import itertools
 import operator
 import re
+import io
 import contextlib
+import inspect
+import threading
+import collections
+import heapq
+import select
+import struct
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import win32security
@@ -63,6 +81,40 @@ try:
 except ImportError:
     pass
 
+try:
+    import fcntl
+except ImportError:
+    pass
+
+try:
+    import sqlite3
+except ImportError:
+    pass
+
+try:
+    import numpy
+except ImportError:
+    pass
+
+try:
+    import ctypes
+except ImportError:
+    pass
+
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    pass
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        pass
+
 ##############################################################################
 # Python 2/3 support
 PY3 = sys.version_info >= (3,)
@@ -72,6 +124,9 @@ string_types = str,
 text_type = str
 getcwdu = os.getcwd
 u = lambda x: x
+# mode for reading text with universal newlines (the default on Python 3,
+# where the 'U' flag is gone)
+universal_newlines_mode = 'r'
 
 def surrogate_escape(error):
     """
@@ -90,31 +145,862 @@ if PY2:
     getcwdu = os.getcwdu
     u = lambda x: codecs.unicode_escape_decode(x)[0]
     codecs.register_error('surrogateescape', surrogate_escape)
+    universal_newlines_mode = 'U'
 ##############################################################################
 
 __version__ = '6.3'
-__all__ = ['Path', 'path', 'CaseInsensitivePattern']
+__all__ = [
+    'Path', 'path', 'CaseInsensitivePattern', 'Matcher', 'HashCache',
+    'COPY_STRATEGIES', 'SyncPlan', 'WriteBatch', 'DURABILITY', 'AsyncPath',
+    'StatColumns', 'Snapshot', 'DiskUsage', 'FileIndex', 'Watcher',
+    'WatchEvent',
+]
 
 
 class TreeWalkWarning(Warning):
     pass
 
 
+class _ErrorHandlers:
+    """
+    The named policies accepted by the `errors=` argument of
+    :meth:`Path.walk` and friends.
+    """
+    def strict(msg):
+        raise
+
+    def warn(msg):
+        warnings.warn(msg, TreeWalkWarning)
+
+    def ignore(msg):
+        pass
+
+
+def _resolve_errors(errors):
+    """
+    Return the callable for an `errors=` argument, which is either the
+    name of one of the :class:`_ErrorHandlers` or a callable taking a
+    msg parameter.
+    """
+    if callable(errors):
+        return errors
+    if errors not in ('strict', 'warn', 'ignore'):
+        raise ValueError("invalid errors parameter")
+    return vars(_ErrorHandlers)[errors]
+
+
+class _ListdirEntry(object):
+    """
+    A stand-in for :class:`os.DirEntry` used when :func:`os.scandir` is
+    not available. The first type query costs a ``stat()`` call; as with
+    :class:`os.DirEntry`, the result is cached on the entry.
+    """
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = self._lstat = None
+
+    def is_dir(self):
+        try:
+            return stat_module.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat_module.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat_module.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+
+class _WorkerPool(object):
+    """
+    A fixed set of daemon threads running tasks from a queue, used by
+    the methods that spread blocking filesystem calls across threads.
+
+    Results come back from :meth:`get` as ``(key, ok, value)`` tuples,
+    where `value` is the task's return value or, if `ok` is false, the
+    exception it raised. Callers bound the number of outstanding tasks
+    themselves, which also bounds the results waiting to be collected.
+    """
+    def __init__(self, workers):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            key, func, args = task
+            try:
+                result = key, True, func(*args)
+            except Exception:
+                result = key, False, sys.exc_info()[1]
+            self.results.put(result)
+
+    def submit(self, key, func, *args):
+        self.tasks.put((key, func, args))
+
+    def get(self):
+        return self.results.get()
+
+    def close(self):
+        """ Discard queued tasks and let the threads exit. """
+        try:
+            while True:
+                self.tasks.get_nowait()
+        except queue.Empty:
+            pass
+        for thread in self.threads:
+            self.tasks.put(None)
+
+
+def _imap_unordered(func, iterable, workers):
+    """
+    Call `func` on each item of `iterable` on a pool of `workers` threads,
+    yielding ``(item, ok, value)`` tuples as the calls complete, where
+    `value` is the return value or, if `ok` is false, the exception raised.
+
+    Items are drawn from `iterable` lazily, keeping at most ``4 * workers``
+    calls in flight. Without `workers`, the calls are made one at a time
+    in the calling thread.
+    """
+    if not workers:
+        for item in iterable:
+            try:
+                yield item, True, func(item)
+            except Exception:
+                yield item, False, sys.exc_info()[1]
+        return
+    pool = _WorkerPool(workers)
+    limit = 4 * workers
+    items = iter(iterable)
+    inflight = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and inflight < limit:
+                for item in items:
+                    pool.submit(item, func, item)
+                    inflight += 1
+                    break
+                else:
+                    exhausted = True
+            if not inflight:
+                return
+            result = pool.get()
+            inflight -= 1
+            yield result
+    finally:
+        pool.close()
+
+
+def _edge_hash(path, hash_name, block):
+    """
+    Hash the first and last `block` bytes of the file at `path`, which is
+    the whole file if it is no larger than ``2 * block``.
+    """
+    m = hashlib.new(hash_name)
+    with open(path, 'rb') as f:
+        m.update(f.read(block))
+        size = os.fstat(f.fileno()).st_size
+        if size > block:
+            f.seek(max(block, size - block))
+            m.update(f.read(block))
+    return m.digest()
+
+
+def _same_contents(a, b):
+    """ Whether the files at `a` and `b` hold the same bytes. """
+    with open(a, 'rb') as fa:
+        with open(b, 'rb') as fb:
+            if os.fstat(fa.fileno()).st_size != os.fstat(fb.fileno()).st_size:
+                return False
+            while True:
+                chunk = fa.read(2 ** 20)
+                if chunk != fb.read(2 ** 20):
+                    return False
+                if not chunk:
+                    return True
+
+
+def _scan_dir(dirpath):
+    """
+    List `dirpath` and classify its entries, for the parallel walk. Returns
+    ``(child, entry, isdir, exc)`` tuples, where `exc` is the error raised
+    when examining the entry, if any.
+    """
+    listing = []
+    for child, entry in dirpath._listentries():
+        try:
+            isdir = entry.is_dir()
+            # warm the entry's cache so the caller's checks are free
+            entry.is_file()
+            exc = None
+        except Exception:
+            isdir, exc = False, sys.exc_info()[1]
+        listing.append((child, entry, isdir, exc))
+    return listing
+
+
+def _du_scan(dirpath):
+    """
+    List `dirpath` and ``lstat()`` its entries, for :meth:`Path.du`.
+    Returns ``(child, st, exc)`` tuples, where `exc` is the error raised
+    by ``lstat()``, if any.
+    """
+    listing = []
+    for child, entry in dirpath._listentries():
+        try:
+            listing.append((child, entry.stat(follow_symlinks=False), None))
+        except Exception:
+            listing.append((child, None, sys.exc_info()[1]))
+    return listing
+
+
+def _mtime_ns(st):
+    """ The modification time of stat result `st`, in nanoseconds. """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10 ** 9)
+    return mtime_ns
+
+
+def _allocated(st):
+    """ The bytes allocated on disk to the file with stat result `st`. """
+    blocks = getattr(st, 'st_blocks', None)
+    if blocks is None:
+        return st.st_size
+    return blocks * 512
+
+
+class DiskUsage(
+        collections.namedtuple('DiskUsage', 'apparent allocated files')):
+    """
+    The space used by a tree, from :meth:`Path.du`: the total apparent
+    size of its entries, the bytes allocated to them on disk, and the
+    number of entries that are not directories.
+    """
+    __slots__ = ()
+
+
 def simple_cache(func):
     """
-    Save results for the :meth:'path.using_module' classmethod.
+    Save results for the :meth:'path.using_module' and
+    :meth:'path.using_stat_cache' classmethods, per class and argument.
     When Python 3.2 is available, use functools.lru_cache instead.
     """
     saved_results = {}
 
-    def wrapper(cls, module):
-        if module in saved_results:
-            return saved_results[module]
-        saved_results[module] = func(cls, module)
-        return saved_results[module]
+    def wrapper(cls, arg):
+        key = cls, arg
+        if key in saved_results:
+            return saved_results[key]
+        saved_results[key] = func(cls, arg)
+        return saved_results[key]
     return wrapper
 
 
+_clock = getattr(time, 'monotonic', time.time)
+
+_replace = getattr(os, 'replace', os.rename)
+
+# ioctl request asking the filesystem to share a file's extents with
+# another (a "reflink"), from <linux/fs.h>.
+FICLONE = 0x40049409
+
+
+def _reflink(src_fd, dst_fd):
+    """
+    Make the file open as `dst_fd` a copy-on-write clone of the one open
+    as `src_fd`. Raises :exc:`EnvironmentError` where the filesystem (or
+    platform) doesn't support it.
+    """
+    if 'fcntl' not in globals() or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported")
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+try:
+    _copystat_args = inspect.signature(shutil.copystat).parameters
+except AttributeError:
+    _copystat_args = ()
+
+try:
+    _rmtree_args = inspect.signature(shutil.rmtree).parameters
+except AttributeError:
+    _rmtree_args = ()
+
+COPY_STRATEGIES = ('reflink', 'copy_file_range', 'sendfile', 'buffered')
+""" The ways :meth:`Path.copy_data` can copy a file, cheapest first. """
+
+# errors meaning a copy strategy doesn't apply to these files
+_COPY_FALLBACK_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in ('EXDEV', 'EINVAL', 'ENOSYS', 'EOPNOTSUPP', 'ENOTSUP',
+                 'EBADF', 'ETXTBSY', 'ENOTTY', 'ENOTSOCK')
+    if hasattr(errno, name)
+)
+
+_COPY_CHUNK = 2 ** 23
+
+
+def _copy_fd(src_fd, dst_fd, size, strategies=COPY_STRATEGIES):
+    """
+    Copy the file open as `src_fd`, of `size` bytes, to the empty file
+    open as `dst_fd`, and return the name of the strategy that completed
+    the copy.
+
+    Strategies the platform lacks are skipped. If one fails with an error
+    showing it doesn't apply to these files, the next one carries on from
+    where it stopped.
+    """
+    offset = 0
+    for strategy in strategies:
+        try:
+            if strategy == 'reflink':
+                if offset or not size:
+                    continue
+                _reflink(src_fd, dst_fd)
+                return strategy
+            elif strategy == 'copy_file_range':
+                if not hasattr(os, 'copy_file_range'):
+                    continue
+                while True:
+                    n = os.copy_file_range(
+                        src_fd, dst_fd, _COPY_CHUNK, offset, offset)
+                    if not n:
+                        break
+                    offset += n
+            elif strategy == 'sendfile':
+                if not (hasattr(os, 'sendfile')
+                        and sys.platform.startswith('linux')):
+                    # other platforms only send to sockets
+                    continue
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                while True:
+                    n = os.sendfile(dst_fd, src_fd, offset, _COPY_CHUNK)
+                    if not n:
+                        break
+                    offset += n
+            elif strategy == 'buffered':
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                while True:
+                    buf = os.read(src_fd, 2 ** 20)
+                    if not buf:
+                        return strategy
+                    view = memoryview(buf)
+                    while view:
+                        view = view[os.write(dst_fd, view):]
+            else:
+                raise ValueError("unknown copy strategy %r" % strategy)
+        except EnvironmentError:
+            # ioctl() raises IOError on Python 2
+            if sys.exc_info()[1].errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+            continue
+        # Some special filesystems (such as procfs) report end-of-file
+        # early to the kernel copy calls, so check before trusting them.
+        if offset >= size:
+            return strategy
+    raise ValueError("no usable copy strategy in %r" % (strategies,))
+
+
+class SyncPlan(
+        collections.namedtuple('SyncPlan', 'created updated deleted')):
+    """
+    The changes :meth:`Path.sync_to` made, or would make: sorted lists of
+    the paths, relative to both trees, of the files and directories
+    created, the files updated and the extra entries deleted.
+    """
+    __slots__ = ()
+
+
+def _normalize_newlines(text):
+    r"""
+    Translate the newline sequences :meth:`Path.text` recognizes in the
+    Unicode string `text` to ``'\n'``.
+
+    Each sequence is only replaced if present, so text that already uses
+    ``'\n'`` alone is scanned, not copied. (``str.replace`` outruns a
+    single regular expression substitution on every input tried, since
+    the latter does Python-level work for every match.)
+    """
+    if u('\r') in text:
+        text = text.replace(u('\r\n'), u('\n'))
+        if u('\r') in text:
+            text = (text.replace(u('\r\x85'), u('\n'))
+                        .replace(u('\r'), u('\n')))
+    if u('\x85') in text:
+        text = text.replace(u('\x85'), u('\n'))
+    if u('\u2028') in text:
+        text = text.replace(u('\u2028'), u('\n'))
+    return text
+
+
+# line endings write_lines() replaces
+_LINE_END_CHARS = frozenset(u('\r\n\x85\u2028'))
+_LINE_END_PAIRS = frozenset([u('\r\n'), u('\r\x85')])
+
+# encodings whose output for a string is the concatenation of their
+# output for its parts: no byte order marks, shift states or the like
+_CONCATENABLE_ENCODINGS = frozenset([
+    'ascii', 'utf-8', 'iso8859-1', 'utf-16-le', 'utf-16-be', 'utf-32-le',
+    'utf-32-be',
+])
+
+# lines write_lines() takes at a time
+_WRITE_BATCH = 4096
+
+
+def _concatenable(encoding):
+    name = codecs.lookup(encoding).name
+    return (name in _CONCATENABLE_ENCODINGS
+            or name.startswith(('cp', 'iso8859-', 'mac-', 'koi8-')))
+
+
+def _write_encoded(f, texts, encoding, errors, batched):
+    """
+    Write the Unicode strings `texts` to `f`, encoding them each in turn
+    or, if `batched`, all together.
+    """
+    try:
+        if batched:
+            f.write(u('').join(texts).encode(encoding, errors))
+        else:
+            f.write(b''.join([text.encode(encoding, errors)
+                              for text in texts]))
+        return
+    except UnicodeError:
+        # write the lines before the one that fails, as they would be
+        # written one by one
+        pass
+    for text in texts:
+        f.write(text.encode(encoding, errors))
+
+
+def _write_mixed_lines(f, lines, encoding, errors, linesep):
+    """
+    Write `lines` of both Unicode and 8-bit strings, one by one, as
+    :meth:`Path.write_lines` does.
+    """
+    for line in lines:
+        isUnicode = isinstance(line, text_type)
+        if linesep is not None:
+            # Strip off any existing line-end and add the
+            # specified linesep string.
+            if isUnicode:
+                if line[-2:] in _LINE_END_PAIRS:
+                    line = line[:-2]
+                elif line[-1:] in _LINE_END_CHARS:
+                    line = line[:-1]
+                line += linesep
+            else:
+                if line[-2:] == b'\r\n':
+                    line = line[:-2]
+                elif line[-1:] in (b'\r', b'\n'):
+                    line = line[:-1]
+                if isinstance(linesep, text_type) and PY3:
+                    line += linesep.encode('ascii')
+                else:
+                    line += linesep
+        if isUnicode:
+            if encoding is None:
+                encoding = sys.getdefaultencoding()
+            line = line.encode(encoding, errors)
+        f.write(line)
+
+
+def _encode_text(text, encoding, errors, linesep):
+    """ Convert `text` to bytes as :meth:`Path.write_text` does. """
+    if isinstance(text, text_type):
+        if linesep is not None:
+            # Convert all standard end-of-line sequences to
+            # ordinary newline characters.
+            text = _normalize_newlines(text)
+            if linesep != u('\n'):
+                text = text.replace(u('\n'), linesep)
+        if encoding is None:
+            encoding = sys.getdefaultencoding()
+        data = text.encode(encoding, errors)
+    else:
+        # It is an error to specify an encoding if 'text' is
+        # an 8-bit string.
+        assert encoding is None
+
+        data = text
+        if linesep is not None:
+            if isinstance(linesep, text_type):
+                linesep = linesep.encode('ascii')
+            if b'\r' in data:
+                data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            if linesep != b'\n':
+                data = data.replace(b'\n', linesep)
+    return data
+
+
+try:
+    array.array('q')
+    _INT64, _UINT64 = 'q', 'Q'
+except ValueError:
+    _INT64, _UINT64 = 'l', 'L'
+
+
+class StatColumns(
+        collections.namedtuple('StatColumns', 'exists size mtime mode')):
+    """
+    Metadata of many paths from :meth:`Path.stat_many`, as :mod:`array`
+    columns in the order of the paths: whether each exists (``0`` or
+    ``1``), its size (``-1`` if missing), modification time (NaN if
+    missing) and ``st_mode`` (``0`` if missing).
+    """
+    __slots__ = ()
+
+# queried names in one directory from which listing it beats stat() calls
+_LISTING_THRESHOLD = 8
+
+# paths looked up per task by _bulk_stat()
+_STAT_BATCH = 256
+
+
+def _list_entries(dirpath):
+    """
+    Map the names in `dirpath` (the current directory if empty) to their
+    directory entries, or return ``None`` if they can't be listed but may
+    still exist.
+    """
+    try:
+        return dict((entry.name, entry)
+                    for entry in scandir(dirpath or os.curdir))
+    except OSError:
+        # A missing named directory has no entries, but the current one
+        # was never named: leave its names to be looked up one by one,
+        # exactly as Path.exists() would.
+        if dirpath and sys.exc_info()[1].errno in (errno.ENOENT,
+                                                   errno.ENOTDIR):
+            return {}
+        return None
+
+
+def _bulk_stat(paths, workers, need_stat, follow_symlinks=True):
+    """
+    Look up the list of `paths` on `workers` threads, listing any
+    directory holding several of them once instead of looking them up one
+    by one. Returns, in the order of `paths`, their stat results, or
+    ``None`` for those that don't exist, or (unless `need_stat`) ``True``
+    for those known to exist from a listing.
+    """
+    def entry_name(path):
+        """ The parent and name of `path`, if it names an entry of its
+        parent's listing (unlike ``d/``, ``d/.`` and ``d/..``).
+        """
+        parent, name = os.path.split(path)
+        if name and name not in (os.curdir, os.pardir):
+            return parent, name
+        return None, None
+
+    groups = {}
+    for i, path in enumerate(paths):
+        parent, name = entry_name(path)
+        if name is not None:
+            groups.setdefault(parent, []).append(i)
+    listings = {}
+    if 'scandir' in globals():
+        listed = [parent for parent, indexes in groups.items()
+                  if len(indexes) >= _LISTING_THRESHOLD]
+        for parent, ok, value in _imap_unordered(
+                _list_entries, listed, workers):
+            if ok and value is not None:
+                listings[parent] = value
+
+    def look_up(indexes):
+        found = []
+        for i in indexes:
+            parent, name = entry_name(paths[i])
+            listing = listings.get(parent) if name is not None else None
+            try:
+                if listing is None:
+                    if follow_symlinks:
+                        st = os.stat(paths[i])
+                    else:
+                        st = os.lstat(paths[i])
+                else:
+                    entry = listing.get(name)
+                    if entry is None:
+                        st = None
+                    elif not need_stat and not (
+                            follow_symlinks and entry.is_symlink()):
+                        st = True
+                    else:
+                        st = entry.stat(follow_symlinks=follow_symlinks)
+            except OSError:
+                st = None
+            found.append((i, st))
+        return found
+
+    results = [None] * len(paths)
+    batches = [range(start, min(start + _STAT_BATCH, len(paths)))
+               for start in range(0, len(paths), _STAT_BATCH)]
+    for indexes, ok, value in _imap_unordered(look_up, batches, workers):
+        if not ok:
+            raise value
+        for i, st in value:
+            results[i] = st
+    return results
+
+
+def _temp_sibling(path):
+    """
+    A name for a temporary file next to `path`, unlikely to be in use.
+    """
+    token = binascii.hexlify(os.urandom(4)).decode('ascii')
+    return path.parent / ('.%s.%s.tmp' % (path.name, token))
+
+
+DURABILITY = ('none', 'file', 'directory')
+""" How far writes can be made to survive a crash: not at all beyond
+what the system does anyway (``'none'``), by syncing the data of the
+file written (``'file'``), or by syncing the directory holding it as
+well (``'directory'``), so that its name survives too. """
+
+
+def _check_durability(durability):
+    if durability not in DURABILITY:
+        raise ValueError("durability must be one of %r" % (DURABILITY,))
+
+
+def _fsync(fd):
+    """ Flush a file to stable storage. """
+    if hasattr(globals().get('fcntl'), 'F_FULLFSYNC'):
+        # macOS only flushes the drive's write cache when asked this way
+        try:
+            fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
+            return
+        except EnvironmentError:
+            pass
+    os.fsync(fd)
+
+
+def _fsync_dir(dirname):
+    """ Flush a directory's entries to stable storage, where possible. """
+    if not hasattr(os, 'O_DIRECTORY'):
+        # Windows can't open directories, and doesn't need to
+        return
+    fd = os.open(dirname or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_temp(path, data, sync):
+    """
+    Write `data` to a new temporary file beside `path`, with the mode of
+    `path` if it exists, syncing it if `sync` is true. Returns the name
+    of the temporary file.
+    """
+    temp = _temp_sibling(path)
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL
+                 | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with io.open(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if sync:
+                _fsync(f.fileno())
+        try:
+            shutil.copymode(path, temp)
+        except EnvironmentError:
+            if sys.exc_info()[1].errno != errno.ENOENT:
+                raise
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+    return temp
+
+
+# whether rmtree can work relative to directory descriptors
+_RMTREE_FD = (
+    all(func in getattr(os, 'supports_dir_fd', ())
+        for func in (os.open, os.rmdir, os.unlink))
+    and getattr(os, 'scandir', None) in getattr(os, 'supports_fd', ())
+    and hasattr(os, 'O_DIRECTORY') and hasattr(os, 'O_NOFOLLOW')
+)
+
+
+def _rmtree_scan(node):
+    """
+    Open the directory for an rmtree `node` (unless it is open already),
+    unlink everything in it but its subdirectories, and return the
+    directory's descriptor (or ``None``), its subdirectories as
+    ``(name, path, lstat)`` tuples, and the errors met, as ``(function,
+    path, exc_info)`` tuples for the ``onerror`` callback.
+    """
+    parent, name, path, orig, fd = node[:5]
+    errors = []
+    if fd is None:
+        try:
+            fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                         dir_fd=parent[4])
+        except Exception:
+            return None, (), [(os.open, path, sys.exc_info())]
+        if not os.path.samestat(orig, os.fstat(fd)):
+            # replaced since it was listed
+            os.close(fd)
+            try:
+                raise OSError("Cannot call rmtree on a symbolic link")
+            except OSError:
+                return None, (), [(os.path.islink, path, sys.exc_info())]
+    try:
+        entries = list(os.scandir(fd))
+    except Exception:
+        return fd, (), [(os.scandir, path, sys.exc_info())]
+    subdirs = []
+    for entry in entries:
+        child = os.path.join(path, entry.name)
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            is_dir = False
+        if is_dir:
+            try:
+                subdirs.append(
+                    (entry.name, child, entry.stat(follow_symlinks=False)))
+            except Exception:
+                errors.append((os.lstat, child, sys.exc_info()))
+            continue
+        try:
+            os.unlink(entry.name, dir_fd=fd)
+        except Exception:
+            errors.append((os.unlink, child, sys.exc_info()))
+    return fd, subdirs, errors
+
+
+def _rmtree_fd(top, onerror, workers=None):
+    """
+    Remove the directory tree at `top` with calls relative to directory
+    descriptors, so no path is resolved more than once and a directory
+    swapped for a symbolic link mid-way is detected rather than followed.
+    With `workers`, sibling directories are emptied on that many threads.
+
+    Each directory is a ``[parent, name, path, lstat, fd, pending]``
+    node, `pending` counting its subdirectories not yet removed. Nodes
+    are scanned depth first, and a directory is removed, and its
+    descriptor closed, once its last subdirectory is gone.
+    """
+    try:
+        orig = os.lstat(top)
+    except Exception:
+        onerror(os.lstat, top, sys.exc_info())
+        return
+    try:
+        fd = os.open(top, os.O_RDONLY | os.O_DIRECTORY)
+    except Exception:
+        onerror(os.open, top, sys.exc_info())
+        return
+    if not os.path.samestat(orig, os.fstat(fd)):
+        os.close(fd)
+        try:
+            raise OSError("Cannot call rmtree on a symbolic link")
+        except OSError:
+            onerror(os.path.islink, top, sys.exc_info())
+        return
+
+    root = [None, top, top, orig, fd, 0]
+    opened = [root]
+    stack = [root]
+    pool = _WorkerPool(workers) if workers else None
+    inflight = 0
+
+    def done(node):
+        # remove `node`, and any parents it was the last child of
+        while node is not None:
+            parent = node[0]
+            if node[4] is not None:
+                os.close(node[4])
+                node[4] = None
+                try:
+                    if parent is None:
+                        os.rmdir(node[2])
+                    else:
+                        os.rmdir(node[1], dir_fd=parent[4])
+                except Exception:
+                    onerror(os.rmdir, node[2], sys.exc_info())
+            if parent is None:
+                return
+            parent[5] -= 1
+            if parent[5]:
+                return
+            node = parent
+
+    try:
+        while stack or inflight:
+            if pool is None:
+                node = stack.pop()
+                result = _rmtree_scan(node)
+            else:
+                while stack and inflight < 2 * workers:
+                    node = stack.pop()
+                    pool.submit(node, _rmtree_scan, node)
+                    inflight += 1
+                node, ok, result = pool.get()
+                inflight -= 1
+                if not ok:
+                    raise result
+            node[4], subdirs, errors = result
+            if node[4] is not None:
+                opened.append(node)
+            for func, path, exc_info in errors:
+                onerror(func, path, exc_info)
+            node[5] = len(subdirs)
+            for name, path, st in subdirs:
+                stack.append([node, name, path, st, None, 0])
+            if not subdirs:
+                done(node)
+    finally:
+        if pool is not None:
+            # wait for running scans before closing the descriptors
+            # they work relative to
+            while inflight:
+                node, ok, result = pool.get()
+                inflight -= 1
+                if ok and result[0] is not None:
+                    os.close(result[0])
+            pool.close()
+        for node in opened:
+            if node[4] is not None:
+                os.close(node[4])
+                node[4] = None
+
+
 class ClassProperty(property):
     def __get__(self, cls, owner):
         return self.fget.__get__(None, owner)()
@@ -157,6 +1043,19 @@ class Path(text_type):
     .. seealso:: :mod:`os.path`
     """
 
+    cache_stat = False
+    """ Whether instances cache the results of :meth:`stat` and the
+    metadata queries built on it.
+
+    .. seealso:: :meth:`using_stat_cache`
+    """
+
+    stat_ttl = None
+    """ How many seconds cached metadata stays valid, or ``None`` to keep
+    it until :meth:`refresh` is called. Only used when :attr:`cache_stat`
+    is set.
+    """
+
     def __init__(self, other=''):
         if other is None:
             raise TypeError("Invalid initial value for path: None")
@@ -169,6 +1068,84 @@ class Path(text_type):
         ns = {'module': module}
         return type(subclass_name, bases, ns)
 
+    @classmethod
+    def using_stat_cache(cls, ttl=None):
+        """ Return a subclass whose instances cache their metadata.
+
+        Instances of the returned class keep the result of :meth:`stat`
+        (and :meth:`lstat`) for `ttl` seconds, or until :meth:`refresh`
+        is called if `ttl` is ``None``, and answer :meth:`exists`,
+        :meth:`isdir`, :meth:`isfile`, :meth:`islink`, :attr:`size`,
+        :attr:`mtime`, :attr:`atime`, :attr:`ctime` and :attr:`owner`
+        from it. Failed lookups are cached too.
+
+        Paths produced by :meth:`listdir`, :meth:`dirs`, :meth:`files`
+        and the ``walk`` methods also carry the directory entry they were
+        listed from, so type queries are usually answered without any
+        ``stat()`` call at all. For example::
+
+            CachedPath = Path.using_stat_cache(ttl=60)
+            for f in CachedPath('/srv/data').walkfiles():
+                if f.size > 2**20 and f.mtime < cutoff:  # one stat()
+                    ...
+
+        Changes made to the file, even through this object, are not
+        noticed until the cache expires or :meth:`refresh` is called.
+        """
+        return cls._using_stat_cache(ttl)
+
+    @classmethod
+    @simple_cache
+    def _using_stat_cache(cls, ttl):
+        subclass_name = '%s_cached' % cls.__name__
+        ns = {'cache_stat': True, 'stat_ttl': ttl}
+        return type(subclass_name, (cls,), ns)
+
+    def __getstate__(self):
+        # cached metadata may hold directory entries, which can't be pickled
+        state = self.__dict__.copy()
+        state.pop('_metadata', None)
+        return state
+
+    def refresh(self):
+        """ Discard any cached metadata for this path.
+
+        .. seealso:: :meth:`using_stat_cache`
+        """
+        self.__dict__.pop('_metadata', None)
+        return self
+
+    def _cached(self, name, fetch):
+        """ Return the cached metadata `name`, first calling `fetch` to
+        get it if it is missing or older than :attr:`stat_ttl`. An
+        :exc:`OSError` raised by `fetch` is cached and raised again.
+        """
+        metadata = self.__dict__.setdefault('_metadata', {})
+        now = _clock()
+        if name in metadata:
+            value, stamp = metadata[name]
+            if self.stat_ttl is None or now - stamp < self.stat_ttl:
+                if isinstance(value, OSError):
+                    raise value
+                return value
+        try:
+            value = fetch()
+        except OSError:
+            value = sys.exc_info()[1]
+        metadata[name] = value, now
+        if isinstance(value, OSError):
+            raise value
+        return value
+
+    def _entry(self):
+        """ The directory entry this path was listed from, if it is still
+        fresh, else ``None``.
+        """
+        try:
+            return self._cached('entry', lambda: None)
+        except OSError:
+            return None
+
     @ClassProperty
     @classmethod
     def _next_class(cls):
@@ -478,15 +1455,46 @@ class Path(text_type):
 
         .. seealso:: :meth:`files`, :meth:`dirs`
         """
-        if pattern is None:
-            pattern = '*'
+        if self.cache_stat:
+            return [child for child, entry in self._listentries(pattern)]
+        match = self._name_matcher(pattern)
         return [
             self / child
             for child in map(self._always_unicode, os.listdir(self))
-            if self._next_class(child).fnmatch(pattern)
+            if match is None or match(child)
         ]
 
-    def dirs(self, pattern=None):
+    def _listentries(self, pattern=None):
+        """ D._listentries() -> List of ``(path, entry)`` pairs.
+
+        Like :meth:`listdir`, but each child Path is paired with its
+        directory entry. Where :func:`os.scandir` is available, the
+        entry answers ``is_dir()`` and ``is_file()`` from the file type
+        reported by the directory listing, only calling ``stat()`` when
+        the type is unknown (or the entry is a symbolic link).
+        """
+        if 'scandir' in globals():
+            it = scandir(self)
+            try:
+                entries = list(it)
+            finally:
+                if hasattr(it, 'close'):
+                    it.close()
+        else:
+            entries = [_ListdirEntry(self, name) for name in os.listdir(self)]
+        match = self._name_matcher(pattern)
+        now = _clock()
+        pairs = []
+        for entry in entries:
+            name = self._always_unicode(entry.name)
+            if match is None or match(name):
+                child = self / name
+                if self.cache_stat:
+                    child._metadata = {'entry': (entry, now)}
+                pairs.append((child, entry))
+        return pairs
+
+    def dirs(self, pattern=None):
         """ D.dirs() -> List of this directory's subdirectories.
 
         The elements of the list are Path objects.
@@ -497,7 +1505,7 @@ class Path(text_type):
         directories whose names match the given pattern.  For
         example, ``d.dirs('build-*')``.
         """
-        return [p for p in self.listdir(pattern) if p.isdir()]
+        return [p for p, entry in self._listentries(pattern) if entry.is_dir()]
 
     def files(self, pattern=None):
         """ D.files() -> List of the files in this directory.
@@ -510,9 +1518,192 @@ class Path(text_type):
         ``d.files('*.pyc')``.
         """
 
-        return [p for p in self.listdir(pattern) if p.isfile()]
+        return [p for p, entry in self._listentries(pattern)
+                if entry.is_file()]
+
+    def _walk(self, errors, workers=None, ordered=False, max_depth=None,
+              breadth_first=False, prune=None):
+        """ D._walk(errors) -> iterator over ``(path, entry)`` pairs.
+
+        The traversal core shared by :meth:`walk`, :meth:`walkdirs` and
+        :meth:`walkfiles`. Directories waiting to be listed are kept in an
+        explicit queue instead of in nested generators, so each entry is
+        yielded once, at a constant cost however deep the tree is, and
+        the recursion limit never comes into play. Taking the newest
+        directory from the queue gives a depth-first traversal; taking
+        the oldest, with `breadth_first`, gives a breadth-first one.
+        Either way, each directory is yielded before its children.
+
+        `errors` is a callable as returned by :func:`_resolve_errors`; it
+        is called with a message from within the ``except`` block when a
+        directory can't be listed or an entry can't be examined.
+
+        With `workers`, directories are listed on that many threads; see
+        :meth:`_walk_parallel`. See :meth:`walk` for `max_depth` and
+        `prune`.
+        """
+        if max_depth is not None and max_depth < 1:
+            return
+        if workers:
+            walker = self._walk_parallel(
+                errors, workers, ordered, max_depth, breadth_first, prune)
+            for item in walker:
+                yield item
+            return
+
+        def listing(dirpath):
+            try:
+                return iter(dirpath._listentries())
+            except Exception:
+                exc = sys.exc_info()[1]
+                errors("Unable to list directory '%s': %s" % (dirpath, exc))
+                return iter(())
+
+        # each item is [dirpath, depth, iterator over its listing or None]
+        pending = collections.deque([[self, 0, None]])
+        while pending:
+            current = pending[0] if breadth_first else pending[-1]
+            dirpath, depth, children = current
+            if children is None:
+                children = current[2] = listing(dirpath)
+            item = next(children, None)
+            if item is None:
+                if breadth_first:
+                    pending.popleft()
+                else:
+                    pending.pop()
+                continue
+            child, entry = item
+            try:
+                isdir = entry.is_dir()
+            except Exception:
+                exc = sys.exc_info()[1]
+                errors("Unable to access '%s': %s" % (child, exc))
+                isdir = False
+            if isdir and prune is not None and prune(child):
+                continue
+            yield item
+            if isdir and (max_depth is None or depth + 1 < max_depth):
+                pending.append([child, depth + 1, None])
+
+    def _walk_parallel(self, errors, workers, ordered, max_depth,
+                       breadth_first, prune):
+        """ Like :meth:`_walk`, but list directories on a pool of `workers`
+        threads, which keeps many requests in flight on high-latency
+        filesystems such as NFS.
+
+        At most ``4 * workers`` listings are requested ahead of the
+        consumer, so a slow consumer holds back the workers rather than
+        letting results pile up. Errors are still reported through
+        `errors`, and `prune` is called, in the consuming thread.
+
+        Unless `ordered`, entries are yielded as listings complete (with
+        `breadth_first` only deciding which directories are requested
+        first). With `ordered`, the output is the same as that of the
+        serial walk: listings are prefetched in the order the traversal
+        will need them.
+        """
+        def report(exc, msg):
+            try:
+                raise exc
+            except Exception:
+                errors(msg)
+
+        def descends(child, isdir, depth):
+            """ Whether to list `child`; ``None`` if it is pruned. """
+            if not isdir:
+                return False
+            if prune is not None and prune(child):
+                return None
+            return max_depth is None or depth + 1 < max_depth
+
+        pool = _WorkerPool(workers)
+        limit = 4 * workers
+        try:
+            if not ordered:
+                pending = collections.deque([(self, 0)])
+                inflight = {}
+                while pending or inflight:
+                    while pending and len(inflight) < limit:
+                        if breadth_first:
+                            dirpath, depth = pending.popleft()
+                        else:
+                            dirpath, depth = pending.pop()
+                        pool.submit(dirpath, _scan_dir, dirpath)
+                        inflight[dirpath] = depth
+                    dirpath, ok, listing = pool.get()
+                    depth = inflight.pop(dirpath)
+                    if not ok:
+                        report(listing, "Unable to list directory '%s': %s"
+                               % (dirpath, listing))
+                        continue
+                    for child, entry, isdir, exc in listing:
+                        if exc is not None:
+                            report(exc, "Unable to access '%s': %s"
+                                   % (child, exc))
+                        descend = descends(child, isdir, depth)
+                        if descend is None:
+                            continue
+                        yield child, entry
+                        if descend:
+                            pending.append((child, depth + 1))
+                return
+
+            # The directory the traversal needs next is always either in
+            # flight or next in line in the prefetch queue.
+            prefetch = collections.deque([self])
+            inflight = set()
+            results = {}
+            pending = collections.deque([[self, 0, None]])
+            while pending:
+                current = pending[0] if breadth_first else pending[-1]
+                dirpath, depth, children = current
+                if children is None:
+                    while prefetch and (
+                            len(inflight) < limit or dirpath not in inflight):
+                        if breadth_first:
+                            queued = prefetch.popleft()
+                        else:
+                            queued = prefetch.pop()
+                        pool.submit(queued, _scan_dir, queued)
+                        inflight.add(queued)
+                    while dirpath not in results:
+                        queued, ok, listing = pool.get()
+                        results[queued] = ok, listing
+                    inflight.remove(dirpath)
+                    ok, listing = results.pop(dirpath)
+                    if not ok:
+                        report(listing, "Unable to list directory '%s': %s"
+                               % (dirpath, listing))
+                        listing = []
+                    decided = []
+                    for child, entry, isdir, exc in listing:
+                        descend = descends(child, isdir, depth)
+                        if descend is not None:
+                            decided.append((child, entry, exc, descend))
+                    subdirs = [item[0] for item in decided if item[3]]
+                    if not breadth_first:
+                        subdirs.reverse()
+                    prefetch.extend(subdirs)
+                    children = current[2] = iter(decided)
+                item = next(children, None)
+                if item is None:
+                    if breadth_first:
+                        pending.popleft()
+                    else:
+                        pending.pop()
+                    continue
+                child, entry, exc, descend = item
+                if exc is not None:
+                    report(exc, "Unable to access '%s': %s" % (child, exc))
+                yield child, entry
+                if descend:
+                    pending.append([child, depth + 1, None])
+        finally:
+            pool.close()
 
-    def walk(self, pattern=None, errors='strict'):
+    def walk(self, pattern=None, errors='strict', workers=None,
+             ordered=False, max_depth=None, breadth_first=False, prune=None):
         """ D.walk() -> iterator over files and subdirs, recursively.
 
         The iterator yields Path objects naming each child item of
@@ -527,47 +1718,39 @@ class Path(text_type):
         exception.  Other allowed values are ``'warn'`` (which
         reports the error via :func:`warnings.warn()`), and ``'ignore'``.
         `errors` may also be an arbitrary callable taking a msg parameter.
-        """
-        class Handlers:
-            def strict(msg):
-                raise
 
-            def warn(msg):
-                warnings.warn(msg, TreeWalkWarning)
+        With `workers`, directories are listed in parallel on that many
+        threads and items are yielded as soon as their directory has been
+        listed, so the order is no longer depth-first (each directory is
+        still yielded before its children). Pass ``ordered=True`` to get
+        the same order as the serial walk while still listing ahead on
+        the worker threads.
 
-            def ignore(msg):
-                pass
+        `pattern` only filters what is yielded. To limit what is
+        traversed:
 
-        if not callable(errors) and errors not in vars(Handlers):
-            raise ValueError("invalid errors parameter")
-        errors = vars(Handlers).get(errors, errors)
+        `max_depth` - Only descend this many levels; ``max_depth=1``
+            yields the same items as :meth:`listdir`.
 
-        try:
-            childList = self.listdir()
-        except Exception:
-            exc = sys.exc_info()[1]
-            tmpl = "Unable to list directory '%(self)s': %(exc)s"
-            msg = tmpl % locals()
-            errors(msg)
-            return
+        `breadth_first` - Yield all the items at one depth before any
+            at the next.
 
-        for child in childList:
-            if pattern is None or child.fnmatch(pattern):
+        `prune` - A callable taking a directory's Path and returning
+            ``True`` to skip that directory: it is neither yielded nor
+            listed. For example,
+            ``d.walk(prune=lambda d: d.name in ('.git', 'node_modules'))``.
+        """
+        errors = _resolve_errors(errors)
+        match = self._name_matcher(pattern)
+        walker = self._walk(
+            errors, workers, ordered, max_depth, breadth_first, prune)
+        for child, entry in walker:
+            if match is None or match(child.name):
                 yield child
-            try:
-                isdir = child.isdir()
-            except Exception:
-                exc = sys.exc_info()[1]
-                tmpl = "Unable to access '%(child)s': %(exc)s"
-                msg = tmpl % locals()
-                errors(msg)
-                isdir = False
-
-            if isdir:
-                for item in child.walk(pattern, errors):
-                    yield item
 
-    def walkdirs(self, pattern=None, errors='strict'):
+    def walkdirs(self, pattern=None, errors='strict', workers=None,
+                 ordered=False, max_depth=None, breadth_first=False,
+                 prune=None):
         """ D.walkdirs() -> iterator over subdirs, recursively.
 
         With the optional `pattern` argument, this yields only
@@ -579,77 +1762,65 @@ class Path(text_type):
         error occurs.  The default is ``'strict'``, which causes an
         exception.  The other allowed values are ``'warn'`` (which
         reports the error via :func:`warnings.warn()`), and ``'ignore'``.
-        """
-        if errors not in ('strict', 'warn', 'ignore'):
-            raise ValueError("invalid errors parameter")
-
-        try:
-            dirs = self.dirs()
-        except Exception:
-            if errors == 'ignore':
-                return
-            elif errors == 'warn':
-                warnings.warn(
-                    "Unable to list directory '%s': %s"
-                    % (self, sys.exc_info()[1]),
-                    TreeWalkWarning)
-                return
-            else:
-                raise
+        `errors` may also be an arbitrary callable taking a msg parameter.
 
-        for child in dirs:
-            if pattern is None or child.fnmatch(pattern):
+        `workers`, `ordered`, `max_depth`, `breadth_first` and `prune`
+        behave as for :meth:`walk`.
+        """
+        errors = _resolve_errors(errors)
+        match = self._name_matcher(pattern)
+        walker = self._walk(
+            errors, workers, ordered, max_depth, breadth_first, prune)
+        for child, entry in walker:
+            try:
+                isdir = entry.is_dir()
+            except Exception:
+                # already reported by _walk
+                continue
+            if isdir and (match is None or match(child.name)):
                 yield child
-            for subsubdir in child.walkdirs(pattern, errors):
-                yield subsubdir
 
-    def walkfiles(self, pattern=None, errors='strict'):
+    def walkfiles(self, pattern=None, errors='strict', workers=None,
+                  ordered=False, max_depth=None, breadth_first=False,
+                  prune=None):
         """ D.walkfiles() -> iterator over files in D, recursively.
 
         The optional argument `pattern` limits the results to files
         with names that match the pattern.  For example,
         ``mydir.walkfiles('*.tmp')`` yields only files with the ``.tmp``
         extension.
-        """
-        if errors not in ('strict', 'warn', 'ignore'):
-            raise ValueError("invalid errors parameter")
 
-        try:
-            childList = self.listdir()
-        except Exception:
-            if errors == 'ignore':
-                return
-            elif errors == 'warn':
-                warnings.warn(
-                    "Unable to list directory '%s': %s"
-                    % (self, sys.exc_info()[1]),
-                    TreeWalkWarning)
-                return
-            else:
-                raise
+        The `errors=` keyword argument behaves as for :meth:`walk`.
 
-        for child in childList:
+        On network filesystems, where each listing costs a round trip,
+        ``mydir.walkfiles(workers=16)`` lists up to 16 directories at once
+        and yields files as their directories come back. See :meth:`walk`
+        for `workers`, `ordered`, `max_depth`, `breadth_first` and
+        `prune`.
+        """
+        errors = _resolve_errors(errors)
+        match = self._name_matcher(pattern)
+        walker = self._walk(
+            errors, workers, ordered, max_depth, breadth_first, prune)
+        for child, entry in walker:
             try:
-                isfile = child.isfile()
-                isdir = not isfile and child.isdir()
-            except:
-                if errors == 'ignore':
-                    continue
-                elif errors == 'warn':
-                    warnings.warn(
-                        "Unable to access '%s': %s"
-                        % (self, sys.exc_info()[1]),
-                        TreeWalkWarning)
-                    continue
-                else:
-                    raise
+                isfile = entry.is_file()
+            except Exception:
+                # already reported by _walk
+                continue
+            if isfile and (match is None or match(child.name)):
+                yield child
 
-            if isfile:
-                if pattern is None or child.fnmatch(pattern):
-                    yield child
-            elif isdir:
-                for f in child.walkfiles(pattern, errors):
-                    yield f
+    def _name_matcher(self, pattern):
+        """ Return a function testing whether a name matches `pattern`,
+        or ``None`` if there is no pattern.
+
+        The pattern is compiled once, so a listing or a walk doesn't pay
+        for normalizing and translating it for every name.
+        """
+        if pattern is None:
+            return None
+        return Matcher.coerce(pattern).compile(self.module.normcase)
 
     def fnmatch(self, pattern, normcase=None):
         """ Return ``True`` if `self.name` matches the given `pattern`.
@@ -657,6 +1828,7 @@ class Path(text_type):
         `pattern` - A filename pattern with wildcards,
             for example ``'*.py'``. If the pattern contains a `normcase`
             attribute, it is applied to the name and path prior to comparison.
+            `pattern` may also be a :class:`Matcher`.
 
         `normcase` - (optional) A function used to normalize the pattern and
             filename before matching. Defaults to :meth:`self.module`, which defaults
@@ -664,6 +1836,8 @@ class Path(text_type):
 
         .. seealso:: :func:`fnmatch.fnmatch`
         """
+        if isinstance(pattern, Matcher):
+            return pattern.matches(self.name, normcase or self.module.normcase)
         default_normcase = getattr(pattern, 'normcase', self.module.normcase)
         normcase = normcase or default_normcase
         name = normcase(self.name)
@@ -698,6 +1872,48 @@ class Path(text_type):
         with self.open('rb') as f:
             return f.read()
 
+    @contextlib.contextmanager
+    def mmap(self):
+        """ Map this file into memory, read-only, for the duration of a
+        ``with`` block::
+
+            with Path('huge.log').mmap() as data:
+                offset = data.find(b'ERROR')
+
+        Yields an :class:`mmap.mmap`, which can be sliced and searched
+        like :class:`bytes` without reading the whole file into memory,
+        or an empty bytes object if the file is empty (including special
+        files, such as those in ``/proc``, that report a size of zero).
+        The mapping is closed on leaving the block. Changes made to the
+        file meanwhile may show through it, and truncating it may crash
+        the process when the missing pages are touched.
+        """
+        with self.open('rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                # zero-length mappings aren't allowed
+                yield b''
+                return
+            mapped = mmap_module.mmap(
+                f.fileno(), 0, access=mmap_module.ACCESS_READ)
+            try:
+                yield mapped
+            finally:
+                mapped.close()
+
+    @contextlib.contextmanager
+    def memoryview(self):
+        """ Like :meth:`mmap`, but yields a :class:`memoryview` of the
+        mapping, whose slices don't copy any data. Views derived from it
+        must not outlive the ``with`` block.
+        """
+        with self.mmap() as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                if hasattr(view, 'release'):
+                    view.release()
+
     def chunks(self, size, *args, **kwargs):
         """ Returns a generator yielding chunks of the file, so it can
             be read piece by piece with a simple for loop.
@@ -719,24 +1935,50 @@ class Path(text_type):
                     break
                 yield d
 
-    def write_bytes(self, bytes, append=False):
+    def write_bytes(self, bytes, append=False, atomic=False,
+                    durability='none'):
         """ Open this file and write the given bytes to it.
 
         Default behavior is to overwrite any existing file.
         Call ``p.write_bytes(bytes, append=True)`` to append instead.
+
+        With ``atomic=True``, the bytes are written to a temporary file in
+        the same directory, which is then renamed over this one, so that
+        readers see either the old contents or the new, never a partial
+        write. The new file gets the old one's permissions; if this path
+        is a symbolic link, the file it points to is replaced.
+
+        `durability` is one of :data:`DURABILITY`: whether to sync the
+        file (``'file'``), or the file and its directory
+        (``'directory'``), to stable storage before returning. To write
+        many files durably, see :class:`WriteBatch`.
         """
-        if append:
-            mode = 'ab'
+        _check_durability(durability)
+        if atomic:
+            if append:
+                raise ValueError("can't append atomically")
+            target = self.realpath()
+            _replace(_write_temp(target, bytes, durability != 'none'),
+                     target)
         else:
-            mode = 'wb'
-        with self.open(mode) as f:
-            f.write(bytes)
+            if append:
+                mode = 'ab'
+            else:
+                mode = 'wb'
+            with self.open(mode) as f:
+                f.write(bytes)
+                if durability != 'none':
+                    f.flush()
+                    _fsync(f.fileno())
+            target = self
+        if durability == 'directory':
+            _fsync_dir(target.parent)
 
     def text(self, encoding=None, errors='strict'):
         r""" Open this file, read it in, return the content as a string.
 
-        This method uses ``'U'`` mode, so ``'\r\n'`` and ``'\r'`` are
-        automatically translated to ``'\n'``.
+        This method uses universal newlines mode, so ``'\r\n'`` and
+        ``'\r'`` are automatically translated to ``'\n'``.
 
         Optional arguments:
             `encoding` - The Unicode encoding (or character set) of
@@ -750,22 +1992,20 @@ class Path(text_type):
         """
         if encoding is None:
             # 8-bit
-            with self.open('U') as f:
+            with self.open(universal_newlines_mode) as f:
                 return f.read()
         else:
             # Unicode
-            with codecs.open(self, 'r', encoding, errors) as f:
-                # (Note - Can't use 'U' mode here, since codecs.open
-                # doesn't support 'U' mode.)
+            # decode without translating newlines; we translate more
+            # sequences than universal newlines mode does
+            with io.open(self, 'r', encoding=encoding, errors=errors,
+                         newline='') as f:
                 t = f.read()
-            return (t.replace(u('\r\n'), u('\n'))
-                     .replace(u('\r\x85'), u('\n'))
-                     .replace(u('\r'), u('\n'))
-                     .replace(u('\x85'), u('\n'))
-                     .replace(u('\u2028'), u('\n')))
+            return _normalize_newlines(t)
 
     def write_text(self, text, encoding=None, errors='strict',
-                   linesep=os.linesep, append=False):
+                   linesep=os.linesep, append=False, atomic=False,
+                   durability='none'):
         r""" Write the given text to this file.
 
         The default behavior is to overwrite any existing file;
@@ -828,31 +2068,10 @@ class Path(text_type):
         isn't specified).  The `errors` argument applies only to this
         conversion.
 
+        `atomic` and `durability` are as for :meth:`write_bytes`.
         """
-        if isinstance(text, text_type):
-            if linesep is not None:
-                # Convert all standard end-of-line sequences to
-                # ordinary newline characters.
-                text = (text.replace(u('\r\n'), u('\n'))
-                            .replace(u('\r\x85'), u('\n'))
-                            .replace(u('\r'), u('\n'))
-                            .replace(u('\x85'), u('\n'))
-                            .replace(u('\u2028'), u('\n')))
-                text = text.replace(u('\n'), linesep)
-            if encoding is None:
-                encoding = sys.getdefaultencoding()
-            bytes = text.encode(encoding, errors)
-        else:
-            # It is an error to specify an encoding if 'text' is
-            # an 8-bit string.
-            assert encoding is None
-
-            if linesep is not None:
-                text = (text.replace('\r\n', '\n')
-                            .replace('\r', '\n'))
-                bytes = text.replace('\n', linesep)
-
-        self.write_bytes(bytes, append)
+        data = _encode_text(text, encoding, errors, linesep)
+        self.write_bytes(data, append, atomic, durability)
 
     def lines(self, encoding=None, errors='strict', retain=True):
         r""" Open this file, read all lines, return them in a list.
@@ -869,15 +2088,66 @@ class Path(text_type):
                 translated to ``'\n'``.  If ``False``, newline characters are
                 stripped off.  Default is ``True``.
 
-        This uses ``'U'`` mode.
+        This uses universal newlines mode.
 
-        .. seealso:: :meth:`text`
+        .. seealso:: :meth:`text`, :meth:`iterlines`
         """
         if encoding is None and retain:
-            with self.open('U') as f:
+            with self.open(universal_newlines_mode) as f:
                 return f.readlines()
         else:
-            return self.text(encoding, errors).splitlines(retain)
+            return list(self.iterlines(encoding, errors, retain))
+
+    def iterlines(self, encoding=None, errors='strict', retain=True,
+                  chunk_size=2 ** 16):
+        r""" Iterate over the lines of this file, reading and decoding it
+        `chunk_size` bytes at a time.
+
+        This yields the same lines as :meth:`lines` does with the same
+        arguments, without reading the whole file into memory first.
+
+        .. seealso:: :meth:`lines`
+        """
+        if encoding is None:
+            with self.open(universal_newlines_mode) as f:
+                for line in f:
+                    if retain:
+                        yield line
+                    else:
+                        # lines() splits at every line boundary of the text
+                        for part in line.splitlines():
+                            yield part
+            return
+
+        decoder = codecs.getincrementaldecoder(encoding)(errors)
+        # the start of a line still being read, in pieces, and a carriage
+        # return that a line feed in the next chunk may belong to
+        pending = []
+        cr = u('')
+        with self.open('rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                data = cr + decoder.decode(chunk, not chunk)
+                cr = u('')
+                if chunk and data.endswith(u('\r')):
+                    cr = data[-1:]
+                    data = data[:-1]
+                lines = _normalize_newlines(data).splitlines(True)
+                tail = None
+                if chunk and lines and lines[-1].splitlines()[0] == lines[-1]:
+                    # no line boundary at the end yet
+                    tail = lines.pop()
+                if pending and (lines or not chunk):
+                    # the pending line ends here; only now join its pieces
+                    pending.extend(lines[:1])
+                    lines[:1] = [u('').join(pending)]
+                    pending = []
+                if tail is not None:
+                    pending.append(tail)
+                for line in lines:
+                    yield line if retain else line.splitlines()[0]
+                if not chunk:
+                    break
 
     def write_lines(self, lines, encoding=None, errors='strict',
                     linesep=os.linesep, append=False):
@@ -888,7 +2158,7 @@ class Path(text_type):
         This puts a platform-specific newline sequence on every line.
         See `linesep` below.
 
-            `lines` - A list of strings.
+            `lines` - An iterable of strings.
 
             `encoding` - A Unicode encoding to use.  This applies only if
                 `lines` contains any Unicode strings.
@@ -921,38 +2191,43 @@ class Path(text_type):
             mode = 'ab'
         else:
             mode = 'wb'
-        with self.open(mode) as f:
-            for line in lines:
-                isUnicode = isinstance(line, text_type)
+        # Lines are taken in batches. Unicode lines are encoded together,
+        # unless the encoding puts something (a byte order mark, say) at
+        # the start of each string, as each line used to be on its own.
+        lines = iter(lines)
+        batched = None
+        with self.open(mode, 2 ** 20) as f:
+            while True:
+                batch = list(itertools.islice(lines, _WRITE_BATCH))
+                if not batch:
+                    break
+                if not all(issubclass(cls, text_type)
+                           for cls in set(map(type, batch))):
+                    _write_mixed_lines(f, batch, encoding, errors, linesep)
+                    continue
                 if linesep is not None:
                     # Strip off any existing line-end and add the
                     # specified linesep string.
-                    if isUnicode:
-                        if line[-2:] in (u('\r\n'), u('\x0d\x85')):
-                            line = line[:-2]
-                        elif line[-1:] in (u('\r'), u('\n'),
-                                           u('\x85'), u('\u2028')):
-                            line = line[:-1]
-                    else:
-                        if line[-2:] == '\r\n':
-                            line = line[:-2]
-                        elif line[-1:] in ('\r', '\n'):
-                            line = line[:-1]
-                    line += linesep
-                if isUnicode:
+                    batch = [
+                        (line[:-2] if line[-2:] in _LINE_END_PAIRS
+                         else line[:-1]) + linesep
+                        if line[-1:] in _LINE_END_CHARS else line + linesep
+                        for line in batch
+                    ]
+                if batched is None:
                     if encoding is None:
                         encoding = sys.getdefaultencoding()
-                    line = line.encode(encoding, errors)
-                f.write(line)
+                    batched = _concatenable(encoding)
+                _write_encoded(f, batch, encoding, errors, batched)
 
-    def read_md5(self):
+    def read_md5(self, cache=None):
         """ Calculate the md5 hash for this file.
 
         This reads through the entire file.
 
         .. seealso:: :meth:`read_hash`
         """
-        return self.read_hash('md5')
+        return self.read_hash('md5', cache)
 
     def _hash(self, hash_name):
         """ Returns a hash object for the file at the current path.
@@ -961,30 +2236,434 @@ class Path(text_type):
             that's available in the :mod:`hashlib` module.
         """
         m = hashlib.new(hash_name)
-        for chunk in self.chunks(8192, mode="rb"):
-            m.update(chunk)
+        with self.open('rb') as f:
+            # read rather than mapped, as a file truncated meanwhile would
+            # kill the process with SIGBUS; large chunks let hashlib
+            # release the GIL for most of the work
+            for chunk in iter(functools.partial(f.read, 2 ** 20), b''):
+                m.update(chunk)
         return m
 
-    def read_hash(self, hash_name):
+    def read_hash(self, hash_name, cache=None):
         """ Calculate given hash for this file.
 
         List of supported hashes can be obtained from :mod:`hashlib` package.
-        This reads the entire file.
+        This reads the entire file, unless a :class:`HashCache` is given
+        as `cache` and holds the digest of the file as it is now.
 
         .. seealso:: :meth:`hashlib.hash.digest`
         """
+        if cache is not None:
+            return cache.digest(self, hash_name)
         return self._hash(hash_name).digest()
 
-    def read_hexhash(self, hash_name):
+    def read_hexhash(self, hash_name, cache=None):
         """ Calculate given hash for this file, returning hexdigest.
 
         List of supported hashes can be obtained from :mod:`hashlib` package.
-        This reads the entire file.
+        This reads the entire file, unless a :class:`HashCache` is given
+        as `cache` and holds the digest of the file as it is now.
 
         .. seealso:: :meth:`hashlib.hash.hexdigest`
         """
+        if cache is not None:
+            digest = cache.digest(self, hash_name)
+            return binascii.hexlify(digest).decode('ascii')
         return self._hash(hash_name).hexdigest()
 
+    @classmethod
+    def hash_many(cls, paths, hash_name, workers=4, errors='strict',
+                  hexdigest=False, cache=None):
+        """ Hash many files at once, on a pool of `workers` threads.
+
+        Yields ``(path, digest)`` pairs in the order the hashes complete.
+        `paths` may be any iterable, including a generator such as
+        :meth:`walkfiles`; it is consumed as hashing proceeds. With
+        `hexdigest`, digests are given as by :meth:`read_hexhash`.
+        Reading and hashing release the GIL, so threads hash in parallel.
+
+        For example::
+
+            for f, digest in Path.hash_many(d.walkfiles(), 'sha256', 8):
+                ...
+
+        The `errors=` keyword argument controls what happens when a file
+        can't be hashed: ``'strict'`` (the default) raises the exception,
+        ``'warn'`` issues a warning and ``'ignore'`` skips the file.
+        `errors` may also be a callable taking a msg parameter.
+
+        `cache` may be a :class:`HashCache`, as for :meth:`read_hash`.
+
+        .. seealso:: :meth:`read_hash`
+        """
+        errors = _resolve_errors(errors)
+        method = 'read_hexhash' if hexdigest else 'read_hash'
+
+        def as_path(path):
+            return path if isinstance(path, Path) else cls(path)
+
+        def hash_one(path):
+            return getattr(as_path(path), method)(hash_name, cache)
+
+        for path, ok, value in _imap_unordered(hash_one, paths, workers):
+            if ok:
+                yield as_path(path), value
+                continue
+            try:
+                raise value
+            except Exception:
+                errors("Unable to hash '%s': %s" % (path, value))
+
+    def snapshot(self, errors='strict'):
+        """ D.snapshot() -> :class:`Snapshot` of the metadata of everything
+        under D.
+
+        The tree is walked once, without following symbolic links, and
+        each entry's name, size, modification time, mode and inode number
+        recorded in columns, ready for queries over the whole tree::
+
+            snap = Path('/srv/data').snapshot()
+            for f, size in snap.largest(100):
+                ...
+            snap.bytes_per_extension()
+
+        The `errors=` keyword argument behaves as for :meth:`walk`.
+        """
+        errors = _resolve_errors(errors)
+        names = []
+        parent = array.array(_INT64)
+        size = array.array(_INT64)
+        mtime_ns = array.array(_INT64)
+        mode = array.array('L')
+        inode = array.array(_UINT64)
+        stack = [(self, -1)]
+        while stack:
+            dirpath, index = stack.pop()
+            try:
+                listing = dirpath._listentries()
+            except Exception:
+                exc = sys.exc_info()[1]
+                errors("Unable to list directory '%s': %s" % (dirpath, exc))
+                continue
+            for child, entry in listing:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except Exception:
+                    exc = sys.exc_info()[1]
+                    errors("Unable to access '%s': %s" % (child, exc))
+                    continue
+                if stat_module.S_ISDIR(st.st_mode):
+                    stack.append((child, len(names)))
+                names.append(child.name)
+                parent.append(index)
+                size.append(st.st_size)
+                mtime_ns.append(_mtime_ns(st))
+                mode.append(st.st_mode)
+                inode.append(st.st_ino)
+        return Snapshot(self, names, parent, size, mtime_ns, mode, inode)
+
+    def du(self, depth=None, workers=None, errors='strict'):
+        """ D.du() -> :class:`DiskUsage` of D and everything under it.
+
+        Like the ``du`` command, symbolic links are not followed, and a
+        file with several hard links is counted once, under the first
+        directory in which it is found, taking the directories of each level
+        in order of their paths. The allocated bytes are the
+        apparent size where the platform doesn't report blocks.
+
+        With `depth`, return instead a dict mapping D and each directory
+        at most `depth` levels below it to the usage of its own subtree::
+
+            for d, usage in sorted(Path('/srv').du(depth=1).items()):
+                print(d, usage.allocated)
+
+        With `workers`, each level of the tree is listed on that many
+        threads at once, which helps on slow or networked filesystems.
+        The result is the same either way.
+
+        The `errors=` keyword argument behaves as for :meth:`walk`.
+        """
+        errors = _resolve_errors(errors)
+        usage = {self: [0, 0, 0]}
+        # the rollup directories in breadth-first order, with their parents
+        rollups = [(self, None)]
+        # the directories to list next, with the rollups they count toward
+        level = []
+        try:
+            st = self.lstat()
+        except Exception:
+            exc = sys.exc_info()[1]
+            errors("Unable to access '%s': %s" % (self, exc))
+        else:
+            isdir = stat_module.S_ISDIR(st.st_mode)
+            usage[self] = [st.st_size, _allocated(st), int(not isdir)]
+            if isdir:
+                level.append((self, self))
+        seen = set()
+        depth_below = 0
+        while level:
+            depth_below += 1
+            keys = dict(level)
+            if workers:
+                scanned = list(_imap_unordered(
+                    _du_scan, [d for d, key in level], workers))
+            else:
+                scanned = []
+                for dirpath, key in level:
+                    try:
+                        scanned.append((dirpath, True, _du_scan(dirpath)))
+                    except Exception:
+                        scanned.append((dirpath, False, sys.exc_info()[1]))
+            # a fixed order, so hard links are attributed the same way
+            # whether or not the level was listed in parallel
+            scanned.sort(key=lambda result: result[0])
+            level = []
+            for dirpath, ok, listing in scanned:
+                if not ok:
+                    try:
+                        raise listing
+                    except Exception:
+                        errors("Unable to list directory '%s': %s"
+                               % (dirpath, listing))
+                    continue
+                key = keys[dirpath]
+                for child, st, exc in listing:
+                    if exc is not None:
+                        try:
+                            raise exc
+                        except Exception:
+                            errors("Unable to access '%s': %s"
+                                   % (child, exc))
+                        continue
+                    if stat_module.S_ISDIR(st.st_mode):
+                        child_key = key
+                        if depth is not None and depth_below <= depth:
+                            child_key = child
+                            usage[child] = [0, 0, 0]
+                            rollups.append((child, key))
+                        level.append((child, child_key))
+                        total = usage[child_key]
+                    else:
+                        if st.st_nlink > 1:
+                            inode = st.st_dev, st.st_ino
+                            if inode in seen:
+                                continue
+                            seen.add(inode)
+                        total = usage[key]
+                        total[2] += 1
+                    total[0] += st.st_size
+                    total[1] += _allocated(st)
+        for child, parent in reversed(rollups[1:]):
+            for i, value in enumerate(usage[child]):
+                usage[parent][i] += value
+        if depth is None:
+            return DiskUsage(*usage[self])
+        return dict((d, DiskUsage(*value)) for d, value in usage.items())
+
+    def index(self, filename, refresh=True, errors='strict'):
+        """ D.index(filename) -> :class:`FileIndex` of D.
+
+        Open the index of D in the SQLite database `filename`, creating
+        it if need be, and unless `refresh` is false, bring it up to
+        date. The `errors=` keyword argument behaves as for :meth:`walk`.
+        """
+        index = FileIndex(self, filename)
+        if refresh:
+            try:
+                index.refresh(errors=errors)
+            except Exception:
+                index.close()
+                raise
+        return index
+
+    def watch(self, recursive=True, poll=None, interval=1.0, latency=0.05):
+        """ D.watch() -> :class:`Watcher` of the changes under D.
+
+        Iterating over the watcher yields a :class:`WatchEvent` for each
+        file or directory created, modified, deleted or moved under D
+        (or only in D, unless `recursive`)::
+
+            for event in Path('incoming').watch():
+                if event.kind == 'created' and event.path.isfile():
+                    process(event.path)
+
+        On Linux, changes are reported by inotify. Elsewhere, or if `poll`
+        is true, D is scanned for changes every `interval` seconds; use
+        ``poll=True`` for filesystems, such as network ones, whose
+        changes inotify doesn't see. With ``poll=False``, inotify is
+        required. See :class:`Watcher` for `latency`.
+        """
+        return Watcher(self, recursive, poll, interval, latency)
+
+    def find_duplicates(self, pattern=None, hash_name='sha256', min_size=1,
+                        workers=4, errors='strict', cache=None,
+                        block=65536):
+        """ D.find_duplicates() -> List of groups of identical files in D.
+
+        Each group is a sorted list of Path objects naming files, found
+        recursively as by :meth:`walkfiles`, with the same content; groups
+        are sorted too. `pattern` limits the search as for
+        :meth:`walkfiles`, and files smaller than `min_size` bytes are
+        ignored.
+
+        Most files are never read in full: candidates are grouped by
+        size, then by a hash of their first and last `block` bytes, and
+        only files still alike are hashed in full with `hash_name` (using
+        :meth:`hash_many` on `workers` threads, and `cache` if given).
+        Paths that are hard links to the same file are hashed once; they
+        are listed along with any other copies of their content, but are
+        not duplicates by themselves.
+
+        The `errors=` keyword argument behaves as for :meth:`walk`.
+
+        .. seealso:: :meth:`dedupe`
+        """
+        errors = _resolve_errors(errors)
+
+        def report(exc, msg):
+            try:
+                raise exc
+            except Exception:
+                errors(msg)
+
+        # size -> {(dev, ino): [paths]}
+        by_size = {}
+        for f in self.walkfiles(pattern, errors):
+            try:
+                st = f.stat()
+            except Exception:
+                exc = sys.exc_info()[1]
+                errors("Unable to access '%s': %s" % (f, exc))
+                continue
+            if st.st_size < min_size:
+                continue
+            inodes = by_size.setdefault(st.st_size, {})
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(f)
+
+        # Candidate groups are (size, [paths of each inode]) pairs; each
+        # stage splits them by a digest of one path per inode.
+        groups = [
+            (size, list(inodes.values()))
+            for size, inodes in by_size.items()
+            if len(inodes) > 1
+        ]
+
+        def split(groups, digests):
+            refined = []
+            for size, group in groups:
+                by_digest = {}
+                for paths in group:
+                    digest = digests.get(paths[0])
+                    if digest is not None:
+                        by_digest.setdefault(digest, []).append(paths)
+                refined.extend(
+                    (size, alike) for alike in by_digest.values()
+                    if len(alike) > 1)
+            return refined
+
+        candidates = [paths[0] for size, group in groups for paths in group]
+        digests = {}
+        edge_hash = lambda path: _edge_hash(path, hash_name, block)
+        for path, ok, value in _imap_unordered(edge_hash, candidates, workers):
+            if ok:
+                digests[path] = value
+                continue
+            try:
+                raise value
+            except Exception:
+                errors("Unable to hash '%s': %s" % (path, value))
+        groups = split(groups, digests)
+
+        # files no larger than two blocks have been hashed in full already
+        large = [item for item in groups if item[0] > 2 * block]
+        groups = [item for item in groups if item[0] <= 2 * block]
+        candidates = [paths[0] for size, group in large for paths in group]
+        digests = dict(self.hash_many(
+            candidates, hash_name, workers, errors, cache=cache))
+        groups.extend(split(large, digests))
+
+        return sorted(
+            sorted(path for paths in group for path in paths)
+            for size, group in groups
+        )
+
+    @classmethod
+    def dedupe(cls, groups, method='hardlink', errors='strict'):
+        """ Replace duplicate files with links to a single copy.
+
+        `groups` is a list of groups of identical files, as returned by
+        :meth:`find_duplicates`. In each group, every file is replaced by
+        a link to the first one, created under a temporary name and
+        renamed over the duplicate so that its path always names a
+        complete file. Files that already share the first one's inode
+        are left alone.
+
+        Each duplicate is compared byte for byte with the first file
+        before it is replaced, and a file that differs, or that changes
+        while being compared, is reported as an error and kept, so a
+        stale group can't destroy data.
+
+        `method` may be ``'hardlink'``, or ``'reflink'`` to make
+        copy-on-write clones, which keep their own metadata and can later
+        diverge, on filesystems that support them (such as Btrfs and XFS).
+        A hard link shares the first file's inode, so each duplicate
+        takes on its owner, mode and times, losing its own.
+
+        Returns the number of bytes that no longer need their own copy.
+        The `errors=` keyword argument behaves as for :meth:`walk`.
+        """
+        if method not in ('hardlink', 'reflink'):
+            raise ValueError("method must be 'hardlink' or 'reflink'")
+        errors = _resolve_errors(errors)
+        reclaimed = 0
+        for group in groups:
+            group = [
+                path if isinstance(path, Path) else cls(path)
+                for path in group
+            ]
+            original = group[0]
+            for duplicate in group[1:]:
+                temp = _temp_sibling(duplicate)
+                try:
+                    if original.samefile(duplicate):
+                        continue
+                    st = duplicate.stat()
+                    if not _same_contents(original, duplicate):
+                        raise ValueError("contents differ")
+                    if method == 'hardlink':
+                        original.link(temp)
+                    else:
+                        original._reflink_to(temp, duplicate)
+                    now = duplicate.stat()
+                    if (now.st_size, _mtime_ns(now)) != (
+                            st.st_size, _mtime_ns(st)):
+                        raise ValueError("modified while being compared")
+                    _replace(temp, duplicate)
+                except Exception:
+                    exc = sys.exc_info()[1]
+                    temp.remove_p()
+                    errors("Unable to replace '%s' with a link to '%s': %s"
+                           % (duplicate, original, exc))
+                    continue
+                reclaimed += st.st_size
+        return reclaimed
+
+    def _reflink_to(self, dst, like=None):
+        """ Create `dst` as a copy-on-write clone of this file. Its mode
+        and times are copied from `like`, if given.
+        """
+        with open(self, 'rb') as src:
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                _reflink(src.fileno(), fd)
+            except Exception:
+                os.close(fd)
+                os.unlink(dst)
+                raise
+            os.close(fd)
+        if like is not None:
+            shutil.copystat(like, dst)
+
     # --- Methods for querying the filesystem.
     # N.B. On some platforms, the os.path functions may be implemented in C
     # (e.g. isdir on Windows, Python 3.2.2), and compiled functions don't get
@@ -994,20 +2673,48 @@ class Path(text_type):
         """ .. seealso:: :func:`os.path.isabs` """
         return self.module.isabs(self)
 
+    def _is_type(self, entry_method, test, stat_method='stat'):
+        """ Answer a file type query from the cached directory entry or
+        ``stat()`` result, for instances that cache their metadata.
+        """
+        entry = self._entry()
+        try:
+            if entry is not None:
+                return getattr(entry, entry_method)()
+            return test(getattr(self, stat_method)().st_mode)
+        except OSError:
+            return False
+
     def exists(self):
         """ .. seealso:: :func:`os.path.exists` """
+        if self.cache_stat:
+            entry = self._entry()
+            if entry is not None and not entry.is_symlink():
+                return True
+            try:
+                self.stat()
+            except OSError:
+                return False
+            return True
         return self.module.exists(self)
 
     def isdir(self):
         """ .. seealso:: :func:`os.path.isdir` """
+        if self.cache_stat:
+            return self._is_type('is_dir', stat_module.S_ISDIR)
         return self.module.isdir(self)
 
     def isfile(self):
         """ .. seealso:: :func:`os.path.isfile` """
+        if self.cache_stat:
+            return self._is_type('is_file', stat_module.S_ISREG)
         return self.module.isfile(self)
 
     def islink(self):
         """ .. seealso:: :func:`os.path.islink` """
+        if self.cache_stat:
+            return self._is_type(
+                'is_symlink', stat_module.S_ISLNK, stat_method='lstat')
         return self.module.islink(self)
 
     def ismount(self):
@@ -1020,6 +2727,8 @@ class Path(text_type):
 
     def getatime(self):
         """ .. seealso:: :attr:`atime`, :func:`os.path.getatime` """
+        if self.cache_stat:
+            return self.stat().st_atime
         return self.module.getatime(self)
 
     atime = property(
@@ -1031,6 +2740,8 @@ class Path(text_type):
 
     def getmtime(self):
         """ .. seealso:: :attr:`mtime`, :func:`os.path.getmtime` """
+        if self.cache_stat:
+            return self.stat().st_mtime
         return self.module.getmtime(self)
 
     mtime = property(
@@ -1042,6 +2753,8 @@ class Path(text_type):
 
     def getctime(self):
         """ .. seealso:: :attr:`ctime`, :func:`os.path.getctime` """
+        if self.cache_stat:
+            return self.stat().st_ctime
         return self.module.getctime(self)
 
     ctime = property(
@@ -1053,6 +2766,8 @@ class Path(text_type):
 
     def getsize(self):
         """ .. seealso:: :attr:`size`, :func:`os.path.getsize` """
+        if self.cache_stat:
+            return self.stat().st_size
         return self.module.getsize(self)
 
     size = property(
@@ -1076,8 +2791,13 @@ class Path(text_type):
     def stat(self):
         """ Perform a ``stat()`` system call on this path.
 
+        If this path caches its metadata, the result may come from the
+        cache (see :meth:`using_stat_cache`).
+
         .. seealso:: :meth:`lstat`, :func:`os.stat`
         """
+        if self.cache_stat:
+            return self._cached('stat', self._fetch_stat)
         return os.stat(self)
 
     def lstat(self):
@@ -1085,8 +2805,58 @@ class Path(text_type):
 
         .. seealso:: :meth:`stat`, :func:`os.lstat`
         """
+        if self.cache_stat:
+            return self._cached(
+                'lstat', lambda: self._fetch_stat(follow_symlinks=False))
         return os.lstat(self)
 
+    def _fetch_stat(self, follow_symlinks=True):
+        entry = self._entry()
+        if entry is not None:
+            return entry.stat(follow_symlinks=follow_symlinks)
+        if follow_symlinks:
+            return os.stat(self)
+        return os.lstat(self)
+
+    @classmethod
+    def exists_many(cls, paths, workers=8):
+        """ Check whether each of `paths` exists, as :meth:`exists` would,
+        on a pool of `workers` threads.
+
+        Returns an ``array('B')`` of ``1`` or ``0`` for each path, in
+        order. Directories holding several of the paths are listed
+        instead, so most paths cost no system call of their own. Names
+        are matched exactly against the listing, so on a case-insensitive
+        filesystem a path differing in case from the name on disk may be
+        reported missing.
+
+        .. seealso:: :meth:`stat_many`
+        """
+        results = _bulk_stat(list(paths), workers, False)
+        return array.array('B', [st is not None for st in results])
+
+    @classmethod
+    def stat_many(cls, paths, workers=8, follow_symlinks=True):
+        """ ``stat()`` each of `paths` on a pool of `workers` threads.
+
+        Returns a :class:`StatColumns` of compact :mod:`array` columns
+        rather than a stat result per path; paths that can't be
+        ``stat()``-ed are marked as missing. As with :meth:`exists_many`,
+        directories holding several of the paths are listed first, so
+        missing paths cost nothing more (and, on Windows, where listings
+        include metadata, neither do the others).
+
+        .. seealso:: :meth:`exists_many`
+        """
+        results = _bulk_stat(list(paths), workers, True, follow_symlinks)
+        nan = float('nan')
+        return StatColumns(
+            array.array('B', [st is not None for st in results]),
+            array.array(_INT64, [st.st_size if st else -1 for st in results]),
+            array.array('d', [st.st_mtime if st else nan for st in results]),
+            array.array('L', [st.st_mode if st else 0 for st in results]),
+        )
+
     def __get_owner_windows(self):
         r"""
         Return the name of the owner of this file or directory. Follow
@@ -1328,21 +3098,346 @@ class Path(text_type):
     #
     # --- High-level functions from shutil
 
-    copyfile = shutil.copyfile
+    def copy_data(self, dst, strategies=COPY_STRATEGIES):
+        """ Copy the contents of this file to the file `dst`, returning
+        the name of the strategy used.
+
+        The cheapest of `strategies` that works for the two files is
+        used, avoiding copying the data through user space where the
+        platform allows:
+
+        ``'reflink'`` - Clone the file with the ``FICLONE`` ioctl, sharing
+            its extents copy-on-write, on filesystems such as Btrfs and
+            XFS.
+
+        ``'copy_file_range'`` - Have the kernel copy the data with
+            :func:`os.copy_file_range`, which may also be offloaded to the
+            filesystem or storage.
+
+        ``'sendfile'`` - Have the kernel copy the data with
+            :func:`os.sendfile`.
+
+        ``'buffered'`` - Read and write the data through a user-space
+            buffer.
+
+        .. seealso:: :meth:`copyfile`
+        """
+        with open(self, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                return _copy_fd(
+                    fsrc.fileno(), fdst.fileno(), size, strategies)
+
+    def copyfile(self, dst, follow_symlinks=True):
+        """ Copy the contents of this file to the file `dst`.
+
+        This behaves as :func:`shutil.copyfile`, but copies the data as
+        cheaply as the platform allows; see :meth:`copy_data`. Returns
+        `dst` as a Path.
+
+        .. seealso:: :func:`shutil.copyfile`
+        """
+        try:
+            same = os.path.samefile(self, dst)
+        except (OSError, AttributeError):
+            same = False
+        if same:
+            raise getattr(shutil, 'SameFileError', shutil.Error)(
+                "%r and %r are the same file" % (self, dst))
+        for name in (self, dst):
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            if stat_module.S_ISFIFO(st.st_mode):
+                raise getattr(shutil, 'SpecialFileError', shutil.Error)(
+                    "`%s` is a named pipe" % name)
+        if not follow_symlinks and self.islink():
+            os.symlink(os.readlink(self), dst)
+        else:
+            self.copy_data(dst)
+        return self._next_class(dst)
+
+    def copy(self, dst, follow_symlinks=True):
+        """ Copy data and mode bits to `dst`, which may be a directory.
+
+        This behaves as :func:`shutil.copy`, but copies the data as
+        cheaply as the platform allows; see :meth:`copy_data`. Returns
+        the new file's Path.
+
+        .. seealso:: :func:`shutil.copy`
+        """
+        dst = self._next_class(dst)
+        if dst.isdir():
+            dst = dst / self.name
+        self.copyfile(dst, follow_symlinks)
+        kwargs = {} if follow_symlinks else {'follow_symlinks': False}
+        shutil.copymode(self, dst, **kwargs)
+        return dst
+
+    def copy2(self, dst, follow_symlinks=True):
+        """ Copy data and metadata to `dst`, which may be a directory.
+
+        This behaves as :func:`shutil.copy2`, but copies the data as
+        cheaply as the platform allows; see :meth:`copy_data`. Returns
+        the new file's Path.
+
+        .. seealso:: :func:`shutil.copy2`
+        """
+        dst = self._next_class(dst)
+        if dst.isdir():
+            dst = dst / self.name
+        self.copyfile(dst, follow_symlinks)
+        kwargs = {} if follow_symlinks else {'follow_symlinks': False}
+        shutil.copystat(self, dst, **kwargs)
+        return dst
+
     copymode = shutil.copymode
     copystat = shutil.copystat
-    copy = shutil.copy
-    copy2 = shutil.copy2
-    copytree = shutil.copytree
     if hasattr(shutil, 'move'):
         move = shutil.move
-    rmtree = shutil.rmtree
 
-    def rmtree_p(self):
+    def copytree(self, dst, symlinks=False, ignore=None, copy_function=None,
+                 ignore_dangling_symlinks=False, dirs_exist_ok=False,
+                 workers=None, progress=None):
+        """ Recursively copy the directory tree rooted here to `dst`.
+
+        This behaves as :func:`shutil.copytree`: `dst` must not exist
+        yet, unless `dirs_exist_ok`, symbolic links are copied as links
+        if `symlinks` is true and otherwise followed (skipping dangling
+        ones if `ignore_dangling_symlinks`), `ignore` may be a callable
+        as returned by :func:`shutil.ignore_patterns`, and errors are
+        collected and raised together as a :exc:`shutil.Error` at the
+        end.
+
+        Directories are created in order as the tree is walked, while
+        the files are copied, with `copy_function` (by default
+        :meth:`copy2`), one at a time or, with `workers`, on a pool of
+        that many threads. If given, `progress` is called after each file
+        is copied with the source Path and the number of files and bytes
+        copied so far. Returns `dst` as a Path.
+
+        .. seealso:: :func:`shutil.copytree`
+        """
+        dst = self._next_class(dst)
+        listing = self._listentries()
+        if dirs_exist_ok:
+            dst.makedirs_p()
+        else:
+            dst.makedirs()
+        errors = []
+        # (src, dst) of each directory, to copy its metadata at the end
+        created = []
+
+        def files():
+            pending = [(self, dst, listing)]
+            while pending:
+                src_dir, dst_dir, entries = pending.pop()
+                created.append((src_dir, dst_dir))
+                names = [child.name for child, entry in entries]
+                ignored = ignore(src_dir, names) if ignore else ()
+                for child, entry in entries:
+                    if child.name in ignored:
+                        continue
+                    target = dst_dir / child.name
+                    try:
+                        if symlinks and entry.is_symlink():
+                            os.symlink(os.readlink(child), target)
+                            if 'follow_symlinks' in _copystat_args:
+                                shutil.copystat(
+                                    child, target, follow_symlinks=False)
+                        elif entry.is_dir():
+                            sub_entries = child._listentries()
+                            if dirs_exist_ok:
+                                target.mkdir_p()
+                            else:
+                                target.mkdir()
+                            pending.append((child, target, sub_entries))
+                        elif (ignore_dangling_symlinks and
+                              entry.is_symlink() and not child.exists()):
+                            continue
+                        else:
+                            yield child, target
+                    except (OSError, IOError):
+                        errors.append((child, target, str(sys.exc_info()[1])))
+
+        def copy_file(item):
+            src, target = item
+            if copy_function is None:
+                return src.copy2(target).size
+            copy_function(src, target)
+            return os.path.getsize(target)
+
+        count = nbytes = 0
+        for item, ok, value in _imap_unordered(copy_file, files(), workers):
+            if not ok:
+                errors.append(item + (str(value),))
+                continue
+            count += 1
+            nbytes += value
+            if progress is not None:
+                progress(item[0], count, nbytes)
+        for src_dir, dst_dir in reversed(created):
+            try:
+                shutil.copystat(src_dir, dst_dir)
+            except OSError:
+                errors.append((src_dir, dst_dir, str(sys.exc_info()[1])))
+        if errors:
+            raise shutil.Error(errors)
+        return dst
+
+    def sync_to(self, dest, delete=False, checksum=False, dry_run=False,
+                workers=4, hash_name='sha256', cache=None):
+        """ Make the directory tree at `dest` a copy of this one, copying
+        only what differs.
+
+        Files missing from `dest` are copied there, and files present in
+        both trees are copied again if their sizes or their modification
+        times (to the second, as rsync compares them) differ. With
+        `checksum`, files of the same size are compared by their
+        `hash_name` digests instead of their times; `cache` may be a
+        :class:`HashCache` for those. Entries of `dest` that are not in
+        this tree are deleted if `delete` is true, and left alone
+        otherwise.
+
+        Files are copied with :meth:`copy2` on a pool of `workers`
+        threads. Errors are collected and raised together as a
+        :exc:`shutil.Error`. Returns a :class:`SyncPlan` listing the
+        changes; with `dry_run`, they are only planned, not made.
+        """
+        cached = type(self).using_stat_cache()
+
+        def scan(root):
+            root = cached(root)
+            prefix = len(root / '')
+            found = {}
+            if root.isdir():
+                for p in root.walk():
+                    found[p[prefix:]] = p
+            return found
+
+        src = scan(self)
+        dst = scan(dest)
+        created, updated, deleted = [], [], []
+        # entries of dest in the way of a source entry of another type
+        replace = []
+        same_size = []
+        for rel, s in src.items():
+            d = dst.get(rel)
+            if d is None:
+                created.append(rel)
+            elif s.isdir() != d.isdir():
+                replace.append(d)
+                (created if s.isdir() else updated).append(rel)
+            elif s.isdir():
+                continue
+            elif s.size != d.size:
+                updated.append(rel)
+            elif checksum:
+                same_size.append((rel, s, d))
+            elif int(s.mtime) != int(d.mtime):
+                updated.append(rel)
+
+        def digests_differ(item):
+            rel, s, d = item
+            return (s.read_hash(hash_name, cache=cache)
+                    != d.read_hash(hash_name, cache=cache))
+
+        errors = []
+        for item, ok, value in _imap_unordered(
+                digests_differ, same_size, workers):
+            if not ok:
+                errors.append((item[1], item[2], str(value)))
+            elif value:
+                updated.append(item[0])
+
+        if delete:
+            for rel in dst:
+                # only list the topmost of the extra entries
+                parent = os.path.dirname(rel)
+                if rel not in src and (
+                        not parent or parent in src and src[parent].isdir()):
+                    deleted.append(rel)
+
+        plan = SyncPlan(*[
+            sorted(self._next_class(rel) for rel in names)
+            for names in (created, updated, deleted)])
+        if dry_run:
+            if errors:
+                raise shutil.Error(errors)
+            return plan
+
+        dest = self._next_class(dest)
+        for target in [dest / rel for rel in plan.deleted] + replace:
+            if target.isdir() and not target.islink():
+                target.rmtree_p()
+            else:
+                target.remove_p()
+        dest.makedirs_p()
+        copies = []
+        for rel in plan.created + plan.updated:
+            if src[rel].isdir():
+                (dest / rel).makedirs_p()
+            else:
+                copies.append(rel)
+
+        def copy_file(rel):
+            return src[rel].copy2(dest / rel)
+
+        for rel, ok, value in _imap_unordered(copy_file, copies, workers):
+            if not ok:
+                errors.append((self / rel, dest / rel, str(value)))
+        for rel in reversed(plan.created):
+            if src[rel].isdir():
+                try:
+                    shutil.copystat(self / rel, dest / rel)
+                except OSError:
+                    errors.append(
+                        (self / rel, dest / rel, str(sys.exc_info()[1])))
+        if errors:
+            raise shutil.Error(errors)
+        return plan
+
+    def rmtree(self, ignore_errors=False, onerror=None, workers=None,
+               dir_fd=None, onexc=None):
+        """ Remove this directory and everything in it.
+
+        `ignore_errors`, `onerror`, `onexc` and `dir_fd` are as for
+        :func:`shutil.rmtree`. Where the platform allows, entries are
+        removed relative to open directory descriptors, so each path is
+        resolved only once and symbolic links swapped in during the
+        removal are not followed. With `workers`, sibling directories
+        are emptied on that many threads. Elsewhere, or given `dir_fd`,
+        this falls back to :func:`shutil.rmtree`.
+
+        .. seealso:: :func:`shutil.rmtree`
+        """
+        if onexc is not None:
+            if onerror is not None:
+                raise TypeError("onerror and onexc are mutually exclusive")
+
+            def onerror(func, path, exc_info):
+                return onexc(func, path, exc_info[1])
+        if dir_fd is not None or not _RMTREE_FD:
+            kwargs = {} if dir_fd is None else {'dir_fd': dir_fd}
+            if onexc is not None and 'onexc' in _rmtree_args:
+                # spare the caller shutil's onerror deprecation warning
+                return shutil.rmtree(self, ignore_errors, onexc=onexc,
+                                     **kwargs)
+            return shutil.rmtree(self, ignore_errors, onerror, **kwargs)
+        if ignore_errors:
+            def onerror(func, path, exc_info):
+                pass
+        elif onerror is None:
+            def onerror(func, path, exc_info):
+                raise exc_info[1]
+        _rmtree_fd(self, onerror, workers)
+
+    def rmtree_p(self, workers=None):
         """ Like :meth:`rmtree`, but does not raise an exception if the
         directory does not exist. """
         try:
-            self.rmtree()
+            self.rmtree(workers=workers)
         except OSError:
             _, e, _ = sys.exc_info()
             if e.errno != errno.ENOENT:
@@ -1373,7 +3468,8 @@ class Path(text_type):
     # http://www.zopatista.com/python/2013/11/26/inplace-file-rewriting/
     @contextlib.contextmanager
     def in_place(self, mode='r', buffering=-1, encoding=None, errors=None,
-            newline=None, backup_extension=None):
+            newline=None, backup_extension=None, atomic=False,
+            durability='none'):
         """
         A context in which a file may be re-written in-place with new content.
 
@@ -1383,6 +3479,18 @@ class Path(text_type):
         If an exception occurs, the old file is restored, removing the
         written data.
 
+        By default, the file is moved to a backup (named with
+        `backup_extension`, ``.bak`` by default) while the new content is
+        written in its place, and the backup is removed afterwards. With
+        ``atomic=True``, the new content is written to a temporary file
+        instead, which is renamed over the old one once the block exits
+        successfully, so that the file is never missing or incomplete,
+        even if the process dies. In that mode a backup is only made, and
+        kept, if `backup_extension` is given; it is a hard link to the old
+        file where possible, else a copy (a reflink clone where the
+        filesystem supports it). `durability` is then as for
+        :meth:`write_bytes`.
+
         Mode *must not* use ``'w'``, ``'a'``, or ``'+'``; only read-only-modes are
         allowed. A :exc:`ValueError` is raised on invalid modes.
 
@@ -1402,6 +3510,62 @@ class Path(text_type):
         if set(mode).intersection('wa+'):
             raise ValueError('Only read-only file modes can be used')
 
+        if atomic:
+            _check_durability(durability)
+            target = self.realpath()
+            readable = io.open(target, mode, buffering=buffering,
+                encoding=encoding, errors=errors, newline=newline)
+            temp = _temp_sibling(target)
+            try:
+                perm = stat_module.S_IMODE(os.fstat(readable.fileno()).st_mode)
+                fd = os.open(temp, os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                             | getattr(os, 'O_BINARY', 0), perm)
+                writable = io.open(fd, "w" + mode.replace('r', ''),
+                    buffering=buffering, encoding=encoding, errors=errors,
+                    newline=newline)
+            except BaseException:
+                readable.close()
+                raise
+            try:
+                if hasattr(os, 'chmod'):
+                    # not masked by the umask, unlike the mode given above
+                    os.chmod(temp, perm)
+                yield readable, writable
+                writable.flush()
+                if durability != 'none':
+                    _fsync(writable.fileno())
+            except BaseException:
+                readable.close()
+                writable.close()
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+                raise
+            readable.close()
+            writable.close()
+            try:
+                if backup_extension:
+                    backup = target + backup_extension
+                    try:
+                        os.remove(backup)
+                    except OSError:
+                        pass
+                    try:
+                        os.link(target, backup)
+                    except (OSError, AttributeError):
+                        target.copy2(backup)
+                _replace(temp, target)
+            except BaseException:
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+                raise
+            if durability == 'directory':
+                _fsync_dir(target.parent)
+            return
+
         # move existing file to backup, create new file with same permissions
         # borrowed extensively from the fileinput module
         backup_fn = self + (backup_extension or os.extsep + 'bak')
@@ -1452,6 +3616,44 @@ class Path(text_type):
             except os.error:
                 pass
 
+    @property
+    def aio(self):
+        """ An :class:`AsyncPath` for this path, with awaitable versions of
+        its I/O methods.
+        """
+        return AsyncPath(self)
+
+    def transform(self, func, encoding=None, errors=None, chunk_size=None,
+                  backup_extension=None, durability='none'):
+        """ Rewrite this file atomically, passing its content through
+        `func`.
+
+        `func` is called with each line of the file, or with each chunk
+        of `chunk_size` characters or bytes if that is given, and returns
+        what to write in its place. Lines keep their line endings. The
+        content is bytes unless an `encoding` is given. For example::
+
+            Path('app.conf').transform(
+                lambda line: line.replace('debug = on', 'debug = off'),
+                encoding='utf-8')
+
+        The file is read and written through large buffers, and replaced
+        as with ``in_place(atomic=True)``, which also describes
+        `backup_extension` and `durability`. Returns this path.
+        """
+        mode = 'r' if encoding else 'rb'
+        newline = '' if encoding else None
+        with self.in_place(mode, 2 ** 20, encoding, errors, newline,
+                           backup_extension, True, durability) as files:
+            reader, writer = files
+            if chunk_size:
+                pieces = iter(functools.partial(reader.read, chunk_size),
+                              '' if encoding else b'')
+            else:
+                pieces = reader
+            writer.writelines(func(piece) for piece in pieces)
+        return self
+
 
 class tempdir(Path):
     """
@@ -1524,7 +3726,8 @@ class CaseInsensitivePattern(text_type):
     """
     A string with a ``'normcase'`` property, suitable for passing to
     :meth:`listdir`, :meth:`dirs`, :meth:`files`, :meth:`walk`,
-    :meth:`walkdirs`, or :meth:`walkfiles` to match case-insensitive.
+    :meth:`walkdirs`, or :meth:`walkfiles` (or including in a
+    :class:`Matcher`) to match case-insensitive.
 
     For example, to get all files ending in .py, .Py, .pY, or .PY in the
     current directory::
@@ -1536,3 +3739,1376 @@ class CaseInsensitivePattern(text_type):
     @property
     def normcase(self):
         return __import__('ntpath').normcase
+
+
+class Matcher(object):
+    """
+    A reusable, compiled set of filename patterns, suitable for passing
+    anywhere a pattern is accepted: :meth:`fnmatch`, :meth:`listdir`,
+    :meth:`dirs`, :meth:`files`, :meth:`walk`, :meth:`walkdirs`, and
+    :meth:`walkfiles`.
+
+    A name matches if it matches any of the `include` patterns (or
+    `include` is ``None``) and none of the `exclude` patterns. Either may
+    be a single pattern or a sequence of them, and individual patterns
+    may be :class:`CaseInsensitivePattern` instances. For example::
+
+        from path import Path, Matcher, CaseInsensitivePattern as ci
+        sources = Matcher(['*.py', '*.pyx', ci('*.c')], exclude='test_*')
+        for f in Path('.').walkfiles(sources):
+            ...
+
+    All the patterns sharing a case normalization are translated into a
+    single regular expression, so a name is tested against the whole set
+    with one normalization and one regex match per normalization.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = None if include is None else self._as_list(include)
+        self.exclude = self._as_list(exclude)
+        self._compiled = {}
+
+    @staticmethod
+    def _as_list(patterns):
+        if patterns is None:
+            return []
+        if isinstance(patterns, string_types):
+            return [patterns]
+        return list(patterns)
+
+    @classmethod
+    def coerce(cls, pattern):
+        """ Return `pattern` as a Matcher, wrapping plain patterns. """
+        if isinstance(pattern, cls):
+            return pattern
+        return cls(pattern)
+
+    def __repr__(self):
+        return '%s(%r, exclude=%r)' % (
+            type(self).__name__, self.include, self.exclude)
+
+    @staticmethod
+    def _groups(patterns, normcase):
+        """
+        Compile `patterns` into a list of ``(normcase, match)`` pairs, one
+        regular expression per distinct normalization function.
+        """
+        groups = {}
+        order = []
+        for pattern in patterns:
+            pattern_normcase = getattr(pattern, 'normcase', normcase)
+            if pattern_normcase not in groups:
+                groups[pattern_normcase] = []
+                order.append(pattern_normcase)
+            regex = fnmatch.translate(pattern_normcase(pattern))
+            groups[pattern_normcase].append('(?:%s)' % regex)
+        return [
+            (func, re.compile('|'.join(groups[func])).match)
+            for func in order
+        ]
+
+    def compile(self, normcase=os.path.normcase):
+        """
+        Return a function taking a name and returning whether it matches.
+
+        `normcase` normalizes the patterns that don't carry their own
+        ``normcase``, and the names tested against them.
+        """
+        try:
+            return self._compiled[normcase]
+        except KeyError:
+            pass
+        include = (
+            None if self.include is None
+            else self._groups(self.include, normcase)
+        )
+        exclude = self._groups(self.exclude, normcase)
+
+        def match(name):
+            if include is not None:
+                for func, regex_match in include:
+                    if regex_match(func(name)):
+                        break
+                else:
+                    return False
+            for func, regex_match in exclude:
+                if regex_match(func(name)):
+                    return False
+            return True
+        self._compiled[normcase] = match
+        return match
+
+    def matches(self, name, normcase=os.path.normcase):
+        """ Return ``True`` if `name` matches this set of patterns.
+
+        >>> m = Matcher(['*.py', '*.txt'], exclude='setup.*')
+        >>> m.matches('path.py'), m.matches('setup.py'), m.matches('a.c')
+        (True, False, False)
+        """
+        return self.compile(normcase)(name)
+
+
+class HashCache(object):
+    """
+    A persistent cache of file digests, for :meth:`Path.read_hash`,
+    :meth:`Path.read_hexhash` and :meth:`Path.hash_many`.
+
+    Digests are recorded in the SQLite database `filename` against the
+    file's ``(st_dev, st_ino, st_size, st_mtime_ns)``, and only reused
+    while all four still match, so a file is read again once it has been
+    modified or replaced. For example::
+
+        with HashCache('~/.cache/digests.db') as cache:
+            for f in Path('artifacts').walkfiles():
+                print(f, f.read_hexhash('sha256', cache=cache))
+
+    The database can be shared by concurrent processes and threads. Once
+    it holds more than `max_entries` digests, the ones unused for
+    longest are evicted.
+
+    With `xattr`, digests are also stored in an extended attribute of
+    each file (``user.path.<hash_name>``) where the filesystem allows it,
+    and looked up there first. `filename` may then be ``None`` to use
+    extended attributes alone.
+    """
+
+    touch_interval = 3600
+    """ Seconds between updates of an entry's last-used time, so that a
+    cache hit doesn't normally need a write.
+    """
+
+    evict_interval = 1000
+    """ Number of insertions between checks against `max_entries`. """
+
+    def __init__(self, filename, max_entries=1000000, xattr=False):
+        self.max_entries = max_entries
+        self.xattr = xattr and hasattr(os, 'setxattr')
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._db = None
+        self.filename = None
+        if filename is None:
+            return
+        self.filename = Path(filename).expanduser()
+        self._db = sqlite3.connect(
+            self.filename, timeout=60, isolation_level=None,
+            check_same_thread=False)
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            # not supported on some network filesystems
+            pass
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            ' dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,'
+            ' hash_name TEXT, digest BLOB, used REAL,'
+            ' PRIMARY KEY (dev, ino, hash_name))')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS digests_used ON digests (used)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @staticmethod
+    def _key(st):
+        """ The ``(dev, ino, size, mtime_ns)`` identifying a file version. """
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 10 ** 9)
+        # SQLite integers are signed 64-bit
+        dev, ino = st.st_dev, st.st_ino
+        if dev >= 2 ** 63:
+            dev -= 2 ** 64
+        if ino >= 2 ** 63:
+            ino -= 2 ** 64
+        return dev, ino, st.st_size, mtime_ns
+
+    def _xattr_name(self, hash_name):
+        return 'user.path.' + hash_name
+
+    def get(self, path, hash_name, st=None):
+        """ Return the cached digest of the file at `path`, or ``None``
+        if there is none for its current version. `st` is the file's
+        current ``stat()`` result, if already known.
+        """
+        if st is None:
+            st = os.stat(path)
+        dev, ino, size, mtime_ns = self._key(st)
+        if self.xattr:
+            try:
+                value = os.getxattr(path, self._xattr_name(hash_name))
+            except (OSError, IOError):
+                pass
+            else:
+                stamp, sep, digest = value.partition(b' ')
+                if stamp == ('%d:%d' % (size, mtime_ns)).encode('ascii'):
+                    return digest
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime_ns, digest, used FROM digests'
+                ' WHERE dev = ? AND ino = ? AND hash_name = ?',
+                (dev, ino, hash_name)).fetchone()
+            if row is None or tuple(row[:2]) != (size, mtime_ns):
+                return None
+            now = time.time()
+            if now - row[3] > self.touch_interval:
+                self._db.execute(
+                    'UPDATE digests SET used = ?'
+                    ' WHERE dev = ? AND ino = ? AND hash_name = ?',
+                    (now, dev, ino, hash_name))
+        return bytes(row[2])
+
+    def set(self, path, hash_name, digest, st=None):
+        """ Record `digest` for the current version of the file at `path`.
+        """
+        if st is None:
+            st = os.stat(path)
+        dev, ino, size, mtime_ns = self._key(st)
+        if self.xattr:
+            stamp = ('%d:%d ' % (size, mtime_ns)).encode('ascii')
+            try:
+                os.setxattr(path, self._xattr_name(hash_name), stamp + digest)
+            except (OSError, IOError):
+                pass
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO digests'
+                ' (dev, ino, size, mtime_ns, hash_name, digest, used)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (dev, ino, size, mtime_ns, hash_name,
+                 sqlite3.Binary(digest), time.time()))
+            self._inserts += 1
+            if self._inserts % self.evict_interval == 0:
+                self._evict()
+
+    def evict(self):
+        """ Remove the least recently used digests beyond `max_entries`. """
+        if self._db is None:
+            return
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        count, = self._db.execute('SELECT COUNT(*) FROM digests').fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self._db.execute(
+                'DELETE FROM digests WHERE rowid IN'
+                ' (SELECT rowid FROM digests ORDER BY used LIMIT ?)',
+                (excess,))
+
+    def digest(self, path, hash_name):
+        """ Return the digest of the file at `path`, from the cache if
+        possible, else by reading the file and caching the result.
+        """
+        path = path if isinstance(path, Path) else Path(path)
+        st = os.stat(path)
+        digest = self.get(path, hash_name, st)
+        if digest is None:
+            digest = path._hash(hash_name).digest()
+            # don't record a digest of a file modified while it was read
+            if self._key(os.stat(path)) == self._key(st):
+                self.set(path, hash_name, digest, st)
+        return digest
+
+
+def _sqlite_glob(pattern):
+    """
+    Translate the :mod:`fnmatch` `pattern` to the syntax of SQLite's
+    ``GLOB`` operator, which negates a set of characters with ``^``
+    rather than ``!``, and has no literal unclosed ``[``.
+    """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c != '[':
+            out.append(c)
+            continue
+        # find the end of the set as fnmatch does
+        j = i
+        if j < n and pattern[j] == '!':
+            j += 1
+        if j < n and pattern[j] == ']':
+            j += 1
+        j = pattern.find(']', j)
+        if j < 0:
+            out.append('[[]')
+            continue
+        chars = pattern[i:j]
+        i = j + 1
+        if chars.startswith('!'):
+            chars = '^' + chars[1:]
+        elif chars == '^':
+            out.append(chars)
+            continue
+        elif chars.startswith('^'):
+            # a literal caret, which mustn't come first (nor end a range)
+            rest = chars[1:]
+            if rest.endswith('-'):
+                chars = rest[:-1] + '^-'
+            else:
+                chars = rest + '^'
+        out.append('[' + chars + ']')
+    return ''.join(out)
+
+
+class FileIndex(object):
+    """
+    A persistent index of the regular files under directory `root`, kept
+    in the SQLite database `filename`, to query instead of walking the
+    tree again. For example::
+
+        with Path('/srv/data').index('~/.cache/data.db') as index:
+            for f in index.files(ext='.log', older_than=time.time() - 86400):
+                f.remove()
+
+    Each :meth:`refresh` stats every known directory, but only lists
+    again the ones whose modification time changed, as it does when
+    entries are added to, removed from or renamed in them. A file
+    rewritten in place leaves its directory's time as it was, so the size
+    and time the index holds for it may be out of date until
+    ``refresh(full=True)``. Symbolic links are neither followed nor
+    recorded.
+    """
+
+    settle_time = 2
+    """ Seconds after a change to a directory during which its modification
+    time isn't trusted, since another change within the filesystem's time
+    resolution could leave it the same. A directory changed that recently
+    is listed again on the next refresh.
+    """
+
+    def __init__(self, root, filename):
+        self.root = Path(root).abspath()
+        self.filename = Path(filename).expanduser()
+        self._db = sqlite3.connect(
+            self.filename, timeout=60, isolation_level=None)
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            # not supported on some network filesystems
+            pass
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY,'
+            ' value TEXT);'
+            'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY,'
+            ' parent TEXT, mtime_ns INTEGER);'
+            'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY,'
+            ' dir TEXT, name TEXT, ext TEXT, size INTEGER,'
+            ' mtime_ns INTEGER);'
+            'CREATE INDEX IF NOT EXISTS files_dir ON files (dir);'
+            'CREATE INDEX IF NOT EXISTS files_ext ON files (ext);'
+            'CREATE INDEX IF NOT EXISTS files_size ON files (size);'
+            'CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns);')
+        self._db.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('root', ?)", (self.root,))
+        indexed, = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if indexed != self.root:
+            self.close()
+            raise ValueError("'%s' indexes '%s', not '%s'"
+                             % (self.filename, indexed, self.root))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __len__(self):
+        count, = self._db.execute('SELECT COUNT(*) FROM files').fetchone()
+        return count
+
+    def refresh(self, full=False, errors='strict'):
+        """ Bring the index up to date with the tree, listing every
+        directory if `full`, or otherwise only those that changed.
+        Return the number of directories listed.
+
+        The `errors=` keyword argument behaves as for :meth:`Path.walk`.
+        """
+        errors = _resolve_errors(errors)
+        known = {}
+        children = {}
+        for rel, parent, mtime_ns in self._db.execute(
+                'SELECT path, parent, mtime_ns FROM dirs'):
+            known[rel] = mtime_ns
+            children.setdefault(parent, []).append(rel)
+        try:
+            stack = [('', None, self.root.stat())]
+        except Exception:
+            exc = sys.exc_info()[1]
+            errors("Unable to access '%s': %s" % (self.root, exc))
+            return 0
+        cutoff = (time.time() - self.settle_time) * 10 ** 9
+        listed = 0
+        self._db.execute('BEGIN')
+        try:
+            while stack:
+                rel, parent, st = stack.pop()
+                dirpath = self.root / rel if rel else self.root
+                mtime_ns = _mtime_ns(st)
+                if not full and known.get(rel) == mtime_ns:
+                    for child in children.get(rel, ()):
+                        try:
+                            stack.append((child, rel,
+                                          (self.root / child).lstat()))
+                        except Exception:
+                            exc = sys.exc_info()[1]
+                            errors("Unable to access '%s': %s"
+                                   % (self.root / child, exc))
+                    continue
+                try:
+                    listing = dirpath._listentries()
+                except Exception:
+                    exc = sys.exc_info()[1]
+                    errors("Unable to list directory '%s': %s"
+                           % (dirpath, exc))
+                    continue
+                listed += 1
+                files = []
+                subdirs = set()
+                for child, entry in listing:
+                    try:
+                        child_st = entry.stat(follow_symlinks=False)
+                    except Exception:
+                        exc = sys.exc_info()[1]
+                        errors("Unable to access '%s': %s" % (child, exc))
+                        continue
+                    name = child.name
+                    child_rel = os.path.join(rel, name)
+                    if stat_module.S_ISDIR(child_st.st_mode):
+                        subdirs.add(child_rel)
+                        stack.append((child_rel, rel, child_st))
+                    elif stat_module.S_ISREG(child_st.st_mode):
+                        files.append((
+                            child_rel, rel, name, os.path.splitext(name)[1],
+                            child_st.st_size, _mtime_ns(child_st)))
+                self._db.execute('DELETE FROM files WHERE dir = ?', (rel,))
+                self._db.executemany(
+                    'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', files)
+                for gone in set(children.get(rel, ())) - subdirs:
+                    self._forget(gone)
+                if mtime_ns > cutoff:
+                    mtime_ns = -1
+                self._db.execute(
+                    'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                    (rel, parent, mtime_ns))
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+        return listed
+
+    def _forget(self, rel):
+        """ Remove directory `rel` and everything under it. """
+        # the paths under it sort between these two
+        low, high = rel + os.sep, rel + chr(ord(os.sep) + 1)
+        self._db.execute(
+            'DELETE FROM dirs WHERE path = ? OR path >= ? AND path < ?',
+            (rel, low, high))
+        self._db.execute(
+            'DELETE FROM files WHERE path >= ? AND path < ?', (low, high))
+
+    def files(self, pattern=None, ext=None, min_size=None, max_size=None,
+              newer_than=None, older_than=None):
+        """ The indexed files, as sorted Paths, whose names match the glob
+        `pattern`, and that meet the other conditions given:
+
+        `ext` is an extension, such as ``'.txt'``, or a sequence of them.
+        `min_size` and `max_size` are inclusive limits in bytes, and
+        `newer_than` and `older_than` timestamps to compare each file's
+        modification time against.
+        """
+        return self._query('name', pattern, ext, min_size, max_size,
+                           newer_than, older_than)
+
+    def glob(self, pattern, ext=None, min_size=None, max_size=None,
+             newer_than=None, older_than=None):
+        """ Like :meth:`files`, but the `pattern` is matched against the
+        path relative to the root, such as ``'docs/*.txt'``. As in SQLite,
+        ``*`` also matches path separators.
+        """
+        return self._query('path', pattern, ext, min_size, max_size,
+                           newer_than, older_than)
+
+    def _query(self, column, pattern, ext, min_size, max_size,
+               newer_than, older_than):
+        where = []
+        params = []
+        if pattern is not None:
+            where.append(column + ' GLOB ?')
+            params.append(_sqlite_glob(pattern))
+        if ext is not None:
+            if isinstance(ext, string_types):
+                ext = [ext]
+            ext = list(ext)
+            where.append('ext IN (%s)' % ', '.join(['?'] * len(ext)))
+            params.extend(ext)
+        if min_size is not None:
+            where.append('size >= ?')
+            params.append(min_size)
+        if max_size is not None:
+            where.append('size <= ?')
+            params.append(max_size)
+        if newer_than is not None:
+            where.append('mtime_ns > ?')
+            params.append(int(newer_than * 10 ** 9))
+        if older_than is not None:
+            where.append('mtime_ns < ?')
+            params.append(int(older_than * 10 ** 9))
+        query = 'SELECT path FROM files'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY path'
+        return [self.root / rel for rel, in self._db.execute(query, params)]
+
+
+class WatchEvent(collections.namedtuple('WatchEvent', 'kind path dest')):
+    """
+    A change seen by a :class:`Watcher`: `kind` is ``'created'``,
+    ``'modified'``, ``'deleted'`` or ``'moved'``, `path` the Path changed
+    and `dest`, for a move, the Path it was moved to (otherwise ``None``).
+    """
+    __slots__ = ()
+
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_EXCL_UNLINK = 0x4000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0x800
+_IN_CLOEXEC = 0x80000
+_IN_WATCH_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+    _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR |
+    _IN_EXCL_UNLINK)
+_IN_EVENT = struct.Struct('iIII')
+
+_libc = None
+if sys.platform.startswith('linux') and 'ctypes' in globals():
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        _libc = None
+
+# How bursts of changes to one path are summed up by Watcher.read: the
+# kind replacing the two, or None where they cancel out.
+_WATCH_MERGES = {
+    ('created', 'created'): 'created',
+    ('created', 'modified'): 'created',
+    ('created', 'deleted'): None,
+    ('modified', 'modified'): 'modified',
+    ('modified', 'deleted'): 'deleted',
+    ('deleted', 'created'): 'modified',
+}
+
+
+def _fs_encode(path):
+    """ `path` as bytes, for passing to C functions. """
+    if isinstance(path, bytes):
+        return path
+    if hasattr(os, 'fsencode'):
+        return os.fsencode(path)
+    return path.encode(sys.getfilesystemencoding())
+
+
+class Watcher(object):
+    """
+    The changes under directory `root`, as watched by :meth:`Path.watch`.
+
+    :meth:`read` waits for changes and returns them as
+    :class:`WatchEvent` objects, and iterating over the watcher yields
+    them as they come. Once a change arrives, the watcher waits a further
+    `latency` seconds, or with polling until the next scan, and sums up
+    each path's changes over that time: several modifications are
+    reported once, say, and a file created and deleted again not at all.
+    A directory created under `root`, or moved into it, is watched too,
+    and everything found in it is reported as created.
+
+    With inotify, should the kernel's event queue overflow, changes may
+    have been missed, which is reported as a modification of `root`.
+    When polling, moves are recognized by inode number, the contents of a
+    deleted directory are not reported separately, and a directory is
+    only reported as modified if its mode changes.
+    """
+
+    def __init__(self, root, recursive=True, poll=None, interval=1.0,
+                 latency=0.05):
+        self.root = root if isinstance(root, Path) else Path(root)
+        self.recursive = recursive
+        self.interval = interval
+        self.latency = latency
+        self._fd = None
+        if not poll:
+            try:
+                self._start_inotify()
+            except OSError:
+                self.close()
+                if poll is not None:
+                    raise
+        self.polling = self._fd is None
+        if self.polling:
+            self._state = self._scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __iter__(self):
+        while True:
+            for event in self.read():
+                yield event
+
+    def read(self, timeout=None):
+        """ Wait up to `timeout` seconds, or for as long as it takes if
+        it is ``None``, for changes, and return a list of them, which is
+        empty if there were none.
+        """
+        if self.polling:
+            return self._read_polling(timeout)
+        if timeout is not None:
+            timeout += time.time()
+        events = []
+        # the directories moved from, by cookie, until moved to
+        moves = {}
+        while not events:
+            wait = None
+            if timeout is not None:
+                wait = max(timeout - time.time(), 0)
+            if not select.select([self._fd], [], [], wait)[0]:
+                return []
+            self._read_inotify(events, moves)
+        burst_end = time.time() + self.latency
+        while True:
+            wait = burst_end - time.time()
+            if wait <= 0 or not select.select([self._fd], [], [], wait)[0]:
+                break
+            self._read_inotify(events, moves)
+        # those never moved to were moved out of the tree
+        for i, src, isdir in moves.values():
+            if isdir and self.recursive:
+                self._forget_tree(src)
+        return self._merge(events)
+
+    @staticmethod
+    def _merge(events):
+        """ Sum up `events` per path, keeping them in order. """
+        merged = []
+        last = {}
+        for event in events:
+            kind, path, dest = event
+            i = last.get(path)
+            if i is not None and (merged[i].kind, kind) in _WATCH_MERGES:
+                kind = _WATCH_MERGES[merged[i].kind, kind]
+                merged[i] = kind and WatchEvent(kind, path, None)
+                if kind is None:
+                    del last[path]
+                continue
+            last.pop(path, None)
+            if dest is None:
+                last[path] = len(merged)
+            else:
+                last.pop(dest, None)
+            merged.append(event)
+        return [event for event in merged if event]
+
+    # --- inotify
+
+    def _start_inotify(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self._fd = fd
+        # watch descriptors to the directories they watch, and back
+        self._dirs = {}
+        self._wds = {}
+        self._add_watch(self.root)
+        if self.recursive:
+            self._watch_tree(self.root)
+
+    def _add_watch(self, dirpath):
+        wd = _libc.inotify_add_watch(
+            self._fd, _fs_encode(dirpath), _IN_WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), dirpath)
+        self._dirs[wd] = dirpath
+        self._wds[dirpath] = wd
+
+    def _watch_tree(self, top, events=None):
+        """ Watch the directories under `top`, adding what they contain
+        to `events` as created, if given.
+        """
+        stack = [top]
+        while stack:
+            try:
+                listing = stack.pop()._listentries()
+            except OSError:
+                # gone again already
+                continue
+            for child, entry in listing:
+                if events is not None:
+                    events.append(WatchEvent('created', child, None))
+                try:
+                    isdir = stat_module.S_ISDIR(
+                        entry.stat(follow_symlinks=False).st_mode)
+                    if isdir:
+                        self._add_watch(child)
+                except OSError:
+                    if sys.exc_info()[1].errno == errno.ENOSPC:
+                        raise
+                    continue
+                if isdir:
+                    stack.append(child)
+
+    def _forget_tree(self, top):
+        """ Stop watching `top` and the directories under it. """
+        prefix = top / ''
+        for dirpath in list(self._wds):
+            if dirpath == top or dirpath.startswith(prefix):
+                wd = self._wds.pop(dirpath)
+                del self._dirs[wd]
+                _libc.inotify_rm_watch(self._fd, wd)
+
+    def _rename_tree(self, src, dest):
+        """ Update the watches of `src` and under it, now moved to `dest`.
+        """
+        prefix = src / ''
+        for dirpath, wd in list(self._wds.items()):
+            if dirpath == src or dirpath.startswith(prefix):
+                moved = dest + dirpath[len(src):]
+                del self._wds[dirpath]
+                self._wds[moved] = wd
+                self._dirs[wd] = moved
+
+    def _read_inotify(self, events, moves):
+        """ Read the pending inotify events, adding them to `events`,
+        and the moves still to be paired up to `moves`.
+        """
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError:
+            if sys.exc_info()[1].errno != errno.EAGAIN:
+                raise
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                events.append(WatchEvent('modified', self.root, None))
+                continue
+            dirpath = self._dirs.get(wd)
+            if dirpath is None:
+                continue
+            if mask & _IN_IGNORED:
+                del self._dirs[wd]
+                self._wds.pop(dirpath, None)
+                continue
+            if not name:
+                if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                    if dirpath == self.root:
+                        events.append(WatchEvent('deleted', dirpath, None))
+                continue
+            path = dirpath / (os.fsdecode(name) if PY3 else name)
+            isdir = mask & _IN_ISDIR
+            if mask & _IN_MOVED_FROM:
+                moves[cookie] = len(events), path, isdir
+                events.append(WatchEvent('deleted', path, None))
+            elif mask & _IN_MOVED_TO and cookie in moves:
+                i, src, isdir = moves.pop(cookie)
+                events[i] = WatchEvent('moved', src, path)
+                if isdir and self.recursive:
+                    self._rename_tree(src, path)
+            elif mask & (_IN_CREATE | _IN_MOVED_TO):
+                events.append(WatchEvent('created', path, None))
+                if isdir and self.recursive:
+                    try:
+                        self._add_watch(path)
+                    except OSError:
+                        continue
+                    self._watch_tree(path, events)
+            elif mask & _IN_DELETE:
+                events.append(WatchEvent('deleted', path, None))
+            else:
+                events.append(WatchEvent('modified', path, None))
+
+    # --- polling
+
+    def _scan(self):
+        """ A dict of each path under `root` to its ``(mtime_ns, size,
+        mode, inode)``, with the time and size of directories left out.
+        """
+        state = {}
+        stack = [self.root]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                listing = dirpath._listentries()
+            except OSError:
+                if dirpath == self.root:
+                    raise
+                continue
+            for child, entry in listing:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat_module.S_ISDIR(st.st_mode):
+                    state[child] = 0, 0, st.st_mode, st.st_ino
+                    if self.recursive:
+                        stack.append(child)
+                else:
+                    state[child] = (
+                        _mtime_ns(st), st.st_size, st.st_mode, st.st_ino)
+        return state
+
+    def _read_polling(self, timeout):
+        if timeout is not None:
+            timeout += time.time()
+        while True:
+            wait = self.interval
+            if timeout is not None:
+                wait = max(min(wait, timeout - time.time()), 0)
+            time.sleep(wait)
+            try:
+                state = self._scan()
+            except OSError:
+                # the root is gone, and None until it is back
+                state = None
+            if state is None:
+                events = []
+                if self._state is not None:
+                    events.append(WatchEvent('deleted', self.root, None))
+            else:
+                events = self._diff(self._state or {}, state)
+            self._state = state
+            if events:
+                return events
+            if timeout is not None and time.time() >= timeout:
+                return []
+
+    @staticmethod
+    def _diff(old, new):
+        """ The events that turn scan `old` into scan `new`. """
+        deleted = sorted(p for p in old if p not in new)
+        created = sorted(p for p in new if p not in old)
+        # an inode freed by a deletion may be reused by a creation, so a
+        # file is only taken to have moved if its time and size match too
+        sources = dict((old[p], p) for p in deleted)
+        events = []
+        moved = {}
+        for dest in created:
+            src = sources.pop(new[dest], None)
+            if src is None:
+                events.append(WatchEvent('created', dest, None))
+                continue
+            moved[src] = dest
+            # the contents of a moved directory move with it
+            if moved.get(src.parent) != dest.parent:
+                events.append(WatchEvent('moved', src, dest))
+        for p in sorted(new):
+            if p in old and old[p] != new[p]:
+                events.append(WatchEvent('modified', p, None))
+        for p in deleted:
+            # nor is the deletion of a directory's contents reported
+            if p not in moved and (p.parent not in old or p.parent in new):
+                events.append(WatchEvent('deleted', p, None))
+        return events
+
+
+def _sync_file(name):
+    # the file may already have a read-only mode, which is no obstacle
+    # to syncing it, except on Windows, where that needs write access
+    flags = os.O_RDWR if os.name == 'nt' else os.O_RDONLY
+    fd = os.open(name, flags | getattr(os, 'O_BINARY', 0))
+    try:
+        _fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteBatch(object):
+    """
+    Atomic writes of many files, made durable together.
+
+    Files written through a batch are staged in temporary files beside
+    their targets. :meth:`commit` then syncs the staged files on a pool
+    of `workers` threads, renames each into place, and syncs each
+    directory involved once, rather than once per file. For example::
+
+        with WriteBatch() as batch:
+            for name, text in outputs.items():
+                batch.write_text(out_dir / name, text, 'utf-8')
+
+    Leaving the ``with`` block commits the batch or, if it raised an
+    exception, discards the staged files, leaving the targets untouched.
+
+    `durability` is one of :data:`DURABILITY`, as for
+    :meth:`Path.write_bytes`.
+    """
+
+    def __init__(self, durability='directory', workers=4):
+        _check_durability(durability)
+        self.durability = durability
+        self.workers = workers
+        # (temporary file, target) pairs
+        self._staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def write_bytes(self, path, data):
+        """ Stage `data` to be written to `path`. """
+        target = Path(path).realpath()
+        self._staged.append((_write_temp(target, data, False), target))
+
+    def write_text(self, path, text, encoding=None, errors='strict',
+                   linesep=os.linesep):
+        """ Stage `text` to be written to `path`, converted to bytes as
+        :meth:`Path.write_text` does.
+        """
+        self.write_bytes(path, _encode_text(text, encoding, errors, linesep))
+
+    def commit(self):
+        """ Move the staged files into place, as durably as requested. """
+        staged, self._staged = self._staged, []
+        done = 0
+        try:
+            if self.durability != 'none':
+                temps = [temp for temp, target in staged]
+                for temp, ok, value in _imap_unordered(
+                        _sync_file, temps, self.workers):
+                    if not ok:
+                        raise value
+            for temp, target in staged:
+                _replace(temp, target)
+                done += 1
+        except BaseException:
+            self._staged = staged[done:]
+            self.abort()
+            raise
+        if self.durability == 'directory':
+            for dirname in sorted(set(target.parent for temp, target
+                                      in staged)):
+                _fsync_dir(dirname)
+
+    def abort(self):
+        """ Discard the staged files. """
+        staged, self._staged = self._staged, []
+        for temp, target in staged:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+
+class Snapshot(object):
+    """
+    The metadata of every entry under a directory, as taken by
+    :meth:`Path.snapshot`, stored in columns.
+
+    Entry ``i`` is named ``names[i]`` and sits in the directory that is
+    entry ``parent[i]`` (or ``-1``, for the root itself). Its ``size``,
+    ``mtime_ns``, ``mode`` and ``inode`` are likewise the ``i``-th items
+    of those columns, which are NumPy arrays if NumPy is installed, and
+    :mod:`array` arrays otherwise. The query methods work on whole
+    columns at once when NumPy is available.
+    """
+
+    def __init__(self, root, names, parent, size, mtime_ns, mode, inode):
+        self.root = root
+        self.names = names
+        if 'numpy' in globals():
+            parent, size, mtime_ns, mode, inode = map(
+                numpy.asarray, (parent, size, mtime_ns, mode, inode))
+        self.parent = parent
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.mode = mode
+        self.inode = inode
+
+    def __len__(self):
+        return len(self.names)
+
+    def path(self, index):
+        """ The Path of entry `index`. """
+        parts = []
+        while index >= 0:
+            parts.append(self.names[index])
+            index = self.parent[index]
+        parts.reverse()
+        return self.root.joinpath(*parts)
+
+    def paths(self, indexes=None):
+        """ The Paths of the entries at `indexes`, or of all entries. """
+        if indexes is None:
+            indexes = range(len(self))
+        return [self.path(int(i)) for i in indexes]
+
+    def files(self):
+        """ The indexes of the regular files. """
+        if isinstance(self.mode, array.array):
+            return [i for i, mode in enumerate(self.mode)
+                    if stat_module.S_ISREG(mode)]
+        return numpy.flatnonzero(
+            self.mode & 0o170000 == stat_module.S_IFREG)
+
+    def largest(self, n=100):
+        """ The `n` largest files, as ``(path, size)`` pairs, largest
+        first.
+        """
+        files = self.files()
+        if isinstance(files, list):
+            top = heapq.nlargest(n, files, key=self.size.__getitem__)
+        else:
+            order = numpy.argsort(-self.size[files], kind='mergesort')
+            top = files[order[:n]]
+        return [(self.path(int(i)), int(self.size[i])) for i in top]
+
+    def bytes_per_extension(self):
+        """ A dict of the total size of the files with each extension
+        (such as ``'.txt'``, or ``''`` for none).
+        """
+        files = self.files()
+        extensions = [os.path.splitext(self.names[i])[1] for i in files]
+        if isinstance(files, list):
+            totals = {}
+            for ext, i in zip(extensions, files):
+                totals[ext] = totals.get(ext, 0) + self.size[i]
+            return totals
+        if not extensions:
+            return {}
+        keys, inverse = numpy.unique(extensions, return_inverse=True)
+        sums = numpy.zeros(len(keys), dtype=numpy.int64)
+        numpy.add.at(sums, inverse.ravel(), self.size[files])
+        return dict((text_type(k), int(v)) for k, v in zip(keys, sums))
+
+    def older_than(self, days, now=None):
+        """ The paths of the files last modified more than `days` days
+        before `now` (a timestamp, by default the current time).
+        """
+        if now is None:
+            now = time.time()
+        cutoff = int((now - days * 86400) * 1000000000)
+        files = self.files()
+        if isinstance(files, list):
+            old = [i for i in files if self.mtime_ns[i] < cutoff]
+        else:
+            old = files[self.mtime_ns[files] < cutoff]
+        return self.paths(old)
+
+
+def _get_loop():
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):
+        return asyncio.get_event_loop()
+
+
+class _AsyncIterator(object):
+    """
+    An asynchronous iterator over the blocking iterator `iterable`, which
+    is advanced `batch` items at a time on `executor`.
+
+    At most one batch is fetched at a time: calls to :meth:`__anext__`
+    made while one is in flight wait for it, and are answered in the
+    order they were made.
+    """
+
+    def __init__(self, iterable, executor, batch):
+        self._iterator = None
+        self._iterable = iterable
+        self._executor = executor
+        self._batch = batch
+        self._buffered = collections.deque()
+        self._exhausted = False
+        # futures returned by __anext__ not yet answered, and the batch
+        # being fetched for them
+        self._waiters = collections.deque()
+        self._fetching = None
+        self._error = None
+
+    def __aiter__(self):
+        return self
+
+    def _fetch(self):
+        """ Return the next batch and the error that cut it short, if
+        any, so that the items read before the error are still
+        delivered. """
+        items = []
+        try:
+            if self._iterator is None:
+                self._iterator = iter(self._iterable())
+            items.extend(itertools.islice(self._iterator, self._batch))
+        except Exception:
+            return items, sys.exc_info()[1]
+        return items, None
+
+    def _close(self):
+        close = getattr(self._iterator, 'close', None)
+        if close is not None:
+            close()
+
+    def _serve(self, loop):
+        """ Answer the waiting calls from the buffered items, fetching
+        another batch if they run out. """
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.cancelled():
+                self._waiters.popleft()
+            elif self._buffered:
+                self._waiters.popleft().set_result(self._buffered.popleft())
+            elif self._error is not None:
+                self._waiters.popleft().set_exception(self._error)
+                self._error = None
+            elif self._exhausted:
+                self._waiters.popleft().set_exception(StopAsyncIteration())
+            else:
+                break
+        if not self._waiters or self._fetching is not None:
+            return
+        self._fetching = loop.run_in_executor(self._executor, self._fetch)
+
+        def fetched(future):
+            self._fetching = None
+            try:
+                items, error = future.result()
+            except BaseException:
+                items, error = [], sys.exc_info()[1]
+            if not self._exhausted:
+                self._buffered.extend(items)
+                self._error = error
+                # the iterator can't go on after raising
+                self._exhausted = error is not None or len(items) < self._batch
+            self._serve(loop)
+        self._fetching.add_done_callback(fetched)
+
+    def __anext__(self):
+        loop = _get_loop()
+        result = loop.create_future()
+        self._waiters.append(result)
+        self._serve(loop)
+        return result
+
+    def aclose(self):
+        """ Stop the iteration, closing the blocking iterator on the
+        executor once any batch being fetched has arrived. Returns a
+        future.
+        """
+        loop = _get_loop()
+        self._exhausted = True
+        self._buffered.clear()
+        self._error = None
+        self._serve(loop)
+        result = loop.create_future()
+
+        def closed(future):
+            if result.cancelled():
+                return
+            exc = future.exception()
+            if exc is None:
+                result.set_result(None)
+            else:
+                result.set_exception(exc)
+
+        def close(future=None):
+            loop.run_in_executor(
+                self._executor, self._close).add_done_callback(closed)
+        if self._fetching is None:
+            close()
+        else:
+            self._fetching.add_done_callback(close)
+        return result
+
+
+class AsyncPath(object):
+    """
+    Awaitable versions of the I/O methods of the :class:`Path` `path`,
+    for use from :mod:`asyncio` code, also available as ``Path.aio``.
+
+    Each method runs its :class:`Path` counterpart on `executor` and
+    returns a future for its result, while :meth:`listdir`, :meth:`dirs`,
+    :meth:`files` and the ``walk`` methods return asynchronous iterators,
+    which fetch `batch` entries at a time::
+
+        text = await Path('config.ini').aio.text('utf-8')
+        async for f in Path('/srv/logs').aio.walkfiles('*.gz'):
+            ...
+
+    An iterator left before its end should be closed with ``await
+    iterator.aclose()``, which releases the walk it is running (such as
+    the thread pool of a ``walk(workers=N)``).
+
+    Unless an `executor` is given, a thread pool of :attr:`max_workers`
+    threads, shared by all instances, is used, so that however many
+    operations are started, at most that many run at once.
+    """
+
+    max_workers = 8
+    """ Size of the shared thread pool. """
+
+    batch = 256
+    """ Number of entries the asynchronous iterators fetch at a time. """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, path, executor=None):
+        self.path = path if isinstance(path, Path) else Path(path)
+        self.executor = executor
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, text_type(self.path))
+
+    def __str__(self):
+        return str(self.path)
+
+    def __fspath__(self):
+        return self.path
+
+    def __eq__(self, other):
+        return (isinstance(other, AsyncPath) and self.path == other.path)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __div__(self, rel):
+        return type(self)(self.path / rel, self.executor)
+
+    __truediv__ = __div__
+
+    def joinpath(self, *others):
+        return type(self)(self.path.joinpath(*others), self.executor)
+
+    @property
+    def parent(self):
+        return type(self)(self.path.parent, self.executor)
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @classmethod
+    def _shared_executor(cls):
+        with cls._executor_lock:
+            if AsyncPath._executor is None:
+                AsyncPath._executor = concurrent.futures.ThreadPoolExecutor(
+                    cls.max_workers)
+            return AsyncPath._executor
+
+    def _run(self, func, *args, **kwargs):
+        executor = self.executor or self._shared_executor()
+        return _get_loop().run_in_executor(
+            executor, functools.partial(func, *args, **kwargs))
+
+    def _iterate(self, name, *args, **kwargs):
+        method = getattr(self.path, name)
+        return _AsyncIterator(
+            functools.partial(method, *args, **kwargs),
+            self.executor or self._shared_executor(), self.batch)
+
+    def listdir(self, pattern=None):
+        """ Asynchronous iterator over :meth:`Path.listdir`. """
+        return self._iterate('listdir', pattern)
+
+    def dirs(self, pattern=None):
+        """ Asynchronous iterator over :meth:`Path.dirs`. """
+        return self._iterate('dirs', pattern)
+
+    def files(self, pattern=None):
+        """ Asynchronous iterator over :meth:`Path.files`. """
+        return self._iterate('files', pattern)
+
+    def walk(self, *args, **kwargs):
+        """ Asynchronous iterator over :meth:`Path.walk`. """
+        return self._iterate('walk', *args, **kwargs)
+
+    def walkdirs(self, *args, **kwargs):
+        """ Asynchronous iterator over :meth:`Path.walkdirs`. """
+        return self._iterate('walkdirs', *args, **kwargs)
+
+    def walkfiles(self, *args, **kwargs):
+        """ Asynchronous iterator over :meth:`Path.walkfiles`. """
+        return self._iterate('walkfiles', *args, **kwargs)
+
+    def iterlines(self, *args, **kwargs):
+        """ Asynchronous iterator over :meth:`Path.iterlines`. """
+        return self._iterate('iterlines', *args, **kwargs)
+
+
+def _awaitable(name):
+    def method(self, *args, **kwargs):
+        return self._run(getattr(self.path, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Awaitable :meth:`Path.%s`." % name
+    return method
+
+
+for _name in (
+        'stat', 'lstat', 'exists', 'isdir', 'isfile', 'islink', 'ismount',
+        'getsize', 'getmtime', 'getatime', 'getctime', 'samefile',
+        'realpath', 'access', 'glob', 'text', 'bytes', 'lines',
+        'write_text', 'write_bytes', 'write_lines', 'read_hash',
+        'read_hexhash', 'read_md5', 'touch', 'mkdir', 'mkdir_p', 'makedirs',
+        'makedirs_p', 'rmdir', 'rmdir_p', 'removedirs', 'removedirs_p',
+        'remove', 'remove_p', 'unlink', 'unlink_p', 'rename', 'renames',
+        'chmod', 'utime', 'copyfile', 'copy', 'copy2', 'copytree',
+        'sync_to', 'rmtree', 'rmtree_p', 'move', 'link', 'symlink',
+        'readlink', 'readlinkabs', 'transform', 'find_duplicates',
+        'snapshot', 'du'):
+    if hasattr(Path, _name):
+        setattr(AsyncPath, _name, _awaitable(_name))
+del _name
@@ -42,6 +42,7 @@ setup_params = dict(
     ],
     setup_requires=sphinx_req + ptr_req,
     tests_require=['pytest'],
+    extras_require={'snapshot': ['numpy']},
 )
 
 
@@ -15,6 +15,8 @@ time on files.
 """
 
 import unittest
+import errno
+import hashlib
 import codecs
 import os
 import sys
@@ -25,11 +27,14 @@ import time
 import ntpath
 import posixpath
 import textwrap
+import threading
 
 import pytest
 
+import path
 from path import Path, tempdir, u
 from path import CaseInsensitivePattern as ci
+from path import Matcher, HashCache, WriteBatch, AsyncPath
 
 
 def p(**choices):
@@ -887,6 +892,1535 @@ class TestPatternMatching(object):
         assert p/'sub2'/'foo'/'bar.TXT' in files
         assert p/'sub1'/'foo'/'bar.Txt' in files
 
+    def test_matcher_include_exclude(self):
+        m = Matcher(['*.py', ci('*.TXT')], exclude=['test_*', '*.tmp.*'])
+        assert Path('foo.py').fnmatch(m)
+        assert Path('README.txt').fnmatch(m)
+        assert not Path('test_foo.py').fnmatch(m)
+        assert not Path('foo.tmp.py').fnmatch(m)
+        assert not Path('foo.PY').fnmatch(m)
+        assert Matcher(exclude='*.pyc').matches('foo.py')
+        assert not Matcher([]).matches('foo.py')
+
+    def test_matcher_listing(self, tmpdir):
+        p = Path(tmpdir)
+        (p/'sub').mkdir()
+        (p/'sub'/'b.PY').touch()
+        (p/'a.py').touch()
+        (p/'a.txt').touch()
+        m = Matcher([ci('*.py'), 'sub'])
+        assert sorted(p.listdir(m)) == [p/'a.py', p/'sub']
+        assert p.files(m) == [p/'a.py']
+        assert p.dirs(m) == [p/'sub']
+        assert sorted(p.walkfiles(m)) == [p/'a.py', p/'sub'/'b.PY']
+        assert list(p.walkdirs(m)) == [p/'sub']
+
+    def test_matcher_custom_module(self, tmpdir):
+        (Path(tmpdir)/'File').touch()
+        always_win = Path.using_module(ntpath)
+        p = always_win(tmpdir)
+        assert p.listdir(Matcher(['f*', 'x*'])) == [p/'File']
+
+
+class TestHashMany(object):
+    def test_hash_many(self, tmpdir):
+        d = Path(tmpdir)
+        files = [(d / ('%d.bin' % i)) for i in range(20)]
+        for i, f in enumerate(files):
+            f.write_bytes(os.urandom(i * 1000))
+        results = dict(Path.hash_many(d.walkfiles(), 'sha256', workers=3))
+        assert sorted(results) == sorted(files)
+        for f in files:
+            assert results[f] == f.read_hash('sha256')
+        hexes = dict(Path.hash_many(map(str, files), 'md5', hexdigest=True))
+        assert hexes[files[3]] == files[3].read_hexhash('md5')
+
+    def test_hash_many_errors(self, tmpdir):
+        d = Path(tmpdir)
+        good = (d / 'good').touch()
+        missing = d / 'missing'
+        with pytest.raises(IOError):
+            list(Path.hash_many([good, missing], 'md5'))
+        assert list(Path.hash_many([missing, good], 'md5', errors='ignore')) \
+            == [(good, good.read_md5())]
+        msgs = []
+        list(Path.hash_many([missing], 'md5', errors=msgs.append))
+        assert len(msgs) == 1 and 'missing' in msgs[0]
+
+
+class TestHashCache(object):
+    def count_hashes(self, monkeypatch):
+        hashed = []
+        real_hash = Path._hash
+
+        def counting_hash(self, hash_name):
+            hashed.append(self)
+            return real_hash(self, hash_name)
+        monkeypatch.setattr(Path, '_hash', counting_hash)
+        return hashed
+
+    def test_cache_hits(self, tmpdir, monkeypatch):
+        d = Path(tmpdir)
+        f = d / 'data.bin'
+        f.write_bytes(b'some data')
+        expected = f.read_hash('sha1')
+        hashed = self.count_hashes(monkeypatch)
+        with HashCache(d / 'cache.db') as cache:
+            assert f.read_hash('sha1', cache) == expected
+            assert f.read_hash('sha1', cache) == expected
+            assert f.read_hexhash('sha1', cache) == f.read_hexhash('sha1')
+        assert len(hashed) == 2
+        # a second process would find the persisted digest
+        with HashCache(d / 'cache.db') as cache:
+            assert f.read_hash('sha1', cache) == expected
+            assert dict(Path.hash_many([f], 'sha1', cache=cache)) == \
+                {f: expected}
+        assert len(hashed) == 2
+
+    def test_modified_file_is_rehashed(self, tmpdir):
+        d = Path(tmpdir)
+        f = d / 'data.bin'
+        f.write_bytes(b'old')
+        with HashCache(d / 'cache.db') as cache:
+            f.read_md5(cache)
+            f.write_bytes(b'new content')
+            assert f.read_md5(cache) == f.read_md5()
+
+    def test_eviction(self, tmpdir):
+        d = Path(tmpdir)
+        cache = HashCache(d / 'cache.db', max_entries=3)
+        cache.evict_interval = 1
+        for i in range(5):
+            f = (d / ('%d.bin' % i))
+            f.write_bytes(b'x' * i)
+            f.read_hash('md5', cache)
+        count, = cache._db.execute('SELECT COUNT(*) FROM digests').fetchone()
+        assert count == 3
+        cache.close()
+
+    def test_large_device_and_inode(self, tmpdir):
+        class FakeStat(object):
+            st_dev = 2 ** 64 - 5
+            st_ino = 2 ** 64 - 7
+            st_size = 4
+            st_mtime_ns = 1000000000 * 10 ** 9
+        st = FakeStat()
+        assert HashCache._key(st) == (-5, -7, 4, 1000000000 * 10 ** 9)
+        f = Path(tmpdir) / 'data.bin'
+        with HashCache(Path(tmpdir) / 'cache.db') as cache:
+            assert cache.get(f, 'md5', st) is None
+            cache.set(f, 'md5', b'digest', st)
+            assert cache.get(f, 'md5', st) == b'digest'
+
+    def test_xattr_only(self):
+        cache = HashCache(None)
+        assert cache.filename is None
+        cache.close()
+
+    def test_xattr(self, tmpdir, monkeypatch):
+        if not hasattr(os, 'setxattr'):
+            pytest.skip("extended attributes not available")
+        f = Path(tmpdir) / 'data.bin'
+        f.write_bytes(b'some data')
+        try:
+            os.setxattr(f, 'user.test', b'1')
+        except OSError:
+            pytest.skip("filesystem does not support extended attributes")
+        cache = HashCache(None, xattr=True)
+        expected = f.read_hash('sha256', cache)
+        assert os.getxattr(f, 'user.path.sha256').endswith(expected)
+        hashed = self.count_hashes(monkeypatch)
+        assert f.read_hash('sha256', cache) == expected
+        assert hashed == []
+
+
+class TestDuplicates(object):
+    def make_files(self, d, block):
+        same = os.urandom(5 * block)
+        differs_in_middle = bytearray(same)
+        differs_in_middle[2 * block] ^= 0xff
+        files = {
+            'a/big1': same,
+            'b/big2': same,
+            'big3': bytes(differs_in_middle),
+            'small1': b'small',
+            'a/small2': b'small',
+            'other': b'smell',
+            'empty1': b'',
+            'empty2': b'',
+        }
+        for name, content in files.items():
+            f = d / name
+            f.parent.makedirs_p()
+            f.write_bytes(content)
+        return files
+
+    def test_find_duplicates(self, tmpdir):
+        d = Path(tmpdir)
+        self.make_files(d, block=16)
+        d.joinpath('small1').link(d / 'small3')
+        assert d.find_duplicates(block=16, workers=2) == [
+            [d/'a'/'big1', d/'b'/'big2'],
+            [d/'a'/'small2', d/'small1', d/'small3'],
+        ]
+        assert [d/'empty1', d/'empty2'] in \
+            d.find_duplicates(block=16, min_size=0)
+        assert d.find_duplicates('small*', block=16) == [
+            [d/'a'/'small2', d/'small1', d/'small3']]
+
+    def test_edge_hash_skips_full_reads(self, tmpdir, monkeypatch):
+        d = Path(tmpdir)
+        (d / 'one').write_bytes(b'a' + b'x' * 1000 + b'a')
+        (d / 'two').write_bytes(b'b' + b'x' * 1000 + b'b')
+        hashed = []
+        monkeypatch.setattr(Path, '_hash', lambda *args: hashed.append(args))
+        assert d.find_duplicates(block=16) == []
+        assert hashed == []
+
+    def test_dedupe_hardlink(self, tmpdir):
+        d = Path(tmpdir)
+        files = self.make_files(d, block=16)
+        groups = d.find_duplicates(block=16)
+        assert Path.dedupe(groups) == 80 + 5
+        assert (d/'a'/'big1').samefile(d/'b'/'big2')
+        assert (d/'small1').samefile(d/'a'/'small2')
+        for name, content in files.items():
+            assert (d / name).bytes() == content
+        assert d.find_duplicates(block=16) == []
+        assert Path.dedupe(groups) == 0
+
+    def test_dedupe_changed(self, tmpdir):
+        d = Path(tmpdir)
+        (d / 'one').write_bytes(b'data')
+        (d / 'two').write_bytes(b'data')
+        (d / 'three').write_bytes(b'data')
+        groups = d.find_duplicates()
+        (d / 'two').write_bytes(b'edit')
+        (d / 'three').write_bytes(b'longer')
+        with pytest.raises(ValueError):
+            Path.dedupe(groups)
+        failures = []
+        assert Path.dedupe(groups, errors=failures.append) == 0
+        assert len(failures) == 2
+        assert (d / 'two').bytes() == b'edit'
+        assert (d / 'three').bytes() == b'longer'
+        assert sorted(d.listdir()) == [d / 'one', d / 'three', d / 'two']
+
+    def test_dedupe_reflink(self, tmpdir):
+        d = Path(tmpdir)
+        (d / 'one').write_bytes(b'data')
+        (d / 'two').write_bytes(b'data')
+        ino = (d / 'two').stat().st_ino
+        failures = []
+        reclaimed = Path.dedupe([[d/'one', d/'two']], method='reflink',
+                                errors=failures.append)
+        assert (d / 'two').bytes() == b'data'
+        assert not (d/'one').samefile(d/'two')
+        if failures:
+            # the filesystem doesn't support reflinks
+            assert reclaimed == 0
+            assert (d / 'one').bytes() == b'data'
+            assert (d / 'two').stat().st_ino == ino
+        else:
+            assert reclaimed == 4
+        assert sorted(d.listdir()) == [d/'one', d/'two']
+
+    def test_dedupe_reflink_replaces(self, tmpdir, monkeypatch):
+        cloned = []
+
+        def reflink(src_fd, dst_fd):
+            cloned.append(src_fd)
+            os.write(dst_fd, os.read(src_fd, 1024))
+        monkeypatch.setattr(path, '_reflink', reflink)
+        d = Path(tmpdir)
+        (d / 'one').write_bytes(b'data')
+        (d / 'two').write_bytes(b'data')
+        ino = (d / 'two').stat().st_ino
+        failures = []
+        reclaimed = Path.dedupe([[d/'one', d/'two']], method='reflink',
+                                errors=failures.append)
+        assert (failures, reclaimed, len(cloned)) == ([], 4, 1)
+        assert (d / 'two').bytes() == b'data'
+        assert (d / 'two').stat().st_ino != ino
+        assert sorted(d.listdir()) == [d/'one', d/'two']
+
+
+class TestCopy(object):
+    @pytest.mark.parametrize('strategies', [
+        path.COPY_STRATEGIES,
+        ('copy_file_range', 'buffered'),
+        ('sendfile', 'buffered'),
+        ('buffered',),
+    ])
+    def test_copy_data(self, tmpdir, strategies):
+        d = Path(tmpdir)
+        src = d / 'src.bin'
+        content = os.urandom(3 * 2 ** 20 + 17)
+        src.write_bytes(content)
+        used = src.copy_data(d / 'dst.bin', strategies)
+        assert used in strategies
+        assert (d / 'dst.bin').bytes() == content
+        empty = (d / 'empty').touch()
+        assert empty.copy_data(d / 'empty2', strategies) in strategies
+        assert (d / 'empty2').bytes() == b''
+
+    def test_unusable_strategies(self, tmpdir):
+        src = (Path(tmpdir) / 'src').touch()
+        with pytest.raises(ValueError):
+            src.copy_data(Path(tmpdir) / 'dst', ['reflink'])
+
+    def test_reflink_ioerror(self, tmpdir, monkeypatch):
+        # Python 2's ioctl() raises IOError rather than OSError
+        def reflink(src_fd, dst_fd):
+            raise IOError(errno.EOPNOTSUPP, "no reflinks")
+        monkeypatch.setattr(path, '_reflink', reflink)
+        src = Path(tmpdir) / 'src'
+        src.write_bytes(b'content')
+        used = src.copy_data(Path(tmpdir) / 'dst', ['reflink', 'buffered'])
+        assert used == 'buffered'
+        assert (Path(tmpdir) / 'dst').bytes() == b'content'
+
+    def test_copy_functions(self, tmpdir):
+        d = Path(tmpdir)
+        src = d / 'src.txt'
+        src.write_bytes(b'content')
+        src.chmod(0o640)
+        os.utime(src, (1000000000, 1000000000))
+        assert src.copyfile(d / 'a.txt') == d / 'a.txt'
+        assert (d / 'a.txt').bytes() == b'content'
+        sub = (d / 'sub').mkdir()
+        assert src.copy(sub) == sub / 'src.txt'
+        assert (sub / 'src.txt').stat().st_mode & 0o777 == 0o640
+        assert src.copy2(d / 'b.txt') == d / 'b.txt'
+        assert (d / 'b.txt').mtime == 1000000000
+        with pytest.raises(shutil.Error):
+            src.copyfile(src)
+
+    @pytest.mark.parametrize('workers', [None, 1, 4])
+    def test_copytree(self, tmpdir, workers):
+        d = Path(tmpdir)
+        src = (d / 'src').mkdir()
+        for sub in ('a', 'a/b', 'a/b/c', 'skip'):
+            (src / sub).mkdir()
+            for i in range(5):
+                (src / sub / ('f%d.txt' % i)).write_bytes(b'x' * i)
+        (src / 'a' / 'f0.pyc').touch()
+        os.utime(src / 'a', (1000000000, 1000000000))
+        (src / 'a' / 'f1.txt').symlink(src / 'link')
+        calls = []
+        result = src.copytree(
+            d / 'dst', symlinks=True, workers=workers,
+            ignore=shutil.ignore_patterns('skip', '*.pyc'),
+            progress=lambda *args: calls.append(args))
+        assert result == d / 'dst'
+        names = sorted(p.relpath(result) for p in result.walk())
+        expected = sorted(p.relpath(src) for p in src.walk()
+                          if 'skip' not in p and not p.endswith('.pyc'))
+        assert names == expected
+        assert (result / 'link').islink()
+        assert (result / 'a' / 'b' / 'f3.txt').bytes() == b'xxx'
+        assert (result / 'a').mtime == 1000000000
+        assert sorted(c[1] for c in calls) == list(range(1, 16))
+        assert max(c[2] for c in calls) == 30
+
+    def test_copytree_errors(self, tmpdir):
+        d = Path(tmpdir)
+        src = (d / 'src').mkdir()
+        (src / 'ok.txt').write_bytes(b'ok')
+        (d / 'missing').symlink(src / 'dangling')
+        with pytest.raises(shutil.Error) as info:
+            src.copytree(d / 'dst')
+        assert [e[0] for e in info.value.args[0]] == [src / 'dangling']
+        assert (d / 'dst' / 'ok.txt').bytes() == b'ok'
+        with pytest.raises(OSError):
+            src.copytree(d / 'dst')
+
+    def test_copytree_shutil_arguments(self, tmpdir):
+        d = Path(tmpdir)
+        src = (d / 'src').mkdir()
+        (src / 'sub').mkdir()
+        (src / 'sub' / 'f.txt').write_bytes(b'data')
+        (d / 'missing').symlink(src / 'dangling')
+        copied = []
+
+        def copy(a, b):
+            copied.append((a, threading.current_thread()))
+            return shutil.copy(a, b)
+        # positionally, as for shutil.copytree
+        src.copytree(d / 'dst', False, None, copy, True)
+        # serially, in the calling thread, unless given workers
+        assert copied == [(src / 'sub' / 'f.txt', threading.current_thread())]
+        assert (d / 'dst' / 'sub' / 'f.txt').bytes() == b'data'
+        assert not (d / 'dst' / 'dangling').exists()
+        (src / 'sub' / 'f.txt').write_bytes(b'new')
+        src.copytree(d / 'dst', ignore_dangling_symlinks=True,
+                     dirs_exist_ok=True)
+        assert (d / 'dst' / 'sub' / 'f.txt').bytes() == b'new'
+        with pytest.raises(OSError):
+            src.copytree(d / 'dst', ignore_dangling_symlinks=True)
+
+    @pytest.mark.parametrize('workers', [None, 4])
+    def test_rmtree(self, tmpdir, workers):
+        d = Path(tmpdir)
+        top = (d / 'top').mkdir()
+        for sub in ('a', 'a/b', 'a/b/c', 'a/d', 'e'):
+            (top / sub).mkdir()
+            for i in range(3):
+                (top / sub / ('f%d' % i)).touch()
+        outside = (d / 'outside').mkdir()
+        (outside / 'keep').touch()
+        outside.symlink(top / 'a' / 'link')
+        assert top.rmtree(workers=workers) is None
+        assert not top.exists()
+        assert (outside / 'keep').isfile()
+        assert top.rmtree_p(workers=workers) == top
+        with pytest.raises(OSError):
+            top.rmtree()
+        top.rmtree(ignore_errors=True)
+
+    def test_rmtree_link(self, tmpdir):
+        d = Path(tmpdir)
+        (d / 'target').mkdir()
+        (d / 'target').symlink(d / 'link')
+        with pytest.raises(OSError):
+            (d / 'link').rmtree()
+        assert (d / 'target').isdir()
+
+    def test_rmtree_onerror(self, tmpdir, monkeypatch):
+        d = Path(tmpdir)
+        locked = (d / 'top' / 'locked').makedirs()
+        (locked / 'f').touch()
+        real_unlink = os.unlink
+
+        def unlink(name, *args, **kwargs):
+            if os.path.basename(name) == 'f':
+                raise OSError(errno.EACCES, "denied", name)
+            return real_unlink(name, *args, **kwargs)
+        monkeypatch.setattr(os, 'unlink', unlink)
+        monkeypatch.setattr(os, 'remove', unlink)
+        calls = []
+        (d / 'top').rmtree(onerror=lambda *args: calls.append(args[1]))
+        assert calls == [locked / 'f', locked, d / 'top']
+        with pytest.raises(OSError):
+            (d / 'top').rmtree()
+        errors = []
+        (d / 'top').rmtree(onexc=lambda *args: errors.append(args))
+        assert [e[1] for e in errors] == [locked / 'f', locked, d / 'top']
+        assert isinstance(errors[0][2], OSError)
+        with pytest.raises(TypeError):
+            (d / 'top').rmtree(onerror=calls.append, onexc=calls.append)
+
+    def test_rmtree_onexc_forwarded(self, tmpdir, monkeypatch):
+        calls = []
+
+        def rmtree(path, ignore_errors=False, onerror=None, onexc=None):
+            calls.append((onerror, onexc))
+        monkeypatch.setattr(path, '_RMTREE_FD', False)
+        monkeypatch.setattr(shutil, 'rmtree', rmtree)
+        monkeypatch.setattr(path, '_rmtree_args', ('onerror', 'onexc'))
+
+        def handler(func, path, exc):
+            pass
+        Path(tmpdir).rmtree(onexc=handler)
+        assert calls == [(None, handler)]
+
+    def test_rmtree_dir_fd(self, tmpdir):
+        d = Path(tmpdir)
+        (d / 'top' / 'sub').makedirs()
+        fd = os.open(d, os.O_RDONLY)
+        try:
+            Path('top').rmtree(dir_fd=fd)
+        except TypeError:
+            pytest.skip("shutil.rmtree doesn't take dir_fd")
+        finally:
+            os.close(fd)
+        assert d.listdir() == []
+
+
+class TestSync(object):
+    def make_tree(self, root):
+        for name, content in [
+            ('a.txt', b'aaa'),
+            ('sub/b.txt', b'bbb'),
+            ('sub/deeper/c.txt', b'ccc'),
+        ]:
+            (root / name).parent.makedirs_p()
+            (root / name).write_bytes(content)
+        (root / 'empty').mkdir()
+        return root
+
+    def test_initial_and_noop(self, tmpdir):
+        d = Path(tmpdir)
+        src = self.make_tree(d / 'src')
+        plan = src.sync_to(d / 'dst')
+        assert isinstance(plan, path.SyncPlan)
+        assert plan.created == sorted(p.relpath(src) for p in src.walk())
+        assert plan.updated == plan.deleted == []
+        assert (d / 'dst' / 'sub' / 'deeper' / 'c.txt').bytes() == b'ccc'
+        assert (d / 'dst' / 'empty').isdir()
+        assert src.sync_to(d / 'dst') == ([], [], [])
+
+    def test_changes(self, tmpdir):
+        d = Path(tmpdir)
+        src = self.make_tree(d / 'src')
+        dst = d / 'dst'
+        src.sync_to(dst)
+        (src / 'a.txt').write_bytes(b'longer')
+        (src / 'new.txt').write_bytes(b'new')
+        (src / 'sub' / 'b.txt').write_bytes(b'BBB')
+        os.utime(src / 'sub' / 'b.txt', (1000000000, 1000000000))
+        (dst / 'extra').makedirs()
+        (dst / 'extra' / 'x.txt').touch()
+        (dst / 'sub' / 'y.txt').touch()
+
+        expected = (['new.txt'], ['a.txt', os.path.join('sub', 'b.txt')],
+                    ['extra', os.path.join('sub', 'y.txt')])
+        plan = src.sync_to(dst, delete=True, dry_run=True)
+        assert plan == expected
+        assert (dst / 'a.txt').bytes() == b'aaa'
+        assert (dst / 'extra' / 'x.txt').exists()
+
+        assert src.sync_to(dst, delete=True) == expected
+        assert (dst / 'a.txt').bytes() == b'longer'
+        assert (dst / 'sub' / 'b.txt').bytes() == b'BBB'
+        assert not (dst / 'extra').exists()
+        assert sorted(p.relpath(dst) for p in dst.walk()) == \
+            sorted(p.relpath(src) for p in src.walk())
+
+    def test_checksum_and_types(self, tmpdir):
+        d = Path(tmpdir)
+        src = self.make_tree(d / 'src')
+        dst = d / 'dst'
+        src.sync_to(dst)
+        (dst / 'a.txt').write_bytes(b'AAA')
+        stat = (src / 'a.txt').stat()
+        os.utime(dst / 'a.txt', (stat.st_atime, stat.st_mtime))
+        assert src.sync_to(dst, dry_run=True) == ([], [], [])
+        assert src.sync_to(dst, checksum=True) == ([], ['a.txt'], [])
+        assert (dst / 'a.txt').bytes() == b'aaa'
+
+        (dst / 'empty').rmdir()
+        (dst / 'empty').touch()
+        (dst / 'sub' / 'deeper').rmtree()
+        (dst / 'sub' / 'deeper').touch()
+        (src / 'sub' / 'deeper' / 'c.txt').rename(src / 'c.txt')
+        (src / 'sub' / 'deeper').rmdir()
+        (src / 'sub' / 'deeper').write_bytes(b'now a file')
+        plan = src.sync_to(dst)
+        assert plan.created == ['c.txt', 'empty']
+        assert plan.updated == [os.path.join('sub', 'deeper')]
+        assert (dst / 'empty').isdir()
+        assert (dst / 'sub' / 'deeper').bytes() == b'now a file'
+
+
+class TestMapping(object):
+    def test_mmap(self, tmpdir):
+        f = Path(tmpdir) / 'data.bin'
+        f.write_bytes(b'header' + b'\0' * 100000 + b'needle')
+        with f.mmap() as data:
+            assert len(data) == 100012
+            assert data[:6] == b'header'
+            assert data.find(b'needle') == 100006
+        assert data.closed
+        with f.memoryview() as view:
+            assert view.readonly
+            assert view[-6:].tobytes() == b'needle'
+        with pytest.raises(ValueError):
+            view[0]
+
+    def test_empty(self, tmpdir):
+        f = (Path(tmpdir) / 'empty').touch()
+        with f.mmap() as data:
+            assert data == b''
+        with f.memoryview() as view:
+            assert len(view) == 0
+        assert f.read_md5() == hashlib.md5().digest()
+
+    def test_hash_reads(self, tmpdir, monkeypatch):
+        f = Path(tmpdir) / 'data.bin'
+        f.write_bytes(b'x' * 3000000)
+
+        def refuse(*args, **kwargs):
+            raise AssertionError("hashing mapped the file")
+        monkeypatch.setattr(path.mmap_module, 'mmap', refuse)
+        assert f.read_hexhash('sha256') == hashlib.sha256(
+            b'x' * 3000000).hexdigest()
+
+    def test_hash_unmappable(self, tmpdir):
+        fifo = Path(tmpdir) / 'fifo'
+        if not hasattr(os, 'mkfifo'):
+            pytest.skip("needs named pipes")
+        os.mkfifo(fifo)
+
+        def feed():
+            with open(fifo, 'wb') as f:
+                f.write(b'x' * 3000000)
+        writer = threading.Thread(target=feed)
+        writer.start()
+        try:
+            assert fifo.read_hash('sha1') == \
+                hashlib.sha1(b'x' * 3000000).digest()
+        finally:
+            writer.join()
+
+
+class TestNewlines(object):
+    def test_write_text(self, tmpdir):
+        p = Path(tmpdir) / 'file.txt'
+        text = u('a\r\nb\r\x85c\rd\x85e\u2028f\r\r\ng\n')
+        p.write_text(text, 'utf-8', linesep='\r\n')
+        assert p.bytes() == b'a\r\nb\r\nc\r\nd\r\ne\r\nf\r\n\r\ng\r\n'
+        assert p.text('utf-8') == u('a\nb\nc\nd\ne\nf\n\ng\n')
+        p.write_text(text, 'utf-8', linesep=None)
+        assert p.bytes() == text.encode('utf-8')
+
+    def test_write_bytes_text(self, tmpdir):
+        p = Path(tmpdir) / 'file.txt'
+        p.write_text(b'a\r\nb\rc\n', linesep='\n')
+        assert p.bytes() == b'a\nb\nc\n'
+        p.write_text(b'a\r\nb\rc\n', linesep=None)
+        assert p.bytes() == b'a\r\nb\rc\n'
+
+
+def legacy_write_lines(f, lines, encoding, linesep):
+    """ write_lines() as of path.py 6.2, for Unicode lines. """
+    for line in lines:
+        if linesep is not None:
+            if line[-2:] in (u('\r\n'), u('\x0d\x85')):
+                line = line[:-2]
+            elif line[-1:] in (u('\r'), u('\n'), u('\x85'), u('\u2028')):
+                line = line[:-1]
+            line += linesep
+        f.write(line.encode(encoding))
+
+
+class TestWriteLines(object):
+    lines = [u('plain'), u('lf\n'), u('crlf\r\n'), u('cr\r'), u('nel\x85'),
+             u('crnel\r\x85'), u('ls\u2028'), u('\u00e9t\u00e9\n'), u(''),
+             u('\n'), u('two\n\n')] * 5000
+
+    @pytest.mark.parametrize('encoding', [
+        'utf-8', 'latin-1', 'utf-16', 'utf-16-le', 'utf-8-sig', 'utf-7',
+        'cp1252',
+    ])
+    @pytest.mark.parametrize('linesep', ['\n', '\r\n', None])
+    def test_same_output(self, tmpdir, encoding, linesep):
+        p = Path(tmpdir) / 'out.txt'
+        expected = Path(tmpdir) / 'expected.txt'
+        try:
+            with open(expected, 'wb') as f:
+                legacy_write_lines(f, self.lines, encoding, linesep)
+        except UnicodeEncodeError:
+            # e.g. U+2028 in Latin-1; the same lines should be written
+            with pytest.raises(UnicodeEncodeError):
+                p.write_lines(iter(self.lines), encoding, linesep=linesep)
+        else:
+            p.write_lines(iter(self.lines), encoding, linesep=linesep)
+        assert p.bytes() == expected.bytes()
+
+    def test_bytes_and_errors(self, tmpdir):
+        p = Path(tmpdir) / 'out.txt'
+        p.write_lines([b'one\r\n', u('two'), b'three\r'], linesep='\n')
+        assert p.bytes() == b'one\ntwo\nthree\n'
+        with pytest.raises(UnicodeEncodeError):
+            p.write_lines([u('fine'), u('\u00e9')], 'ascii')
+        assert p.bytes() == b'fine' + os.linesep.encode('ascii')
+
+
+class TestAtomicWrites(object):
+    @pytest.fixture
+    def fsyncs(self, monkeypatch):
+        calls = []
+        real_fsync = os.fsync
+
+        def fsync(fd):
+            calls.append(fd)
+            real_fsync(fd)
+        monkeypatch.setattr(os, 'fsync', fsync)
+        return calls
+
+    def test_write_bytes(self, tmpdir, fsyncs):
+        d = Path(tmpdir)
+        f = d / 'file.txt'
+        f.write_bytes(b'old')
+        f.chmod(0o600)
+        f.write_bytes(b'new', atomic=True)
+        assert f.bytes() == b'new'
+        assert f.stat().st_mode & 0o777 == 0o600
+        assert d.listdir() == [f]
+        assert not fsyncs
+        f.write_bytes(b'synced', atomic=True, durability='file')
+        assert len(fsyncs) == 1
+        (d / 'new.txt').write_text(u('text'), atomic=True,
+                                   durability='directory')
+        assert (d / 'new.txt').text() == 'text'
+        assert len(fsyncs) == 3
+        f.write_bytes(b'in place', durability='file')
+        assert len(fsyncs) == 4
+
+    def test_symlink_and_failure(self, tmpdir):
+        d = Path(tmpdir)
+        f = d / 'file.txt'
+        f.write_bytes(b'old')
+        f.symlink(d / 'link')
+        (d / 'link').write_bytes(b'new', atomic=True)
+        assert (d / 'link').islink() and f.bytes() == b'new'
+        with pytest.raises(TypeError):
+            f.write_bytes(object(), atomic=True)
+        assert f.bytes() == b'new'
+        assert sorted(d.listdir()) == [f, d / 'link']
+        with pytest.raises(ValueError):
+            f.write_bytes(b'', append=True, atomic=True)
+        with pytest.raises(ValueError):
+            f.write_bytes(b'', durability='disk')
+
+    def test_batch(self, tmpdir, fsyncs):
+        d = Path(tmpdir)
+        (d / 'a').mkdir()
+        (d / 'b').mkdir()
+        (d / 'a' / '0.txt').write_bytes(b'old')
+        with WriteBatch() as batch:
+            for i in range(10):
+                batch.write_text(d / 'a' / ('%d.txt' % i), u('a%d') % i)
+                batch.write_bytes(d / 'b' / ('%d.txt' % i), b'b')
+            assert (d / 'a' / '0.txt').bytes() == b'old'
+            assert not (d / 'b' / '0.txt').exists()
+        assert (d / 'a' / '0.txt').bytes() == b'a0'
+        assert (d / 'b' / '9.txt').bytes() == b'b'
+        # one sync per file and one per directory
+        assert len(fsyncs) == 22
+        assert len(list(d.walkfiles())) == 20
+
+    def test_batch_read_only(self, tmpdir, monkeypatch):
+        d = Path(tmpdir)
+        f = d / 'f.txt'
+        f.write_bytes(b'old')
+        f.chmod(0o444)
+        real_open = os.open
+
+        def open_as_user(name, flags, *args):
+            # refuse writing to read-only files even when run as root
+            if flags & (os.O_WRONLY | os.O_RDWR) and os.path.exists(name) \
+                    and not os.stat(name).st_mode & 0o200:
+                raise OSError(errno.EACCES, 'Permission denied', name)
+            return real_open(name, flags, *args)
+        monkeypatch.setattr(os, 'open', open_as_user)
+        with WriteBatch(durability='file') as batch:
+            batch.write_bytes(f, b'new')
+        assert f.bytes() == b'new'
+        assert f.stat().st_mode & 0o777 == 0o444
+        f.write_bytes(b'newer', atomic=True, durability='file')
+        assert f.bytes() == b'newer'
+
+    def test_batch_abort(self, tmpdir):
+        d = Path(tmpdir)
+        (d / 'f.txt').write_bytes(b'old')
+        with pytest.raises(RuntimeError):
+            with WriteBatch(durability='none') as batch:
+                batch.write_bytes(d / 'f.txt', b'new')
+                batch.write_bytes(d / 'g.txt', b'new')
+                raise RuntimeError
+        assert d.listdir() == [d / 'f.txt']
+        assert (d / 'f.txt').bytes() == b'old'
+
+
+class TestAsyncPath(object):
+    @pytest.fixture
+    def loop(self):
+        asyncio = pytest.importorskip('asyncio')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        yield loop
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    @staticmethod
+    def collect(loop, iterator):
+        assert iterator.__aiter__() is iterator
+        items = []
+        while True:
+            try:
+                items.append(loop.run_until_complete(iterator.__anext__()))
+            except StopAsyncIteration:
+                return items
+
+    def test_methods(self, tmpdir, loop):
+        d = Path(tmpdir).aio
+        assert isinstance(d, AsyncPath) and d.path == Path(tmpdir)
+        f = d / 'file.txt'
+        assert f == AsyncPath(Path(tmpdir) / 'file.txt')
+        assert f.parent == d and f.name == 'file.txt'
+        loop.run_until_complete(f.write_text(u('hello'), 'utf-8'))
+        asyncio = pytest.importorskip('asyncio')
+        results = loop.run_until_complete(asyncio.gather(
+            f.text('utf-8'), f.exists(), f.isdir(), f.getsize(),
+            (d / 'missing').exists()))
+        assert results == [u('hello'), True, False, 5, False]
+        with pytest.raises(OSError):
+            loop.run_until_complete((d / 'missing').stat())
+
+    def test_iterators(self, tmpdir, loop):
+        d = Path(tmpdir)
+        for i in range(10):
+            (d / ('sub%d' % i)).mkdir()
+            for j in range(30):
+                (d / ('sub%d' % i) / ('f%d.txt' % j)).touch()
+        aio = AsyncPath(d)
+        aio.batch = 7
+        files = self.collect(loop, aio.walkfiles('*.txt'))
+        assert sorted(files) == sorted(d.walkfiles('*.txt'))
+        assert sorted(self.collect(loop, aio.listdir())) == sorted(d.listdir())
+        assert self.collect(loop, (aio / 'sub0').dirs()) == []
+
+    def test_concurrent_next(self, tmpdir, loop):
+        asyncio = pytest.importorskip('asyncio')
+        d = Path(tmpdir)
+        for i in range(20):
+            (d / ('f%02d' % i)).touch()
+        aio = AsyncPath(d)
+        aio.batch = 3
+        iterator = aio.listdir()
+        results = loop.run_until_complete(asyncio.gather(
+            *[iterator.__anext__() for i in range(20)]))
+        assert results == d.listdir()
+        assert self.collect(loop, iterator) == []
+
+    def test_error(self, loop):
+        def items():
+            yield 1
+            raise ValueError("broken")
+        iterator = path._AsyncIterator(items, None, 5)
+        assert loop.run_until_complete(iterator.__anext__()) == 1
+        with pytest.raises(ValueError):
+            loop.run_until_complete(iterator.__anext__())
+        assert self.collect(loop, iterator) == []
+
+    def test_aclose(self, loop):
+        closed = []
+
+        def items():
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                closed.append(True)
+        iterator = path._AsyncIterator(items, None, 5)
+        assert loop.run_until_complete(iterator.__anext__()) == 0
+        pending = iterator.__anext__()
+        assert loop.run_until_complete(iterator.aclose()) is None
+        assert closed == [True]
+        assert loop.run_until_complete(pending) == 1
+        assert self.collect(loop, iterator) == []
+
+    def test_executor(self, tmpdir, loop):
+        futures = pytest.importorskip('concurrent.futures')
+        used = []
+
+        class Executor(futures.ThreadPoolExecutor):
+            def submit(self, *args, **kwargs):
+                used.append(args)
+                return super(Executor, self).submit(*args, **kwargs)
+        with Executor(2) as executor:
+            d = AsyncPath(str(tmpdir), executor)
+            assert loop.run_until_complete(d.isdir())
+            assert self.collect(loop, d.files()) == []
+        assert len(used) == 2
+
+
+class TestStatMany(object):
+    def make_paths(self, d):
+        many = (d / 'many').mkdir()
+        for i in range(0, 40, 2):
+            (many / ('f%d' % i)).write_bytes(b'x' * i)
+        (many / 'sub').mkdir()
+        (many / 'dangling').symlink(many / 'link')
+        (many / 'f0').symlink(many / 'good_link')
+        (d / 'single').touch()
+        paths = [many / ('f%d' % i) for i in range(40)]
+        paths += [many / 'sub', many / 'link', many / 'good_link',
+                  d / 'single', d / 'nothing', many / 'sub' / '..',
+                  d / 'gone' / 'a', many / 'f2' / 'child']
+        paths += [d / 'gone' / ('x%d' % i) for i in range(10)]
+        # names that aren't entries of a listing of their directory
+        (many / 'sub' / 's0').touch()
+        paths += [many / 'sub' / ('s%d' % i) for i in range(10)]
+        paths += [many / 'sub' / '', many / 'sub' / '.',
+                  many / 'sub' / '..', many / 'sub' / 's0' / '..']
+        return paths
+
+    def test_exists_many(self, tmpdir, monkeypatch):
+        paths = self.make_paths(Path(tmpdir))
+        expected = [p.exists() for p in paths]
+        calls = []
+        real_stat = os.stat
+        monkeypatch.setattr(os, 'stat', lambda *a, **kw: (
+            calls.append(a) or real_stat(*a, **kw)))
+        result = Path.exists_many(paths, workers=3)
+        assert result.typecode == 'B'
+        assert list(result) == expected
+        # only paths outside the listed directories are looked up alone
+        assert len(calls) < 12
+
+    @pytest.mark.parametrize('follow_symlinks', [True, False])
+    def test_stat_many(self, tmpdir, follow_symlinks):
+        paths = self.make_paths(Path(tmpdir))
+        columns = Path.stat_many(paths, follow_symlinks=follow_symlinks)
+        assert isinstance(columns, path.StatColumns)
+        for i, p in enumerate(paths):
+            try:
+                st = os.stat(p) if follow_symlinks else os.lstat(p)
+            except OSError:
+                assert not columns.exists[i]
+                assert columns.size[i] == -1 and columns.mode[i] == 0
+                assert columns.mtime[i] != columns.mtime[i]
+            else:
+                assert columns.exists[i]
+                assert columns.size[i] == st.st_size
+                assert columns.mtime[i] == st.st_mtime
+                assert columns.mode[i] == st.st_mode
+        assert [len(column) for column in Path.stat_many([])] == [0] * 4
+
+    def test_relative(self, tmpdir, monkeypatch):
+        d = Path(tmpdir)
+        for i in range(0, 10, 2):
+            (d / ('f%d' % i)).touch()
+        monkeypatch.chdir(d)
+        names = ['f%d' % i for i in range(10)]
+        expected = [i % 2 == 0 for i in range(10)]
+        assert list(Path.exists_many(names)) == expected
+        assert list(Path.stat_many(names).exists) == expected
+
+    @pytest.mark.skipif(sys.platform.startswith('win'),
+        reason="the current directory can't be removed")
+    def test_removed_cwd(self, tmpdir, monkeypatch):
+        gone = (Path(tmpdir) / 'gone').mkdir()
+        monkeypatch.chdir(gone)
+        gone.rmdir()
+        real_list_entries = path._list_entries
+        listed = []
+        monkeypatch.setattr(path, '_list_entries', lambda dirpath: (
+            listed.append(dirpath) or real_list_entries(dirpath)))
+        names = ['f%d' % i for i in range(10)]
+        assert list(Path.exists_many(names)) == \
+            [Path(name).exists() for name in names]
+        assert listed == ['']
+
+
+def make_sized_tree(d):
+    """
+    Fill the directory `d` with four files of various sizes and
+    extensions, one of them modified ten days ago, in nested directories,
+    and a symbolic link.
+    """
+    (d / 'a.txt').write_bytes(b'x' * 10)
+    (d / 'b.log').write_bytes(b'x' * 300)
+    (d / 'sub' / 'deep').makedirs()
+    (d / 'sub' / 'c.txt').write_bytes(b'x' * 50)
+    (d / 'sub' / 'deep' / 'README').write_bytes(b'x' * 7)
+    (d / 'a.txt').symlink(d / 'sub' / 'link.txt')
+    old = time.time() - 10 * 86400
+    os.utime(d / 'sub' / 'c.txt', (old, old))
+
+
+class TestSnapshot(object):
+    @pytest.fixture(params=['numpy', 'array'])
+    def backend(self, request, monkeypatch):
+        if request.param == 'numpy':
+            pytest.importorskip('numpy')
+        else:
+            monkeypatch.delattr(path, 'numpy', raising=False)
+        return request.param
+
+    def test_columns(self, tmpdir, backend):
+        d = Path(tmpdir)
+        make_sized_tree(d)
+        snap = d.snapshot()
+        assert len(snap) == 7
+        assert sorted(snap.paths()) == sorted(d.walk())
+        for i, p in enumerate(snap.paths()):
+            st = p.lstat()
+            assert snap.size[i] == st.st_size
+            assert snap.mode[i] == st.st_mode
+            assert snap.inode[i] == st.st_ino
+            assert snap.mtime_ns[i] // 1000000000 == int(st.st_mtime)
+            assert snap.parent[i] == -1 or snap.path(
+                int(snap.parent[i])) == p.parent
+
+    def test_queries(self, tmpdir, backend):
+        d = Path(tmpdir)
+        make_sized_tree(d)
+        snap = d.snapshot()
+        assert snap.largest(2) == [(d / 'b.log', 300),
+                                   (d / 'sub' / 'c.txt', 50)]
+        assert len(snap.largest()) == 4
+        assert snap.bytes_per_extension() == {
+            '.txt': 60, '.log': 300, '': 7}
+        assert snap.older_than(5) == [d / 'sub' / 'c.txt']
+        assert snap.older_than(5, now=time.time() - 20 * 86400) == []
+
+    def test_empty(self, tmpdir, backend):
+        snap = Path(tmpdir).snapshot()
+        assert len(snap) == 0
+        assert snap.largest() == []
+        assert snap.bytes_per_extension() == {}
+        assert snap.older_than(0) == []
+
+    def test_errors(self, tmpdir):
+        with pytest.raises(OSError):
+            (Path(tmpdir) / 'missing').snapshot()
+        assert len((Path(tmpdir) / 'missing').snapshot(errors='ignore')) == 0
+
+
+class TestDiskUsage(object):
+    def make_tree(self, d):
+        (d / 'a').write_bytes(b'x' * 100)
+        (d / 'sub').mkdir()
+        (d / 'sub' / 'b').write_bytes(b'x' * 5000)
+        (d / 'sub' / 'deep').mkdir()
+        (d / 'sub' / 'deep' / 'c').write_bytes(b'x' * 30)
+        (d / 'sub' / 'b').link(d / 'sub' / 'deep' / 'b_link')
+        (d / 'other').mkdir()
+        (d / 'a').symlink(d / 'other' / 'link')
+
+    def expected(self, d):
+        seen = set()
+        apparent = allocated = files = 0
+        for p in [d] + (sorted(d.walk()) if d.isdir() else []):
+            st = p.lstat()
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            apparent += st.st_size
+            if hasattr(st, 'st_blocks'):
+                allocated += st.st_blocks * 512
+            else:
+                allocated += st.st_size
+            files += not p.isdir() or p.islink()
+        return path.DiskUsage(apparent, allocated, files)
+
+    @pytest.mark.parametrize('workers', [None, 3])
+    def test_du(self, tmpdir, workers):
+        d = Path(tmpdir)
+        self.make_tree(d)
+        usage = d.du(workers=workers)
+        assert usage == self.expected(d)
+        assert usage.files == 4
+        assert (d / 'a').du() == self.expected(d / 'a')
+        assert (d / 'a').du().files == 1
+
+    @pytest.mark.parametrize('workers', [None, 3])
+    def test_depth(self, tmpdir, workers):
+        d = Path(tmpdir)
+        self.make_tree(d)
+        usage = d.du(depth=1, workers=workers)
+        assert sorted(usage) == [d, d / 'other', d / 'sub']
+        assert usage[d] == d.du()
+        assert usage[d / 'other'] == self.expected(d / 'other')
+        # the hard link is only counted under the directory found first
+        assert usage[d / 'sub'] == self.expected(d / 'sub')
+        assert usage[d / 'sub'].apparent > 5000
+        assert sorted(d.du(depth=0)) == [d]
+        assert sorted(d.du(depth=5)) == [
+            d, d / 'other', d / 'sub', d / 'sub' / 'deep']
+
+    def test_hardlink_rollups(self, tmpdir):
+        d = Path(tmpdir)
+        names = ['ff', 'bb', 'dd', 'aa', 'ee', 'cc']
+        first = (d / names[0]).mkdir() / 'file'
+        first.write_bytes(b'x' * 100000)
+        for name in names[1:]:
+            first.link((d / name).mkdir() / 'file')
+        serial = d.du(depth=1)
+        assert serial == d.du(depth=1, workers=4)
+        # the shared file counts toward the first directory by path
+        assert serial[d / 'aa'].apparent > 100000
+        for name in names:
+            if name != 'aa':
+                assert serial[d / name].apparent < 100000
+
+    def test_errors(self, tmpdir, monkeypatch):
+        d = Path(tmpdir)
+        self.make_tree(d)
+        with pytest.raises(OSError):
+            (d / 'missing').du()
+        assert (d / 'missing').du(errors='ignore') == (0, 0, 0)
+
+        def fail(dirpath):
+            raise OSError(errno.EACCES, 'denied', dirpath)
+        monkeypatch.setattr(path, '_du_scan', fail)
+        with pytest.raises(OSError):
+            d.du(workers=2)
+        usage = d.du(errors='ignore')
+        assert usage.files == 0 and usage.apparent == d.lstat().st_size
+
+
+class TestFileIndex(object):
+    def settle(self, d):
+        """ Age the directories' times so refreshes trust them. """
+        old = time.time() - 60
+        for p in [d] + list(d.walkdirs()):
+            os.utime(p, (old, old))
+
+    def test_queries(self, tmpdir):
+        d = Path(tmpdir) / 'tree'
+        d.mkdir()
+        make_sized_tree(d)
+        with d.index(Path(tmpdir) / 'index.db') as index:
+            assert isinstance(index, path.FileIndex)
+            assert len(index) == 4
+            # the symbolic link is left out
+            assert index.files() == [
+                d / 'a.txt', d / 'b.log', d / 'sub' / 'c.txt',
+                d / 'sub' / 'deep' / 'README']
+            assert index.files('*.txt') == [d / 'a.txt', d / 'sub' / 'c.txt']
+            assert index.glob('sub/*') == [
+                d / 'sub' / 'c.txt', d / 'sub' / 'deep' / 'README']
+            assert index.files(ext='.log') == [d / 'b.log']
+            assert index.files(ext=['.log', '.txt'], min_size=10,
+                               max_size=50) == [
+                d / 'a.txt', d / 'sub' / 'c.txt']
+            week_ago = time.time() - 7 * 86400
+            assert index.files(older_than=week_ago) == [d / 'sub' / 'c.txt']
+            assert len(index.files(newer_than=week_ago)) == 3
+
+    @pytest.mark.parametrize('pattern', [
+        '[!_]*.py', '[_]*', '[^_]*', '[^]*', '[]a]*', '[!]a]*', '[*',
+        '*[a-c]*', '[^a-]*', '?.py'])
+    def test_patterns(self, tmpdir, pattern):
+        d = Path(tmpdir) / 'tree'
+        d.mkdir()
+        for name in ('a.py', '_b.py', '^c', ']d', '[*x', '-e', 'z.py'):
+            (d / name).touch()
+        with d.index(Path(tmpdir) / 'index.db') as index:
+            assert index.files(pattern) == sorted(d.walkfiles(pattern))
+
+    def test_refresh(self, tmpdir, monkeypatch):
+        d = Path(tmpdir) / 'tree'
+        d.mkdir()
+        make_sized_tree(d)
+        db = Path(tmpdir) / 'index.db'
+        d.index(db).close()
+        self.settle(d)
+        with d.index(db, refresh=False) as index:
+            # the directories' times changed since, so all are listed
+            assert index.refresh() == 3
+            assert index.refresh() == 0
+            (d / 'sub' / 'new.txt').write_bytes(b'new')
+            (d / 'sub' / 'deep').rmtree()
+            # a rewrite in place goes unnoticed by a normal refresh
+            (d / 'a.txt').write_bytes(b'y' * 20)
+            assert index.refresh() == 1
+            assert index.files() == [
+                d / 'a.txt', d / 'b.log', d / 'sub' / 'c.txt',
+                d / 'sub' / 'new.txt']
+            assert index.files(min_size=15, max_size=25) == []
+            assert index.refresh(full=True) == 2
+            assert index.files(min_size=15, max_size=25) == [d / 'a.txt']
+
+            listed = []
+            real_listentries = Path._listentries
+            monkeypatch.setattr(Path, '_listentries', lambda self: (
+                listed.append(self) or real_listentries(self)))
+            self.settle(d)
+            index.refresh()
+            (d / 'sub' / 'more').mkdir()
+            listed[:] = []
+            assert index.refresh() == 2
+            assert sorted(listed) == [d / 'sub', d / 'sub' / 'more']
+
+    def test_other_root(self, tmpdir):
+        d = Path(tmpdir)
+        db = d / 'index.db'
+        (d / 'one').mkdir().index(db).close()
+        (d / 'two').mkdir()
+        with pytest.raises(ValueError):
+            (d / 'two').index(db)
+
+    def test_errors(self, tmpdir):
+        d = Path(tmpdir)
+        with pytest.raises(OSError):
+            (d / 'missing').index(d / 'index.db')
+        with (d / 'missing').index(d / 'index.db', errors='ignore') as index:
+            assert len(index) == 0
+
+
+class TestWatch(object):
+    @pytest.fixture(params=['inotify', 'polling'])
+    def poll(self, request):
+        if request.param == 'inotify' and path._libc is None:
+            pytest.skip("inotify is not available")
+        return request.param == 'polling'
+
+    def watch(self, d, poll, **kwargs):
+        watcher = d.watch(poll=poll, interval=0.05, **kwargs)
+        assert isinstance(watcher, path.Watcher)
+        assert watcher.polling == poll
+        return watcher
+
+    def test_changes(self, tmpdir, poll):
+        d = Path(tmpdir)
+        (d / 'old').write_bytes(b'old')
+        (d / 'gone').touch()
+        (d / 'dir').mkdir()
+        with self.watch(d, poll) as watcher:
+            assert watcher.read(timeout=0.1) == []
+            (d / 'new').write_bytes(b'1')
+            (d / 'new').write_bytes(b'12')
+            (d / 'old').write_bytes(b'changed')
+            (d / 'gone').remove()
+            (d / 'dir' / 'sub').mkdir()
+            (d / 'dir' / 'sub' / 'file').touch()
+            (d / 'temp').touch()
+            (d / 'temp').remove()
+            events = watcher.read(timeout=5)
+            assert sorted(events) == sorted([
+                ('created', d / 'new', None),
+                ('modified', d / 'old', None),
+                ('deleted', d / 'gone', None),
+                ('created', d / 'dir' / 'sub', None),
+                ('created', d / 'dir' / 'sub' / 'file', None),
+            ])
+            assert all(isinstance(e, path.WatchEvent) for e in events)
+            # the new directory is watched too
+            (d / 'dir' / 'sub' / 'file').write_bytes(b'x')
+            assert watcher.read(timeout=5) == [
+                ('modified', d / 'dir' / 'sub' / 'file', None)]
+
+    def test_moves(self, tmpdir, poll):
+        d = Path(tmpdir)
+        (d / 'tree').mkdir()
+        (d / 'dir' / 'inner').makedirs()
+        (d / 'dir' / 'inner' / 'file').touch()
+        (d / 'tree' / 'file').touch()
+        with self.watch(d / 'tree', poll) as watcher:
+            (d / 'tree' / 'file').rename(d / 'tree' / 'renamed')
+            (d / 'dir').rename(d / 'tree' / 'dir')
+            assert sorted(watcher.read(timeout=5)) == [
+                ('created', d / 'tree' / 'dir', None),
+                ('created', d / 'tree' / 'dir' / 'inner', None),
+                ('created', d / 'tree' / 'dir' / 'inner' / 'file', None),
+                ('moved', d / 'tree' / 'file', d / 'tree' / 'renamed'),
+            ]
+            (d / 'tree' / 'dir').rename(d / 'tree' / 'moved')
+            assert watcher.read(timeout=5) == [
+                ('moved', d / 'tree' / 'dir', d / 'tree' / 'moved')]
+            (d / 'tree' / 'moved' / 'inner' / 'file').remove()
+            assert watcher.read(timeout=5) == [
+                ('deleted', d / 'tree' / 'moved' / 'inner' / 'file', None)]
+            (d / 'tree' / 'moved').rename(d / 'out')
+            assert watcher.read(timeout=5) == [
+                ('deleted', d / 'tree' / 'moved', None)]
+            (d / 'out' / 'inner' / 'other').touch()
+            assert watcher.read(timeout=0.2) == []
+
+    def test_not_recursive(self, tmpdir, poll):
+        d = Path(tmpdir)
+        (d / 'dir').mkdir()
+        with self.watch(d, poll, recursive=False) as watcher:
+            (d / 'dir' / 'file').touch()
+            assert watcher.read(timeout=0.2) == []
+            (d / 'file').touch()
+            assert watcher.read(timeout=5) == [('created', d / 'file', None)]
+
+    def test_iterate(self, tmpdir, poll):
+        d = Path(tmpdir)
+        with self.watch(d, poll) as watcher:
+            (d / 'file').touch()
+            for event in watcher:
+                assert event == ('created', d / 'file', None)
+                break
+
+    def test_merge(self):
+        events = [
+            ('created', 'a', None), ('modified', 'a', None),
+            ('modified', 'b', None), ('deleted', 'b', None),
+            ('created', 'c', None), ('deleted', 'c', None),
+            ('deleted', 'd', None), ('created', 'd', None),
+            ('moved', 'a', 'e'), ('modified', 'a', None),
+        ]
+        events = [path.WatchEvent(*event) for event in events]
+        assert path.Watcher._merge(events) == [
+            ('created', 'a', None), ('deleted', 'b', None),
+            ('modified', 'd', None), ('moved', 'a', 'e'),
+            ('modified', 'a', None)]
+
+    def test_fallback(self, tmpdir, monkeypatch):
+        d = Path(tmpdir)
+        monkeypatch.setattr(path, '_libc', None)
+        assert d.watch().polling
+        with pytest.raises(OSError):
+            d.watch(poll=False)
+        with pytest.raises(OSError):
+            (d / 'missing').watch()
+
+
+class TestIterLines(object):
+    content = u('first\r\nsecond\r\x85third\rfourth\x85fifth\u2028'
+                'sixth\x0cseventh\u2029\u00e9\u00e9\r\r\n\n'
+                'no newline at end')
+
+    @pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 2 ** 16])
+    @pytest.mark.parametrize('retain', [True, False])
+    def test_matches_text(self, tmpdir, chunk_size, retain):
+        p = Path(tmpdir) / 'file.txt'
+        p.write_bytes(self.content.encode('utf-8'))
+        expected = p.text('utf-8').splitlines(retain)
+        lines = p.iterlines('utf-8', retain=retain, chunk_size=chunk_size)
+        assert list(lines) == expected
+        assert p.lines('utf-8', retain=retain) == expected
+
+    def test_trailing_newline(self, tmpdir):
+        p = Path(tmpdir) / 'file.txt'
+        p.write_bytes(b'a\r\nb\r')
+        assert list(p.iterlines('ascii', chunk_size=1)) == ['a\n', 'b\n']
+        p.write_bytes(b'')
+        assert list(p.iterlines('ascii')) == []
+
+    def test_no_encoding(self, tmpdir):
+        p = Path(tmpdir) / 'file.txt'
+        p.write_bytes(b'one\r\ntwo\rthree\x0cfour\n')
+        assert list(p.iterlines()) == ['one\n', 'two\n', 'three\x0cfour\n']
+        assert list(p.iterlines(retain=False)) == \
+            ['one', 'two', 'three', 'four']
+        assert p.lines(retain=False) == list(p.iterlines(retain=False))
+
+    def test_long_line(self, tmpdir):
+        p = Path(tmpdir) / 'file.txt'
+        # a line spanning many chunks, whose '\r\n' straddles two of them
+        long_line = 'x' * (64 * 1563 - 1)
+        p.write_bytes(long_line.encode('ascii') + b'\r\nshort\rend')
+        lines = list(p.iterlines('ascii', chunk_size=64))
+        assert lines == [long_line + '\n', 'short\n', 'end']
+        assert list(p.iterlines('ascii', retain=False, chunk_size=64)) == \
+            [long_line, 'short', 'end']
+
+    def test_lazy(self, tmpdir):
+        p = Path(tmpdir) / 'file.txt'
+        p.write_bytes(b'line\n' * 100000)
+        lines = p.iterlines('ascii', chunk_size=64)
+        assert next(lines) == 'line\n'
+        lines.close()
+
+
+class CachedPath(Path):
+    cache_stat = True
+
+
+class TestStatCache(object):
+    def test_cached_class(self):
+        cls = Path.using_stat_cache(ttl=30)
+        assert cls is Path.using_stat_cache(30)
+        assert cls is not Path.using_stat_cache()
+        assert issubclass(cls, Path)
+        assert cls.cache_stat and not Path.cache_stat
+        assert isinstance(cls('foo') / 'bar', cls)
+
+    def test_metadata_is_cached(self, tmpdir):
+        f = Path.using_stat_cache()(tmpdir) / 'f.txt'
+        f.write_bytes(b'abc')
+        assert f.size == 3 and f.isfile() and f.exists()
+        f.write_bytes(b'abcdef')
+        assert f.size == 3
+        assert f.refresh().size == 6
+        f.remove()
+        assert f.exists()
+        assert not f.refresh().exists()
+        assert not f.isfile()
+        with pytest.raises(OSError):
+            f.stat()
+
+    def test_ttl(self, tmpdir):
+        f = Path.using_stat_cache(ttl=0)(tmpdir) / 'f.txt'
+        f.write_bytes(b'abc')
+        assert f.size == 3
+        f.write_bytes(b'abcdef')
+        assert f.size == 6
+
+    @pytest.mark.skipif(not hasattr(os, 'symlink'),
+        reason="symlinks not available")
+    def test_listing_carries_entries(self, tmpdir, monkeypatch):
+        d = Path.using_stat_cache()(tmpdir)
+        (d / 'sub').mkdir()
+        (d / 'sub' / 'f.txt').write_bytes(b'abc')
+        (d / 'sub' / 'f.txt').symlink(d / 'link')
+        found = list(d.walk())
+        calls = []
+        monkeypatch.setattr(os, 'stat', lambda *args: calls.append(args))
+        monkeypatch.setattr(os, 'lstat', lambda *args: calls.append(args))
+        for item in found:
+            assert item.exists()
+            item.isdir(), item.isfile(), item.islink()
+        assert sorted(d.files()) == [d / 'link']
+        assert [f.size for f in d.walkfiles('*.txt')] == [3]
+        if 'scandir' in vars(path):
+            assert calls == []
+
+    def test_pickle_drops_cache(self, tmpdir):
+        import pickle
+        d = CachedPath(tmpdir)
+        (d / 'f.txt').touch()
+        f, = d.files()
+        restored = pickle.loads(pickle.dumps(f))
+        assert restored == f
+        assert '_metadata' not in vars(restored)
+
+
+class TestWalkEntries(object):
+    @classmethod
+    def build_tree(cls, tmpdir):
+        p = Path(tmpdir)
+        (p/'sub1'/'deep').makedirs_p()
+        (p/'sub2').makedirs_p()
+        for d in (p, p/'sub1', p/'sub1'/'deep', p/'sub2'):
+            (d/'a.txt').touch()
+            (d/'b.py').touch()
+        return p
+
+    def test_walk_matches_listing(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        assert sorted(p.walkdirs()) == sorted(
+            [p/'sub1', p/'sub1'/'deep', p/'sub2'])
+        assert sorted(p.walkfiles('*.py')) == sorted(
+            [p/'b.py', p/'sub1'/'b.py', p/'sub1'/'deep'/'b.py',
+             p/'sub2'/'b.py'])
+        assert len(list(p.walk())) == 11
+        assert sorted(p.dirs()) == [p/'sub1', p/'sub2']
+        assert sorted(p.files()) == [p/'a.txt', p/'b.py']
+
+    def test_walk_preorder(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        items = list(p.walk())
+        for item in items:
+            if item.parent != p:
+                assert items.index(item.parent) < items.index(item)
+
+    def test_walk_max_depth(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        assert sorted(p.walk(max_depth=1)) == sorted(p.listdir())
+        assert sorted(p.walkdirs(max_depth=2)) == sorted(
+            [p/'sub1', p/'sub1'/'deep', p/'sub2'])
+        assert len(list(p.walkfiles(max_depth=2))) == 6
+        assert list(p.walk(max_depth=0)) == []
+
+    def test_walk_breadth_first(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        depths = [len(item.splitall()) for item in p.walk(breadth_first=True)]
+        assert depths == sorted(depths)
+        assert sorted(p.walk(breadth_first=True)) == sorted(p.walk())
+
+    def test_walk_prune(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        listed = []
+        real_listentries = Path._listentries
+
+        def spy(self, pattern=None):
+            listed.append(self)
+            return real_listentries(self, pattern)
+        pruned = []
+
+        def prune(d):
+            pruned.append(d)
+            return d.name == 'sub1'
+        try:
+            Path._listentries = spy
+            items = list(p.walk(prune=prune))
+        finally:
+            Path._listentries = real_listentries
+        assert sorted(items) == sorted(
+            [p/'a.txt', p/'b.py', p/'sub2', p/'sub2'/'a.txt', p/'sub2'/'b.py'])
+        assert sorted(pruned) == [p/'sub1', p/'sub2']
+        assert sorted(listed) == [p, p/'sub2']
+
+    def test_parallel_walk_traversal_options(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        prune = lambda d: d.name == 'deep'
+        for options in [dict(breadth_first=True), dict(max_depth=2),
+                        dict(prune=prune)]:
+            assert list(p.walk(workers=3, ordered=True, **options)) == \
+                list(p.walk(**options))
+            assert sorted(p.walk(workers=3, **options)) == \
+                sorted(p.walk(**options))
+
+    def test_walk_deeper_than_recursion_limit(self, tmpdir):
+        p = Path(tmpdir)
+        leaf = p
+        depth = 1100
+        for i in range(depth):
+            leaf = (leaf / 'd').mkdir()
+        (leaf / 'bottom.txt').touch()
+        try:
+            assert list(p.walkfiles()) == [leaf / 'bottom.txt']
+            assert len(list(p.walkdirs())) == depth
+            assert len(list(p.walk())) == depth + 1
+        finally:
+            # shutil.rmtree recurses, so tear the tree down from the bottom
+            (leaf / 'bottom.txt').remove()
+            while leaf != p:
+                leaf = leaf.rmdir().parent
+
+    def test_parallel_walk(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        assert sorted(p.walkfiles(workers=4)) == sorted(p.walkfiles())
+        assert sorted(p.walkdirs(workers=4)) == sorted(p.walkdirs())
+        assert sorted(p.walk('*.py', workers=2)) == sorted(p.walk('*.py'))
+
+    def test_parallel_walk_ordered(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        for workers in (1, 3):
+            assert list(p.walk(workers=workers, ordered=True)) == \
+                list(p.walk())
+            assert list(p.walkfiles(workers=workers, ordered=True)) == \
+                list(p.walkfiles())
+
+    def test_parallel_walk_errors(self, tmpdir):
+        missing = Path(tmpdir) / 'missing'
+        assert list(missing.walkfiles(errors='ignore', workers=2)) == []
+        with pytest.raises(OSError):
+            list(missing.walkfiles(workers=2))
+        msgs = []
+        list(missing.walk(errors=msgs.append, workers=2, ordered=True))
+        assert len(msgs) == 1 and 'Unable to list' in msgs[0]
+
+    def test_walk_entry_error_reported_once(self, tmpdir, monkeypatch):
+        class BrokenEntry(object):
+            def is_dir(self):
+                raise OSError(errno.EACCES, "denied")
+            is_file = is_dir
+        p = Path(tmpdir)
+        monkeypatch.setattr(Path, '_listentries', lambda self, pattern=None:
+                            [(self / 'broken', BrokenEntry())])
+        for walker in (p.walkfiles, p.walkdirs):
+            msgs = []
+            assert list(walker(errors=msgs.append)) == []
+            assert len(msgs) == 1 and 'Unable to access' in msgs[0]
+
+    def test_parallel_walk_early_exit(self, tmpdir):
+        p = self.build_tree(tmpdir)
+        walker = p.walk(workers=2)
+        next(walker)
+        walker.close()
+
+    @pytest.mark.skipif('scandir' not in vars(path),
+        reason="scandir not available")
+    def test_walk_uses_entry_types(self, tmpdir, monkeypatch):
+        """
+        Walking should rely on the file types reported by the directory
+        listing rather than calling stat() for every entry.
+        """
+        p = self.build_tree(tmpdir)
+        calls = []
+        real_stat = os.stat
+
+        def counting_stat(*args, **kwargs):
+            calls.append(args[0])
+            return real_stat(*args, **kwargs)
+        monkeypatch.setattr(os, 'stat', counting_stat)
+        list(p.walk())
+        list(p.walkfiles())
+        list(p.walkdirs())
+        assert calls == []
+
+
 @pytest.mark.skipif(sys.version_info < (2, 6),
     reason="in_place requires io module in Python 2.6")
 class TestInPlace(object):
@@ -937,5 +2471,57 @@ class TestInPlace(object):
         assert not 'Lorem' in data
         assert 'lazy dog' in data
 
+    def test_atomic(self, tmpdir):
+        doc = self.create_reference(tmpdir)
+        doc.chmod(0o640)
+        with doc.in_place(atomic=True, backup_extension='.orig') as (
+                reader, writer):
+            for line in reader:
+                writer.write(''.join(reversed(line.strip())) + '\n')
+            # the original is untouched until the block exits
+            assert doc.text() == self.reference_content
+        assert doc.text() == self.reversed_content
+        assert doc.stat().st_mode & 0o777 == 0o640
+        assert (doc + '.orig').text() == self.reference_content
+        assert sorted(Path(tmpdir).listdir()) == [doc, doc + '.orig']
+
+    def test_atomic_exception(self, tmpdir):
+        doc = self.create_reference(tmpdir)
+        with pytest.raises(RuntimeError):
+            with doc.in_place(atomic=True) as (reader, writer):
+                writer.write(self.alternate_content)
+                raise RuntimeError("some error")
+        assert doc.text() == self.reference_content
+        assert Path(tmpdir).listdir() == [doc]
+
+    def test_atomic_backup_failure(self, tmpdir, monkeypatch):
+        doc = self.create_reference(tmpdir)
+
+        def no_space(*args):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        monkeypatch.setattr(os, 'link', no_space)
+        monkeypatch.setattr(Path, 'copy2', no_space)
+        with pytest.raises(OSError):
+            with doc.in_place(atomic=True, backup_extension='.orig') as (
+                    reader, writer):
+                writer.write(self.alternate_content)
+        assert doc.text() == self.reference_content
+        assert Path(tmpdir).listdir() == [doc]
+
+    def test_transform(self, tmpdir):
+        doc = self.create_reference(tmpdir)
+        doc.write_bytes(b'one\r\ntwo\nthree')
+        doc.transform(lambda line: line.upper())
+        assert doc.bytes() == b'ONE\r\nTWO\nTHREE'
+        doc.transform(lambda line: line.replace(u('T'), u('\u00fe')),
+                      encoding='utf-8')
+        assert doc.text('utf-8') == u('ONE\n\u00feWO\n\u00feHREE')
+        assert doc.bytes().startswith(b'ONE\r\n')
+        doc.write_bytes(b'abcdefg')
+        doc.transform(lambda chunk: chunk[::-1], chunk_size=2,
+                      backup_extension='.bak')
+        assert doc.bytes() == b'badcfeg'
+        assert (doc + '.bak').bytes() == b'abcdefg'
+
 if __name__ == '__main__':
     pytest.main()